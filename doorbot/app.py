@@ -17,24 +17,36 @@ import asyncio
 import pigpio
 import re
 import os
-import requests
 import copy
+import signal
 
 from doorbot.interfaces import slack_blocks
 from doorbot.interfaces.doorbot_hat_gpio import DoorbotHatGpio
 from doorbot.interfaces.wiegand_key_reader import KeyReader
 from doorbot.interfaces.blinkstick_interface import BlinkstickInterface
 from doorbot.interfaces.tidyauth_client import TidyAuthClient
+from doorbot.interfaces.home_assistant_client import HomeAssistantClient
 from doorbot.interfaces.user_manager import UserManager
 from doorbot.interfaces.sound_downloader import SoundDownloader
 from doorbot.interfaces.sound_player import SoundPlayer
-from doorbot.interfaces.monotonic_waiter import MonotonicWaiter
+from doorbot.interfaces.sound_store import SoundStore
+from doorbot.interfaces.sound_ingest import SoundIngest
+from doorbot.interfaces.timer_scheduler import TimerScheduler
+from doorbot.interfaces.key_refresh import KeyRefresh
+from doorbot.interfaces.latency_trace import LatencyStats
+from doorbot.interfaces.loop_monitor import LoopMonitor, DeadlineFailsafe
 from doorbot.interfaces import text_to_speech
 
 # ======= Logging =======
 
-# Global queue for log messages to be sent via Slack
-global_slack_log_queue = []
+# Global queue for log messages to be sent via Slack, read by slack_log_worker
+global_slack_log_queue = asyncio.Queue()
+
+# Seconds slack_log_worker waits after failing to post, so an outage isn't hammered
+SLACK_LOG_ERROR_BACKOFF_S = 5.0
+
+# Event loop slack_log_worker runs on. Messages logged from other threads are queued through it.
+slack_log_loop = None
 
 # Holds the config but not used directly
 root_logger = None
@@ -49,8 +61,16 @@ class SlackLogger(logging.Handler):
     def emit(self, record):
         log_msg = self.format(record)
         sanitised_log_msg = re.sub(r"(?<=token=)[^&]*", "REDACTED", log_msg)
-        global global_slack_log_queue
-        global_slack_log_queue.append(sanitised_log_msg)
+        if slack_log_loop is None:
+            # Worker not started yet, nothing is waiting on the queue
+            global_slack_log_queue.put_nowait(sanitised_log_msg)
+            return
+        try:
+            # Logging can come from any thread
+            slack_log_loop.call_soon_threadsafe(global_slack_log_queue.put_nowait, sanitised_log_msg)
+        except RuntimeError:
+            # Loop closed at shutdown
+            pass
 
 
 def setup_logging(log_path):
@@ -111,12 +131,32 @@ class Config:
         self.tidyauth_token = config["tidyauth"]["token"]
         self.tidyauth_cache_file = config["tidyauth"]["cache_file"]
         self.tidyauth_update_interval_seconds = config["tidyauth"]["update_interval_seconds"]
+        self.tidyauth_max_sound_fetches = config["tidyauth"].get("max_sound_fetches", 4)
+        self.tidyauth_cache_journal_max_bytes = config["tidyauth"].get("cache_journal_max_bytes", 65536)
+        self.tidyauth_index_file = config["tidyauth"].get("index_file")
+        self.tidyauth_denied_cache_seconds = config["tidyauth"].get("denied_cache_seconds", 60.0)
+        self.tidyauth_denied_refresh_burst = config["tidyauth"].get("denied_refresh_burst", 3)
+        self.tidyauth_denied_refresh_refill_seconds = config["tidyauth"].get("denied_refresh_refill_seconds", 60.0)
+        self.tidyauth_denied_refresh_min_interval_seconds = config["tidyauth"].get(
+            "denied_refresh_min_interval_seconds", 10.0)
         self.sounds_dir = config["sounds_dir"]
         self.custom_sounds_dir = config["custom_sounds_dir"]
+        self.custom_sounds_max_downloads = config.get("custom_sounds_max_downloads", 4)
+        self.custom_sounds_max_bytes = config.get("custom_sounds_max_bytes", 5242880)
+        self.custom_sounds_quota_bytes = config.get("custom_sounds_quota_bytes", 104857600)
+        self.custom_sounds_process = config.get("custom_sounds_process", True)
+        self.custom_sounds_max_seconds = config.get("custom_sounds_max_seconds", 10.0)
+        self.custom_sounds_sample_rate = config.get("custom_sounds_sample_rate", 22050)
+        self.custom_sounds_loudness_lufs = config.get("custom_sounds_loudness_lufs", -16.0)
         self.log_path = config["log_path"]
         self.access_granted_webhook = config["access_granted_webhook"]
         self.door_sensor_ha_api_url = config["door_sensor_ha_api_url"]
+        self.door_sensor_poll_seconds = config.get("door_sensor_poll_seconds", 0.5)
         self.home_assistant_token = config["home_assistant_token"]
+        self.stats_path = config.get("stats_path", "data/stats.json")
+        self.duplicate_read_window_seconds = config.get("duplicate_read_window_seconds", 2.0)
+        self.loop_stall_threshold_seconds = config.get("loop_stall_threshold_seconds", 0.5)
+        self.relock_failsafe_grace_seconds = config.get("relock_failsafe_grace_seconds", 1.0)
 
         # Cache the usergroup_id once its been looked up
         self.admin_usergroup_id = None
@@ -144,44 +184,92 @@ hat_gpio = DoorbotHatGpio(pigpio_pi)
 # Door "closed" sensor's last state to trigger webhook on change
 door_sensor_last_state = None
 
+# Relocks the door from its own thread if the relock timer is held up by a stalled loop
+relock_failsafe = DeadlineFailsafe(
+    name='relock_failsafe',
+    action=lambda: hat_gpio.set_relay(config.relay_channel, False),
+    grace_s=config.relock_failsafe_grace_seconds)
+
+# Logs what is blocking the event loop when it stalls
+loop_monitor = LoopMonitor(stall_threshold_s=config.loop_stall_threshold_seconds)
+
 # Create RFID reader class
-key_reader = KeyReader(pigpio_pi)
+key_reader = KeyReader(pigpio_pi, duplicate_window_s=config.duplicate_read_window_seconds)
 
 # Blinkstick - more LEDs! Startup Blue until its ready - White once ready
 blink = BlinkstickInterface()
 blink.set_colour_name('blue')
 
-# Timers
-timer_relock = MonotonicWaiter(name='door_relock')
-timer_blinkstick_white = MonotonicWaiter(name='blinkstick_white')
-timer_keys_update = MonotonicWaiter(name='keys_update')
+# Timers for relock, blinkstick reset, key refresh and polling. Added under Background Tasks.
+scheduler = TimerScheduler()
 
 # TidyAuth API Client
 tidyauth_client = TidyAuthClient(
     base_url=config.tidyauth_url, token=config.tidyauth_token)
 
-# User manager, using tidyauth API
-user_manager = UserManager(api_client=tidyauth_client,
-                           cache_path=config.tidyauth_cache_file)
+# Home assistant client for webhook and door sensor state
+home_assistant = HomeAssistantClient(token=config.home_assistant_token)
 
 # Sound player
 sound_player = SoundPlayer(sound_dir=config.sounds_dir,
                            custom_sound_dir=config.custom_sounds_dir)
 
+# Cleanup and disk quota for downloaded custom sounds
+sound_store = SoundStore(directory=config.custom_sounds_dir,
+                         quota_bytes=config.custom_sounds_quota_bytes,
+                         on_remove=lambda sound_hash, path: custom_sound_removed(sound_hash, path))
+
+# Trims, normalises and transcodes downloaded custom sounds so they're quick to play
+sound_ingest = SoundIngest(max_duration_s=config.custom_sounds_max_seconds,
+                           sample_rate=config.custom_sounds_sample_rate,
+                           loudness_lufs=config.custom_sounds_loudness_lufs) if config.custom_sounds_process else None
+
+# Held while downloading and processing custom sounds
+sound_download_lock = asyncio.Lock()
+
+# Keys whose sound failed to download, tried again after the next key refresh
+sound_retry_keys = set()
+
+# User manager, using tidyauth API
+user_manager = UserManager(api_client=tidyauth_client,
+                           cache_path=config.tidyauth_cache_file,
+                           sound_resolver=sound_player.find_sound_by_hash,
+                           max_sound_fetches=config.tidyauth_max_sound_fetches,
+                           journal_max_bytes=config.tidyauth_cache_journal_max_bytes,
+                           index_path=config.tidyauth_index_file,
+                           denied_ttl_s=config.tidyauth_denied_cache_seconds)
+
+# Rolling latency of key reads, per stage
+latency_stats = LatencyStats()
+
 # Load the slack bolt app framework
 app = AsyncApp(token=config.SLACK_BOT_TOKEN)
 
+# Outbox for door channel messages. Each entry is (message kwargs, call access granted webhook, read trace)
+door_message_outbox = asyncio.Queue()
+
+# Outbox for the access granted webhook. Each entry is the slack message timestamp.
+access_granted_webhook_outbox = asyncio.Queue()
+
+# Outbox for door sensor changes to send to home assistant. Each entry is the state string.
+door_sensor_outbox = asyncio.Queue()
+
 
 # ======= Door Lock/Unlock Methods =======
 
-def gpio_unlock(time_s: float):
+def gpio_unlock(time_s: float, trace=None):
     hat_gpio.set_relay(config.relay_channel, True)
-    timer_relock.set_wait_time(duration_s=time_s)
+    if trace is not None:
+        # Before the logging below, which isn't part of the relay latency
+        trace.stamp("relay")
+    scheduler.schedule('door_relock', time_s)
+    relock_failsafe.arm(time_s)
     general_logger.info(f"gpio_unlock - Unlock door for {time_s} s")
 
 
 def gpio_lock():
     hat_gpio.set_relay(config.relay_channel, False)
+    relock_failsafe.disarm()
     general_logger.info(f"gpio_lock - Locked door")
 
 
@@ -221,6 +309,17 @@ async def post_slack_door(message):
     )
 
 
+def queue_door_access(name, tag, status, level, call_webhook=False, trace=None):
+    """
+    Queue a door access message to be posted by door_message_worker so the caller
+    doesn't wait on slack. If call_webhook, the access granted webhook is called
+    with the message timestamp once it has been posted. The read's trace is
+    completed and recorded once posted.
+    """
+    message = slack_blocks.door_access(name=name, tag=tag, status=status, level=level)
+    door_message_outbox.put_nowait((message, call_webhook, trace))
+
+
 async def post_slack_log(message):
     await app.client.chat_postMessage(
         channel=config.channel_logs,
@@ -548,7 +647,7 @@ async def handle_liveliness_check(ack, body, logger, client):
 
         # Briefly show a dimmer white
         blink.set_colour_name('gray')
-        timer_blinkstick_white.set_wait_time(duration_s=1)
+        scheduler.schedule('blinkstick_white', 1)
 
         # Calculate uptime
         uptime_seconds = time.monotonic() - start_time
@@ -559,6 +658,7 @@ async def handle_liveliness_check(ack, body, logger, client):
         msg = f"Admin {get_user_at_id(body)} has requested liveliness check (uptime {int(days)}d {int(hours)}h)"
         logger.info(msg)
         await post_slack_door(msg)
+        await post_slack_log(latency_stats.format_summary())
 
         # Reset button with success message
         await reset_button_after_action(
@@ -585,7 +685,7 @@ async def handle_update_keys(ack, body, logger, client):
         logger.debug("app.action 'update_keys':" + str(body))
 
         # Queue key update
-        timer_keys_update.set_wait_time(duration_s=1)
+        scheduler.schedule('keys_update', 1)
 
         # Log and post about the key update
         msg = f"Admin {get_user_at_id(body)} has requested keys update"
@@ -609,91 +709,78 @@ async def handle_update_keys(ack, body, logger, client):
 
 
 async def read_tags():
-    """Main worker coroutine to poll the RFID reader and unlock the door"""
+    """Main worker coroutine to wait for RFID/NFC reads and unlock the door"""
 
     # Set blinkstick to WHITE as idle
     blink.set_white()
 
     general_logger.info("Ready to read tags")
 
-    loop_counter = 0
     while True:
         try:
-            if loop_counter % 36000 == 0:
-                # Hourly log of tag reading
-                general_logger.debug('Reading tags...')
-            loop_counter += 1
-
-            if len(key_reader.pending_keys) > 0:
-                tag = key_reader.pending_keys.pop(0)
+            # Sleeps until the reader callbacks queue a key or an error
+            event = await key_reader.next_read()
+            trace = event.trace
+            trace.stamp("queue")
 
-                # Pad with zeros to 10 digits like API expects
-                tag = f"{tag:0>10}"
+            if event.is_key():
+                # Precomputed record with everything needed to grant access, None if not authorised
+                record = user_manager.lookup(event.card_id)
+                trace.stamp("authorise")
 
-                if user_manager.is_key_authorised(tag):
+                if record is not None:
                     # Set blinkstick green until it relocks
                     blink.set_colour_name('green')
 
-                    # Access granted
-                    user = user_manager.get_user_details(tag)
-                    name = user['name']
-                    level = user['door']
-                    groups = user['groups']
-
-                    # Typically unlock for 5s
-                    unlock_time = 5.0
-                    if 'delayed' in groups:
-                        unlock_time = 30.0
-                    gpio_unlock(unlock_time)
+                    # Access granted. Typically unlock for 5s, longer for the delayed group.
+                    gpio_unlock(record.unlock_time_s, trace)
 
                     # Play the sound
-                    sound_player.play_access_granted_or_custom(user)
+                    sound_player.play_access_granted_for(record)
+                    trace.stamp("sound")
+                    if record.sound_hash is not None and sound_store.mark_used(record.sound_hash):
+                        # Evicted for the quota, download it again for next time
+                        start_download_sounds({record.key})
 
                     # Detailed log
                     general_logger.info(
-                        f"read_tags - Access granted: tag = '{tag}', user = {str(user)}")
+                        f"read_tags - Access granted: tag = '{record.key}', user = {record}")
 
-                    # Slack log
-                    response = await app.client.chat_postMessage(
-                        channel=config.channel,
-                        **slack_blocks.door_access(
-                            name=name, tag=tag, status=':white_check_mark: Door unlocked', level=level),
-                    )
-
-                    # Webhook call (for home assistant).
-                    # Slack message timestamp so HA can add the photos.
-                    data = {'ts': response['ts'], }
-                    response = requests.put(config.access_granted_webhook, data=json.dumps(
-                        data), headers={'Content-type': 'application/json'}, timeout=1)
+                    # Slack log and then webhook call (for home assistant), sent by the
+                    # outbox workers so the next tag isn't held up.
+                    queue_door_access(name=record.name, tag=record.key, status=':white_check_mark: Door unlocked',
+                                      level=record.door, call_webhook=True, trace=trace)
 
                 else:
                     # Access denied
 
+                    # Pad with zeros to 10 digits like API expects
+                    tag = f"{event.card_id:0>10}"
+
                     # Set blinkstick red for 5 seconds
                     blink.set_colour_name('red')
-                    timer_blinkstick_white.set_wait_time(duration_s=5)
+                    scheduler.schedule('blinkstick_white', 5)
 
-                    # Queue key update (in case this key has been recently added)
-                    timer_keys_update.set_wait_time(duration_s=1)
+                    # Refresh keys (in case this key has been recently added), unless this card
+                    # was already denied recently. Rate limited and joins any running download.
+                    if user_manager.note_denied(event.card_id):
+                        key_refresh.request()
 
                     sound_player.play_denied()
+                    trace.stamp("sound")
                     general_logger.info(
                         f"read_tags - Access denied: tag = '{tag}'")
-                    await app.client.chat_postMessage(
-                        channel=config.channel,
-                        **slack_blocks.door_access(
-                            name="Unknown", tag=tag, status=':x: Access denied', level="Unknown")
-                    )
+                    queue_door_access(name="Unknown", tag=tag, status=':x: Access denied', level="Unknown",
+                                      trace=trace)
 
-            if len(key_reader.pending_errors) > 0:
+            else:
 
                 # Set blinkstick off-red for 5 seconds
                 blink.set_colour_name('maroon')
-                timer_blinkstick_white.set_wait_time(duration_s=5)
+                scheduler.schedule('blinkstick_white', 5)
 
                 # Loggers only. Don't send to main door channel.
-                msg = key_reader.pending_errors.pop(0)
-                general_logger.info(f"read_tags - Bad read: {msg}")
+                general_logger.info(f"read_tags - Bad read: {event.error}")
 
         except Exception as e:
             general_logger.error(
@@ -705,161 +792,236 @@ async def read_tags():
             await asyncio.sleep(5)
             blink.set_colour_name('white')
 
-        await asyncio.sleep(0.1)
 
+def relock_door():
+    """Timer callback to relock the door after it was unlocked"""
+    gpio_lock()
 
-async def relock_door():
-    """Worker coroutine to relock the door after provided wait"""
-    while True:
-        try:
-            done = await timer_relock.wait()
-            if done:
-                # Lock the door
-                gpio_lock()
+    # Reset blinkstick to white
+    blink.set_white()
 
-                # Reset blinkstick to white
-                blink.set_white()
 
-        except Exception as e:
-            general_logger.error(
-                f"relock_door - An unexpected exception occurred: {e}")
-            gpio_lock()
-            await asyncio.sleep(5)
+async def update_keys():
+    """Timer callback to refresh keys from the API"""
+    general_logger.debug("update_keys - Update data from tidyauth")
+    changes = await user_manager.download_keys()
+    if changes.keys_changed:
+        general_logger.info(f"update_keys - Keys changed {changes.summary()} "
+                            f"(total number of keys = {user_manager.key_count()} )")
+
+        # Set blinkstick light blue for 1 seconds
+        blink.set_colour_name('aqua')
+        scheduler.schedule('blinkstick_white', 1)
+
+        await app.client.chat_postMessage(
+            channel=config.channel,
+            text=f"Key list has changed (TidyAuth): {changes.summary()}"
+        )
+    # Only the new or changed sounds, and those that failed last time. Not awaited, so a long
+    # sound round doesn't hold up key refreshes joining this one.
+    keys = changes.sounds | sound_retry_keys
+    if keys:
+        start_download_sounds(keys)
+
+
+def start_download_sounds(keys=None):
+    """Run download_sounds in its own task, logging any error"""
+    task = asyncio.ensure_future(download_sounds(keys))
+    task.add_done_callback(log_download_sounds_error)
+    return task
+
+
+def log_download_sounds_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        general_logger.error(f"download_sounds - An unexpected exception occurred: {task.exception()}")
+
+
+async def download_sounds(keys=None):
+    """
+    Download sounds helper, for all users with custom sounds or just those in keys. Then
+    removes sounds no longer used and keeps the rest within the quota.
+    """
+    # One round at a time, so two downloaders never write the same file. Startup and the
+    # first key update both download sounds at once.
+    async with sound_download_lock:
+        # Sounds evicted for the quota wait until they are played again
+        users = {key: user for key, user in user_manager.get_users_with_custom_sounds(keys).items()
+                 if sound_store.wanted(user["sound"])}
+        general_logger.debug(
+            f"download_sounds - Check if sounds need downloading for {len(users)} users")
+        sound_downloader = SoundDownloader(
+            users_with_custom_sounds=users,
+            download_directory=config.custom_sounds_dir,
+            on_download=custom_sound_downloaded,
+            max_concurrent=config.custom_sounds_max_downloads,
+            max_bytes=config.custom_sounds_max_bytes)
+
+        # Download the sound files, a few at a time
+        result = await sound_downloader.download_all()
+        if result["downloaded"] or result["failed"]:
+            general_logger.info(f"download_sounds - Downloaded {result['downloaded']} sounds "
+                                f"({result['failed']} failed, {result['resumed']} resumed)")
+
+        # Failed, rejected or cut off downloads are tried again (and resumed) next round
+        if keys is None:
+            sound_retry_keys.clear()
+        else:
+            sound_retry_keys.difference_update(keys)
+        sound_retry_keys.update(key for key, user in users.items()
+                                if user["sound"] in sound_downloader.failed_hashes)
 
-        await asyncio.sleep(0.1)
+        # Process new sounds (and any downloaded before processing was enabled) once each
+        if sound_ingest is not None:
+            sounds = {user["sound"]: sound_downloader.sound_path(user["sound"], user["sound_url"])
+                      for user in users.values() if "sound_url" in user}
+            await sound_ingest.process_all(sounds, on_processed=custom_sound_processed)
 
+        # Fill in the paths of newly downloaded sounds for granting access
+        user_manager.resolve_sounds()
 
-async def clear_blinkstick():
-    """Worker coroutine to change blinkstick back to white after a delay"""
-    while True:
-        try:
-            done = await timer_blinkstick_white.wait()
-            if done:
-                # Reset blinkstick to white
-                blink.set_white()
+        # Without keys (no cache and the download failed) every sound would look unused
+        if user_manager.key_count() == 0:
+            general_logger.warning("download_sounds - No keys loaded, not removing unused sounds")
+            return
+        sound_store.update_references(user_manager.get_users_with_custom_sounds())
+        sound_store.collect()
 
-        except Exception as e:
-            general_logger.error(
-                f"clear_blinkstick - An unexpected exception occurred: {e}")
-            await asyncio.sleep(5)
 
-        await asyncio.sleep(0.1)
+def custom_sound_downloaded(sound_hash, path):
+    sound_player.custom_sound_downloaded(sound_hash, path)
+    sound_store.mark_used(sound_hash)
 
 
-async def update_keys():
-    """Worker coroutine to refresh keys from the API"""
+def custom_sound_processed(sound_hash, path):
+    sound_player.custom_sound_downloaded(sound_hash, path)
+    # Switch records over straight away, rather than after the whole round is processed
+    user_manager.update_sound(sound_hash, path)
 
-    async def _update():
-        """Helper function to do the actual update and logging"""
-        general_logger.debug("update_keys - Update data from tidyauth")
-        changed = await user_manager.download_keys()
-        if changed:
-            general_logger.info(f"update_keys - Keys changed (total number of keys = {user_manager.key_count()} )")
 
-            # Set blinkstick light blue for 1 seconds
-            blink.set_colour_name('aqua')
-            timer_blinkstick_white.set_wait_time(duration_s=1)
+def custom_sound_removed(sound_hash, path):
+    sound_player.custom_sound_removed(sound_hash, path)
+    user_manager.forget_sound(sound_hash)
 
-            await app.client.chat_postMessage(
+
+async def door_message_worker():
+    """Worker coroutine to post queued door access messages to slack"""
+    while True:
+        message, call_webhook, trace = await door_message_outbox.get()
+        try:
+            response = await app.client.chat_postMessage(
                 channel=config.channel,
-                text="Key list has changed (TidyAuth)"
+                **message,
             )
-            await download_sounds()
 
-    # Initial update
-    try:
-        timer_keys_update.set_wait_time(
-            config.tidyauth_update_interval_seconds)
-        await _update()
-    except Exception as e:
-        general_logger.error(
-            f"update_keys - An unexpected exception occurred during initial update: {e}")
+            if trace is not None:
+                trace.stamp("slack")
 
-    while True:
-        try:
-            done = await timer_keys_update.wait()
-            if done:
-                # Do the update and then set the configured interval to wait again for next time.
-                # May be brought earlier if there is an invalid key read.
-                await _update()
-                timer_keys_update.set_wait_time(
-                    config.tidyauth_update_interval_seconds)
+            if call_webhook:
+                # Slack message timestamp so HA can add the photos.
+                access_granted_webhook_outbox.put_nowait(response['ts'])
 
         except Exception as e:
             general_logger.error(
-                f"update_keys - An unexpected exception occurred: {e}")
-            await asyncio.sleep(5)
+                f"door_message_worker - An unexpected exception occurred: {e}")
 
-        await asyncio.sleep(0.1)
+        finally:
+            if trace is not None:
+                latency_stats.add_trace(trace)
 
 
-async def download_sounds():
-    """Download sounds helper"""
-    users = user_manager.get_users_with_custom_sounds()
-    general_logger.debug(
-        f"download_sounds - Check if sounds need downloading for {len(users)} users")
-    sound_downloader = SoundDownloader(
-        users_with_custom_sounds=users,
-        download_directory=config.custom_sounds_dir)
+async def access_granted_webhook_worker():
+    """Worker coroutine to call the access granted webhook (for home assistant)"""
+    while True:
+        ts = await access_granted_webhook_outbox.get()
+        try:
+            data = {'ts': ts, }
+            await home_assistant.call_webhook(config.access_granted_webhook, data, timeout_s=1)
 
-    # Download the sound files
-    while sound_downloader.download_next_sound():
-        # Allow other things to run between sound file downloads
-        await asyncio.sleep(0.5)
+        except Exception as e:
+            general_logger.error(
+                f"access_granted_webhook_worker - An unexpected exception occurred: {e}")
 
 
-async def slack_logs_worker():
-    """Worker coroutine post logs to slack when required"""
-    global global_slack_log_queue
+async def slack_log_worker():
+    """Worker coroutine to post queued logs to slack"""
+    global slack_log_loop
+    slack_log_loop = asyncio.get_running_loop()
     while True:
+        message = await global_slack_log_queue.get()
         try:
-            if len(global_slack_log_queue) > 0:
-                await post_slack_log(global_slack_log_queue.pop())
+            await post_slack_log(message)
         except Exception as e:
-            general_logger.error(
-                f"slack_logs_worker - An unexpected exception occurred: {e}")
-            await asyncio.sleep(5)
-        await asyncio.sleep(0.1)
+            # Only logged at debug, an error would be queued for slack again
+            general_logger.debug(f"slack_log_worker - Failed to post log: {e}")
+            await asyncio.sleep(SLACK_LOG_ERROR_BACKOFF_S)
 
 
-async def input_reader():
-    """Worker coroutine to read inputs - for door open switch"""
+def read_door_sensor():
+    """Timer callback to read inputs - for door open switch. Changes are sent by door_sensor_worker."""
     global door_sensor_last_state
+    status = hat_gpio.read_switches()
+    door_state = status[config.door_sensor_channel]
+    if door_sensor_last_state is None or door_state != door_sensor_last_state:
+        door_sensor_last_state = door_state
+        door_status_string = {False: 'on', True: 'off'}[door_state]
+        general_logger.info(f"Door closed sensor: {door_status_string}")
+        door_sensor_outbox.put_nowait(door_status_string)
+
+
+async def door_sensor_worker():
+    """Worker coroutine to send door sensor changes to home assistant, in order"""
     while True:
-        try:
-            status = hat_gpio.read_switches()
-            door_state = status[config.door_sensor_channel]
-            if door_sensor_last_state is None or door_state != door_sensor_last_state:
-                door_sensor_last_state = door_state
-                door_status_string = {False: 'on', True: 'off'}[door_state]
-                general_logger.info(f"Door closed sensor: {door_status_string}")
-
-                # Define payload and headers
-                payload = {
-                    "state": door_status_string,
-                    "attributes": {
-                        "device_class": "door"
-                    }
-                }
-                headers = {
-                    "Authorization": f"Bearer {config.home_assistant_token}",
-                    "Content-Type": "application/json"
-                }
+        door_status_string = await door_sensor_outbox.get()
+        # Will update/create home assistant entity. Errors are logged by the client.
+        result = await home_assistant.set_state(
+            config.door_sensor_ha_api_url, state=door_status_string,
+            attributes={"device_class": "door"}, timeout_s=1)
+        if result is not None:
+            general_logger.debug(f"Success: {result}")
 
-                # Sending the POST request - will update/create home assistant entity
-                response = requests.post(config.door_sensor_ha_api_url, json=payload, headers=headers, timeout=0.1)
 
-                # Check the response
-                if response.status_code in (200, 201):
-                    general_logger.debug(f"Success: {response.json()}")
-                else:
-                    general_logger.error(f"HTTP Error {response.status_code}: {response.text}")
+# Key downloads, one at a time. Denied reads ask for one with key_refresh.request(), which is rate limited.
+key_refresh = KeyRefresh(update_keys,
+                         burst=config.tidyauth_denied_refresh_burst,
+                         refill_s=config.tidyauth_denied_refresh_refill_seconds,
+                         min_interval_s=config.tidyauth_denied_refresh_min_interval_seconds)
+
+# Timer callbacks above are dispatched by scheduler.run(). The one-shot timers are started by
+# scheduler.schedule(), the periodic ones run from startup.
+scheduler.add('door_relock', relock_door)
+scheduler.add('blinkstick_white', blink.set_white)
+scheduler.add('keys_update', key_refresh.run, interval_s=config.tidyauth_update_interval_seconds, delay_s=0)
+# The door sensor is the only polling left. It is a plain function (no task per poll), and
+# the door state only goes to home assistant, so a couple of reads a second is plenty.
+scheduler.add('door_sensor', read_door_sensor, interval_s=config.door_sensor_poll_seconds, delay_s=0)
+
+
+# ======= Stats =======
+
+
+def dump_stats():
+    """Write current stats to the stats file as json. Triggered by SIGUSR1."""
+    try:
+        stats = {
+            "uptime_s": time.monotonic() - start_time,
+            "latency": latency_stats.summary(),
+            "key_reader": key_reader.stats(),
+            "sound": sound_player.stats(),
+            "timers": scheduler.stats(),
+            "loop": loop_monitor.stats(),
+            "tidyauth": tidyauth_client.stats(),
+            "users": user_manager.stats(),
+            "sound_store": sound_store.stats(),
+            "sound_ingest": sound_ingest.stats() if sound_ingest is not None else None,
+            "key_refresh": key_refresh.stats(),
+            "relock_failsafe_triggered": relock_failsafe.triggered,
+        }
+        with open(config.stats_path, "w") as f:
+            json.dump(stats, f, indent=4)
+        general_logger.debug(f"dump_stats - Wrote stats to {config.stats_path}")
+    except Exception as e:
+        general_logger.error(f"dump_stats - An unexpected exception occurred: {e}")
 
-        except Exception as e:
-            general_logger.error(
-                f"input_reader - An unexpected exception occurred: {e}")
-            await asyncio.sleep(5)
-        await asyncio.sleep(0.1)
 
 # ======= Main =======
 
@@ -872,15 +1034,25 @@ async def run():
         text=msg_start,
     )
 
+    # kill -USR1 <pid> to dump stats to file
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, dump_stats)
+
+    loop_monitor.start(asyncio.get_running_loop())
+    relock_failsafe.start()
+
     asyncio.ensure_future(read_tags())
-    asyncio.ensure_future(relock_door())
-    asyncio.ensure_future(clear_blinkstick())
-    asyncio.ensure_future(update_keys())
-    asyncio.ensure_future(download_sounds())
-    asyncio.ensure_future(slack_logs_worker())
-    asyncio.ensure_future(input_reader())
+    asyncio.ensure_future(scheduler.run())
+    start_download_sounds()
+    asyncio.ensure_future(door_message_worker())
+    asyncio.ensure_future(access_granted_webhook_worker())
+    asyncio.ensure_future(slack_log_worker())
+    asyncio.ensure_future(door_sensor_worker())
     handler = AsyncSocketModeHandler(app, config.SLACK_APP_TOKEN)
-    await handler.start_async()
+    try:
+        await handler.start_async()
+    finally:
+        await home_assistant.close()
+        await tidyauth_client.close()
 
 
 def main():
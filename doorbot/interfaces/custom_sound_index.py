@@ -0,0 +1,100 @@
+"""
+Index of downloaded custom sounds by sound hash.
+
+Custom sounds are stored as {file_name}_{sound_hash}.mp3 (see sound_downloader), and the
+processed variant made by SoundIngest beside it as .wav. The index prefers the processed
+variant when there is one. It is built with one directory scan and then kept up to date
+by add()/remove() as sounds are downloaded or deleted. Changes made by anything else are
+picked up by checking the directory's modification time, which is a single stat rather
+than a scan.
+"""
+
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+SOUND_EXTENSION = ".mp3"
+PROCESSED_EXTENSION = ".wav"
+
+# Suffix of a sound that is still being downloaded
+PART_SUFFIX = ".part"
+
+
+def sound_file_name(file_name, sound_hash):
+    """File name a custom sound is stored as"""
+    return f"{file_name}_{sound_hash}{SOUND_EXTENSION}"
+
+
+def processed_path(path):
+    """Path of the processed variant of a downloaded sound"""
+    return os.path.splitext(path)[0] + PROCESSED_EXTENSION
+
+
+def sound_hash_from_file_name(file_name):
+    """Return the sound hash from a stored custom sound file name, or None if it isn't one"""
+    stem, extension = os.path.splitext(file_name)
+    if extension not in (SOUND_EXTENSION, PROCESSED_EXTENSION) or "_" not in stem:
+        return None
+    return stem.rsplit("_", 1)[1]
+
+
+class CustomSoundIndex:
+    def __init__(self, directory):
+        self.directory = directory
+
+        # Sound hash to file path
+        self._paths = {}
+
+        # Directory mtime when last scanned or updated, None if it didn't exist
+        self._mtime_ns = None
+
+        # Number of full directory scans, for stats
+        self.scans = 0
+
+        self.rescan()
+
+    def find(self, sound_hash):
+        """Return the path of the downloaded sound with the given hash, or None"""
+        self._rescan_if_changed()
+        return self._paths.get(sound_hash)
+
+    def add(self, sound_hash, path):
+        """Record a newly written sound file"""
+        self._paths[sound_hash] = path
+        self._mtime_ns = self._directory_mtime_ns()
+
+    def remove(self, sound_hash):
+        """Forget a sound file that has been deleted"""
+        self._paths.pop(sound_hash, None)
+        self._mtime_ns = self._directory_mtime_ns()
+
+    def hashes(self):
+        self._rescan_if_changed()
+        return set(self._paths)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def rescan(self):
+        """Rebuild the index from the directory contents"""
+        paths = {}
+        self._mtime_ns = self._directory_mtime_ns()
+        if self._mtime_ns is not None:
+            for file_name in os.listdir(self.directory):
+                sound_hash = sound_hash_from_file_name(file_name)
+                if sound_hash is not None and not paths.get(sound_hash, "").endswith(PROCESSED_EXTENSION):
+                    paths[sound_hash] = os.path.join(self.directory, file_name)
+        self._paths = paths
+        self.scans += 1
+        logger.debug(f"Indexed {len(paths)} custom sounds in '{self.directory}'")
+
+    def _rescan_if_changed(self):
+        if self._directory_mtime_ns() != self._mtime_ns:
+            self.rescan()
+
+    def _directory_mtime_ns(self):
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,73 @@
+"""
+Send webhook calls and entity states to home assistant.
+
+Calls share a PooledSession, so connections to home assistant are reused. Each call has
+its own timeout and the number of calls in flight at once is bounded.
+"""
+import asyncio
+import logging
+import aiohttp
+from aiohttp import ClientResponseError, ClientConnectionError
+from asyncio.exceptions import TimeoutError
+
+from doorbot.interfaces.pooled_session import PooledSession
+
+logger = logging.getLogger(__name__)
+
+
+class HomeAssistantClient:
+    def __init__(self, token, max_concurrent=4, keepalive_timeout_s=60.0):
+        """
+        token is the home assistant long lived access token, used for the REST API.
+        max_concurrent limits both open connections and calls in flight.
+        """
+        self.token = token
+        self.max_concurrent = max_concurrent
+        self._pool = PooledSession(max_connections=max_concurrent, keepalive_timeout_s=keepalive_timeout_s)
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def close(self):
+        await self._pool.close()
+
+    async def _request(self, name, method, url, timeout_s, **kwargs):
+        """Make a request, returns the response json (or True if there is none) or None on failure"""
+        session = self._pool.session
+        try:
+            async with self._semaphore:
+                timeout = aiohttp.ClientTimeout(total=timeout_s)
+                async with session.request(method, url, timeout=timeout, **kwargs) as response:
+                    response.raise_for_status()
+                    if response.content_type == "application/json":
+                        return await response.json()
+                    await response.read()
+                    return True
+        except ClientResponseError as e:
+            logger.error(f"{name} - ClientResponseError: {e}")
+        except ValueError as e:
+            logger.error(f"{name} - JSONDecodeError: {e}")
+        except ClientConnectionError as e:
+            logger.error(f"{name} - ClientConnectionError: Could not connect to server: {e}")
+        except TimeoutError as e:
+            logger.error(f"{name} - TimeoutError: {e}")
+        except Exception as e:
+            logger.error(f"{name} - Unexpected error: {e}")
+        return None
+
+    async def call_webhook(self, url, data, timeout_s=1.0):
+        """PUT json data to a home assistant webhook. Returns True if successful."""
+        result = await self._request("call_webhook", "PUT", url, timeout_s, json=data)
+        return result is not None
+
+    async def set_state(self, url, state, attributes=None, timeout_s=1.0):
+        """
+        POST an entity state to the home assistant REST API, creating or updating the entity.
+        Returns the new state json from home assistant or None on failure.
+        """
+        payload = {
+            "state": state,
+            "attributes": attributes or {},
+        }
+        headers = {
+            "Authorization": f"Bearer {self.token}",
+        }
+        return await self._request("set_state", "POST", url, timeout_s, json=payload, headers=headers)
@@ -0,0 +1,248 @@
+"""
+On-disk cache of the door key list, so the door works if tidyauth can't be reached at startup.
+
+The cache is a small header followed by the keys as minified json compressed with zlib:
+
+    magic (4 bytes) | crc32 of payload (uint32) | payload length (uint32) | payload
+
+Saving writes to a temporary file in the same directory, fsyncs it and renames it over the
+old cache, so a power cut mid-save leaves either the old or the new cache, never a partial
+one. The checksum catches any other corruption (eg. from the SD card) on load.
+
+Changes after that snapshot are appended to a journal next to it (cache_file + ".journal")
+rather than rewriting the whole cache, so saving costs in proportion to the change and the
+SD card sees far fewer writes. Each journal record holds the users upserted and the keys
+deleted by one change, framed with its own crc32 and length. On load the journal is replayed
+over the snapshot; a record torn by a power cut is dropped. Once the journal grows past
+journal_max_bytes it is compacted into a new snapshot.
+
+Caches saved as plain json by older versions are still loaded. Use export_json (or run this
+module) to get readable json back out.
+"""
+
+import os
+import sys
+import json
+import zlib
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"DKC1"
+HEADER = struct.Struct("<4sII")
+
+# crc32 and length before each journal record
+RECORD_HEADER = struct.Struct("<II")
+
+# Journal size at which it is compacted into a new snapshot
+DEFAULT_JOURNAL_MAX_BYTES = 64 * 1024
+
+# zlib level 1 is several times faster to save than the default, and only slightly larger
+COMPRESS_LEVEL = 1
+
+
+class CacheCorruptError(Exception):
+    """The cache file is truncated or doesn't match its checksum"""
+
+
+def encode(user_data):
+    """Return the cache file contents for user_data"""
+    payload = zlib.compress(json.dumps(user_data, separators=(",", ":")).encode(), COMPRESS_LEVEL)
+    return HEADER.pack(MAGIC, zlib.crc32(payload), len(payload)) + payload
+
+
+def decode(data):
+    """Return user_data from cache file contents. Raises CacheCorruptError if they are damaged."""
+    if not data.startswith(MAGIC):
+        # Plain json from before the cache had a header
+        return json.loads(data)
+
+    if len(data) < HEADER.size:
+        raise CacheCorruptError("Truncated header")
+    _, crc, length = HEADER.unpack_from(data)
+    payload = data[HEADER.size:]
+    if len(payload) != length:
+        raise CacheCorruptError(f"Payload is {len(payload)} bytes, expected {length}")
+    if zlib.crc32(payload) != crc:
+        raise CacheCorruptError("Checksum mismatch")
+    return json.loads(zlib.decompress(payload))
+
+
+def write_atomic(path, data):
+    """Replace the file at path with data, so it is either the old or new contents after a power cut"""
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    # Make the rename itself durable
+    _fsync_directory(path)
+
+
+def _fsync_directory(path):
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def load(path):
+    """Return the user_data in the snapshot at path, or None if there isn't one or it is corrupt"""
+    if not os.path.exists(path):
+        logger.warning(f"No keys file found at {path}")
+        return None
+    try:
+        with open(path, "rb") as file:
+            user_data = decode(file.read())
+    except (CacheCorruptError, ValueError, zlib.error) as e:
+        logger.error(f"Keys file {path} is corrupt, ignoring it: {e}")
+        return None
+    logger.debug(f"Loaded keys from {path}")
+    return user_data
+
+
+def save(path, user_data):
+    """Write a snapshot of user_data to path"""
+    write_atomic(path, encode(user_data))
+    logger.debug(f"Saved keys to {path}")
+
+
+def encode_record(upserts, deletes):
+    """Return a journal record upserting the users in dict upserts and deleting the keys in deletes"""
+    payload = json.dumps({"upsert": upserts, "delete": list(deletes)}, separators=(",", ":")).encode()
+    return RECORD_HEADER.pack(zlib.crc32(payload), len(payload)) + payload
+
+
+def replay(user_data, data):
+    """
+    Apply the journal records in data to user_data.
+    Returns (records applied, bytes of data that were valid records).
+    """
+    offset = 0
+    records = 0
+    while offset < len(data):
+        if len(data) - offset < RECORD_HEADER.size:
+            break
+        crc, length = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            break
+        record = json.loads(payload)
+        user_data.update(record["upsert"])
+        for key in record["delete"]:
+            user_data.pop(key, None)
+        offset = start + length
+        records += 1
+    return records, offset
+
+
+class KeyCache:
+    def __init__(self, path, journal_max_bytes=DEFAULT_JOURNAL_MAX_BYTES):
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self.journal_max_bytes = journal_max_bytes
+
+        self.journal_bytes = 0
+
+        # Writes made, for stats
+        self.snapshots = 0
+        self.appends = 0
+        self.bytes_written = 0
+
+    def load(self):
+        """Return the cached user_data with the journal replayed, or None if there is no usable snapshot"""
+        user_data = load(self.path)
+        if not os.path.exists(self.journal_path):
+            self.journal_bytes = 0
+            return user_data
+
+        with open(self.journal_path, "rb") as file:
+            data = file.read()
+        if user_data is None:
+            logger.error(f"Ignoring key journal {self.journal_path} without a snapshot")
+            return None
+
+        records, valid_bytes = replay(user_data, data)
+        if valid_bytes < len(data):
+            # Torn write from a power cut, drop it so later records aren't appended after it
+            logger.warning(f"Dropping {len(data) - valid_bytes} bytes of incomplete records from {self.journal_path}")
+            with open(self.journal_path, "r+b") as file:
+                file.truncate(valid_bytes)
+                os.fsync(file.fileno())
+        self.journal_bytes = valid_bytes
+        logger.debug(f"Replayed {records} key changes from {self.journal_path}")
+        return user_data
+
+    def save(self, user_data):
+        """Write a new snapshot of user_data and clear the journal"""
+        data = encode(user_data)
+        write_atomic(self.path, data)
+        # The snapshot includes everything in the journal, so it's safe if this is lost to a power cut
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+            _fsync_directory(self.journal_path)
+        self.journal_bytes = 0
+        self.snapshots += 1
+        self.bytes_written += len(data)
+        logger.debug(f"Saved keys to {self.path}")
+
+    def append(self, user_data, upserted, deleted):
+        """
+        Record that the keys in upserted were added or changed and the keys in deleted were
+        removed, to give user_data. Writes a snapshot instead if there isn't one yet or the
+        journal is due for compaction.
+        """
+        if not upserted and not deleted:
+            return
+        if not os.path.exists(self.path) or self.journal_bytes >= self.journal_max_bytes:
+            self.save(user_data)
+            return
+
+        record = encode_record({key: user_data[key] for key in upserted}, deleted)
+        with open(self.journal_path, "ab") as file:
+            file.write(record)
+            file.flush()
+            os.fsync(file.fileno())
+        if self.journal_bytes == 0:
+            _fsync_directory(self.journal_path)
+        self.journal_bytes += len(record)
+        self.appends += 1
+        self.bytes_written += len(record)
+        logger.debug(f"Journalled {len(upserted)} changed and {len(deleted)} removed keys")
+
+    def modified_ns(self):
+        """Time the cache (snapshot or journal) was last written, or None if there isn't one"""
+        times = [os.stat(path).st_mtime_ns for path in (self.path, self.journal_path) if os.path.exists(path)]
+        return max(times) if times else None
+
+    def stats(self):
+        return {
+            "snapshots": self.snapshots,
+            "journal_appends": self.appends,
+            "journal_bytes": self.journal_bytes,
+            "bytes_written": self.bytes_written,
+        }
+
+
+def export_json(path, json_path):
+    """Write the keys in the cache at path (with its journal replayed) to json_path as indented json"""
+    user_data = KeyCache(path).load()
+    with open(json_path, "w") as file:
+        json.dump(user_data, file, indent=4)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python -m doorbot.interfaces.key_cache <cache_file> <output.json>")
+        sys.exit(1)
+    export_json(sys.argv[1], sys.argv[2])
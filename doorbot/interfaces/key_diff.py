@@ -0,0 +1,55 @@
+"""
+Differences between two downloads of the door key list.
+
+Keys are compared on the fields that change who can get in and what happens when they do
+(name, door level, groups and sound hash). Other fields, such as the looked up sound url,
+are ignored.
+"""
+
+# User fields compared to decide if a key has been modified
+COMPARED_FIELDS = ("name", "door", "groups", "sound")
+
+
+class KeyChanges:
+    def __init__(self, added=None, removed=None, modified=None):
+        """Lists of the 10 digit keys added, removed and modified"""
+        self.added = added if added is not None else []
+        self.removed = removed if removed is not None else []
+        self.modified = modified if modified is not None else []
+
+        # Keys with a new or changed sound url, whose sound needs downloading
+        self.sounds = set()
+
+    @property
+    def keys_changed(self):
+        return bool(self.added or self.removed or self.modified)
+
+    def __bool__(self):
+        return self.keys_changed or bool(self.sounds)
+
+    def summary(self):
+        """Short summary of the counts like "+3 / −1 / ~2" """
+        return f"+{len(self.added)} / −{len(self.removed)} / ~{len(self.modified)}"
+
+    def __repr__(self):
+        return (f"KeyChanges(added={self.added!r}, removed={self.removed!r}, modified={self.modified!r}, "
+                f"sounds={sorted(self.sounds)!r})")
+
+
+def _compared(user):
+    return tuple(user.get(field) for field in COMPARED_FIELDS)
+
+
+def diff_keys(old_keys, new_keys):
+    """Return KeyChanges from old_keys to new_keys (either may be None)"""
+    old_keys = old_keys or {}
+    new_keys = new_keys or {}
+    changes = KeyChanges()
+    for key, user in new_keys.items():
+        old_user = old_keys.get(key)
+        if old_user is None:
+            changes.added.append(key)
+        elif _compared(old_user) != _compared(user):
+            changes.modified.append(key)
+    changes.removed = [key for key in old_keys if key not in new_keys]
+    return changes
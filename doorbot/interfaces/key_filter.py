@@ -0,0 +1,91 @@
+"""
+Fast paths for cards that aren't authorised.
+
+BloomFilter answers "definitely not a key" without touching the key index. It is rebuilt
+whenever the index is, and can give false positives (which then go on to the index) but
+never false negatives.
+
+RecentlyDenied remembers cards denied in the last ttl_s seconds, so a card presented over
+and over (an expired member, a random card, kids testing the reader) only asks for the key
+list to be refreshed once per ttl_s. A key added for that card is still picked up by the
+first read after ttl_s, or the next regular key update, whichever comes first.
+"""
+
+import math
+import time
+
+# Bits in the filter per key, about a 1% false positive rate with the best number of hashes
+BITS_PER_KEY = 10
+
+_MASK_64 = (1 << 64) - 1
+
+
+def _mix(value):
+    """splitmix64 finaliser, spreads card ids that are close together across the filter"""
+    value = (value + 0x9E3779B97F4A7C15) & _MASK_64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK_64
+    return value ^ (value >> 31)
+
+
+class BloomFilter:
+    def __init__(self, card_ids, bits_per_key=BITS_PER_KEY):
+        card_ids = list(card_ids)
+        self.size = max(64, len(card_ids) * bits_per_key)
+        self.hashes = max(1, round(self.size / max(1, len(card_ids)) * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        for card_id in card_ids:
+            for bit in self._bits(card_id):
+                self.bits[bit >> 3] |= 1 << (bit & 7)
+
+    def _bits(self, card_id):
+        # Double hashing: the i'th bit is h1 + i * h2
+        mixed = _mix(card_id)
+        h1 = mixed & 0xFFFFFFFF
+        h2 = (mixed >> 32) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, card_id):
+        """False if card_id is definitely not in the filter"""
+        for bit in self._bits(card_id):
+            if not self.bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+
+class RecentlyDenied:
+    def __init__(self, ttl_s, max_cards=256):
+        self.ttl_s = ttl_s
+        self.max_cards = max_cards
+
+        # Card id to monotonic time it was first denied in this ttl
+        self._denied = {}
+
+    def add(self, card_id, now=None):
+        """
+        Record a denied read of card_id. Returns True if it wasn't already denied in the last
+        ttl_s, ie. it's worth refreshing the keys in case it has been added.
+        """
+        now = time.monotonic() if now is None else now
+        denied_at = self._denied.get(card_id)
+        if denied_at is not None and now - denied_at < self.ttl_s:
+            return False
+
+        if len(self._denied) >= self.max_cards:
+            self.expire(now)
+            if len(self._denied) >= self.max_cards:
+                # Still full of recent cards, forget the oldest
+                del self._denied[min(self._denied, key=self._denied.get)]
+        self._denied[card_id] = now
+        return True
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._denied = {card_id: denied_at for card_id, denied_at in self._denied.items()
+                        if now - denied_at < self.ttl_s}
+
+    def discard(self, card_id):
+        self._denied.pop(card_id, None)
+
+    def __len__(self):
+        return len(self._denied)
@@ -0,0 +1,132 @@
+"""
+Read-only, memory-mapped index of authorised card ids for low RAM Pis.
+
+The index file holds the card ids sorted in fixed width records, followed by each user's
+details as minified json:
+
+    magic (4 bytes) | count (uint32)
+    count x [card id (uint64) | details offset (uint32) | details length (uint32)]
+    details json ...
+
+It is mmap'd, so it is only paged in by the OS as it is read instead of being held as
+Python dicts. Looking up a card is a binary search of the records; only when it is found
+are that user's details parsed into an AccessRecord. Denied cards never touch the details.
+
+Files are replaced atomically (see key_cache.write_atomic), and the index is re-mapped
+after each write.
+"""
+
+import json
+import mmap
+import struct
+import logging
+
+from doorbot.interfaces.key_cache import write_atomic
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"DKI1"
+HEADER = struct.Struct("<4sI")
+RECORD = struct.Struct("<QII")
+
+
+def encode(users_by_card_id):
+    """Return index file contents for a dict of card id to (key, user)"""
+    card_ids = sorted(users_by_card_id)
+    details_start = HEADER.size + RECORD.size * len(card_ids)
+
+    records = bytearray(HEADER.pack(MAGIC, len(card_ids)))
+    details = bytearray()
+    for card_id in card_ids:
+        key, user = users_by_card_id[card_id]
+        data = json.dumps([key, user], separators=(",", ":")).encode()
+        records += RECORD.pack(card_id, details_start + len(details), len(data))
+        details += data
+    return bytes(records + details)
+
+
+class MappedKeyIndex:
+    def __init__(self, path, make_record):
+        """
+        make_record is a function taking (key, user details) and returning the record to
+        give for a lookup, eg. AccessRecord.from_user.
+        """
+        self.path = path
+        self.make_record = make_record
+
+        self._file = None
+        self._map = None
+        self._count = 0
+
+    def write(self, users_by_card_id):
+        """Replace the index with a dict of card id to (key, user) and map it"""
+        write_atomic(self.path, encode(users_by_card_id))
+        self.open()
+        logger.debug(f"Wrote index of {self._count} keys to {self.path}")
+
+    def open(self):
+        self.close()
+        self._file = open(self.path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{self.path} is not a key index")
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+        self._map = None
+        self._file = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, card_id):
+        return self._find(card_id) is not None
+
+    def _find(self, card_id):
+        """Return the (offset, length) of card_id's details, or None if it isn't in the index"""
+        low = 0
+        high = self._count
+        while low < high:
+            middle = (low + high) // 2
+            record_card_id, offset, length = RECORD.unpack_from(self._map, HEADER.size + RECORD.size * middle)
+            if record_card_id < card_id:
+                low = middle + 1
+            elif record_card_id > card_id:
+                high = middle
+            else:
+                return offset, length
+        return None
+
+    def _details(self, offset, length):
+        key, user = json.loads(self._map[offset:offset + length])
+        return key, user
+
+    def get(self, card_id):
+        """Return the record for card_id, or None if it isn't in the index"""
+        found = self._find(card_id)
+        if found is None:
+            return None
+        return self.make_record(*self._details(*found))
+
+    def get_details(self, card_id):
+        """Return the (key, user details) for card_id, or None if it isn't in the index"""
+        found = self._find(card_id)
+        if found is None:
+            return None
+        return self._details(*found)
+
+    def card_ids(self):
+        """Iterate over the card ids in the index, without reading any details"""
+        for i in range(self._count):
+            yield RECORD.unpack_from(self._map, HEADER.size + RECORD.size * i)[0]
+
+    def items(self):
+        """Iterate over (key, user details) for every card in the index"""
+        for i in range(self._count):
+            _, offset, length = RECORD.unpack_from(self._map, HEADER.size + RECORD.size * i)
+            yield self._details(offset, length)
@@ -0,0 +1,136 @@
+"""
+Single-flight, rate limited key refreshes.
+
+Key downloads come from the periodic timer, the admin button and denied reads (in case the
+card was just added). Only one download runs at a time: anything asking for one while it
+is running joins it rather than queueing another.
+
+Requests from denied reads are also rate limited, so a burst of bad reads can't cause a
+burst of downloads. They take a token from a bucket (burst tokens, refilled one every
+refill_s) and must be at least min_interval_s after the last download started. A request
+that can't run yet is deferred until it can, and later requests coalesce into that one
+deferred download. Any download starting in the meantime satisfies it.
+
+The outcome of each request is counted for stats:
+    started - a download was started for it
+    joined - a download was already running
+    deferred - a download was scheduled for when the limits allow
+    coalesced - a deferred download was already scheduled
+"""
+
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BURST = 3
+DEFAULT_REFILL_S = 60.0
+DEFAULT_MIN_INTERVAL_S = 10.0
+
+OUTCOMES = ("started", "joined", "deferred", "coalesced")
+
+
+class KeyRefresh:
+    def __init__(self, refresh, burst=DEFAULT_BURST, refill_s=DEFAULT_REFILL_S,
+                 min_interval_s=DEFAULT_MIN_INTERVAL_S):
+        """refresh is the coroutine function that downloads the keys"""
+        self.refresh = refresh
+        self.burst = burst
+        self.refill_s = refill_s
+        self.min_interval_s = min_interval_s
+
+        self.tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._last_start = None
+
+        # Running download, and the loop handle for a deferred one
+        self._task = None
+        self._deferred = None
+
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self.downloads = 0
+
+    def in_flight(self):
+        return self._task is not None and not self._task.done()
+
+    async def run(self):
+        """Download the keys now, or wait for the download already running. Not rate limited."""
+        if not self.in_flight():
+            # Errors are raised here for the caller to handle
+            self._start(log_errors=False)
+        # Shielded so a cancelled caller doesn't cancel a download others are waiting for
+        await asyncio.shield(self._task)
+
+    def request(self):
+        """Ask for a rate limited download without waiting for it. Returns the outcome."""
+        if self.in_flight():
+            outcome = "joined"
+        elif self._deferred is not None:
+            outcome = "coalesced"
+        else:
+            delay_s = self._delay()
+            if delay_s <= 0:
+                self._take_token()
+                self._start()
+                outcome = "started"
+            else:
+                self._deferred = asyncio.get_running_loop().call_later(delay_s, self._run_deferred)
+                outcome = "deferred"
+                logger.debug(f"Key refresh deferred {delay_s:.1f} s")
+        self.outcomes[outcome] += 1
+        return outcome
+
+    def stats(self):
+        return {
+            "downloads": self.downloads,
+            "tokens": round(self._refill(), 2),
+            "in_flight": self.in_flight(),
+            "pending": self._deferred is not None,
+            **self.outcomes,
+        }
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(float(self.burst), self.tokens + (now - self._refilled_at) / self.refill_s)
+        self._refilled_at = now
+        return self.tokens
+
+    def _delay(self):
+        """Seconds until a rate limited download is allowed"""
+        token_wait_s = max(0.0, (1.0 - self._refill()) * self.refill_s)
+        interval_wait_s = 0.0
+        if self._last_start is not None:
+            interval_wait_s = self._last_start + self.min_interval_s - time.monotonic()
+        return max(token_wait_s, interval_wait_s)
+
+    def _take_token(self):
+        self._refill()
+        self.tokens -= 1.0
+
+    def _run_deferred(self):
+        self._deferred = None
+        if self.in_flight():
+            return
+        delay_s = self._delay()
+        if delay_s > 0:
+            # Woken fractionally early
+            self._deferred = asyncio.get_running_loop().call_later(delay_s, self._run_deferred)
+            return
+        self._take_token()
+        self._start()
+
+    def _start(self, log_errors=True):
+        if self._deferred is not None:
+            # This download satisfies the deferred request
+            self._deferred.cancel()
+            self._deferred = None
+        self._last_start = time.monotonic()
+        self.downloads += 1
+        self._task = asyncio.get_running_loop().create_task(self.refresh())
+        if log_errors:
+            self._task.add_done_callback(self._log_error)
+
+    def _log_error(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Key refresh failed: {task.exception()}")
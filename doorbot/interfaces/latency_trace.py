@@ -0,0 +1,114 @@
+"""
+Trace the latency of each key read, from the last wiegand edge through to the relay
+unlocking, the sound starting and the slack message being posted.
+
+Each read carries a ReadTrace which is stamped as it passes through each stage.
+LatencyStats keeps a rolling window of durations per stage in memory and reports
+p50/p95/p99 for them.
+"""
+
+import time
+from collections import deque
+
+# Stages of a read in the order they happen. Each is timed from the stage before it.
+#   decode: last wiegand edge until the decoder's bit timeout completes the code (pigpio ticks)
+#   queue: decoder callback until read_tags pops the read off the queue
+#   authorise: user_manager.lookup of the key's access record
+#   relay: hat_gpio.set_relay to unlock the door
+#   sound: starting the granted/denied sound
+#   slack: posting the door access message to slack
+STAGES = ("decode", "queue", "authorise", "relay", "sound", "slack")
+
+# End to end totals, timed from the last wiegand edge
+TOTALS = ("tag_to_relay", "tag_to_slack")
+
+
+def tick_diff_us(start_tick, end_tick):
+    """Difference between two pigpio ticks in microseconds, allowing for the 32-bit wrap around"""
+    return (end_tick - start_tick) & 0xFFFFFFFF
+
+
+class ReadTrace:
+    def __init__(self, edge_tick=None, decode_tick=None):
+        """
+        Start a trace for a key read. edge_tick is the pigpio tick of the last wiegand edge
+        and decode_tick the tick when the decoder completed the code. Call from the decoder
+        callback as it anchors the pigpio ticks to time.perf_counter().
+        """
+        if edge_tick is not None and decode_tick is not None:
+            self.decode_s = tick_diff_us(edge_tick, decode_tick) / 1e6
+        else:
+            self.decode_s = 0.0
+        self.stamps = [("decode", time.perf_counter())]
+
+    def stamp(self, stage):
+        """Record that the read has finished the given stage"""
+        self.stamps.append((stage, time.perf_counter()))
+
+    def stage_durations(self):
+        """Return dict of stage name to seconds spent in that stage"""
+        durations = {"decode": self.decode_s}
+        for (_, previous), (stage, current) in zip(self.stamps, self.stamps[1:]):
+            durations[stage] = current - previous
+        return durations
+
+    def since_edge(self, stage):
+        """Return seconds from the last wiegand edge until stage finished, or None if it wasn't reached"""
+        start = self.stamps[0][1]
+        for name, stamp in self.stamps:
+            if name == stage:
+                return self.decode_s + (stamp - start)
+        return None
+
+
+class LatencyStats:
+    def __init__(self, window=500):
+        """Rolling latency samples, keeping the last window samples of each stage"""
+        self.window = window
+        self.samples = {}
+
+    def add(self, name, seconds):
+        if name not in self.samples:
+            self.samples[name] = deque(maxlen=self.window)
+        self.samples[name].append(seconds)
+
+    def add_trace(self, trace: ReadTrace):
+        """Record all the stages of a completed trace"""
+        for stage, seconds in trace.stage_durations().items():
+            self.add(stage, seconds)
+        for total, stage in zip(TOTALS, ("relay", "slack")):
+            seconds = trace.since_edge(stage)
+            if seconds is not None:
+                self.add(total, seconds)
+
+    def percentiles(self, name):
+        """Return dict with count, p50, p95 and p99 in seconds for a stage, or None if no samples"""
+        if not self.samples.get(name):
+            return None
+        ordered = sorted(self.samples[name])
+        last = len(ordered) - 1
+
+        def rank(p):
+            return ordered[min(last, int(round(p / 100 * last)))]
+
+        return {"count": len(ordered), "p50": rank(50), "p95": rank(95), "p99": rank(99)}
+
+    def summary(self):
+        """Return dict of stage name to percentiles for all stages with samples"""
+        summary = {}
+        for name in STAGES + TOTALS:
+            result = self.percentiles(name)
+            if result is not None:
+                summary[name] = result
+        return summary
+
+    def format_summary(self):
+        """Short text summary in milliseconds, one line per stage"""
+        summary = self.summary()
+        if not summary:
+            return "No key reads yet"
+        lines = ["Latency ms (p50 / p95 / p99, count):"]
+        for name, result in summary.items():
+            lines.append(f"{name}: {result['p50'] * 1000:.1f} / {result['p95'] * 1000:.1f} / "
+                         f"{result['p99'] * 1000:.1f} ({result['count']})")
+        return "\n".join(lines)
@@ -0,0 +1,168 @@
+"""
+Watch the asyncio event loop for stalls, and a failsafe for deadlines that must be met
+even when the loop is stalled.
+
+LoopMonitor schedules a heartbeat on the loop every interval and records how late it
+runs, which is the scheduling delay everything else on the loop sees. A separate thread
+checks the heartbeat. If it hasn't run for longer than the stall threshold, something
+is blocking the loop, so the thread logs the loop thread's current stack (the blocking
+call) and counts the stall.
+
+DeadlineFailsafe runs an action from its own thread if a deadline passes without being
+disarmed, eg. relocking the door if the relock timer on the loop is held up.
+"""
+
+import sys
+import time
+import logging
+import threading
+import traceback
+
+from doorbot.interfaces.latency_trace import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+# Default seconds between heartbeats and how late one may be before the loop counts as stalled
+DEFAULT_HEARTBEAT_INTERVAL_S = 0.25
+DEFAULT_STALL_THRESHOLD_S = 0.5
+
+
+class LoopMonitor:
+    def __init__(self, heartbeat_interval_s=DEFAULT_HEARTBEAT_INTERVAL_S,
+                 stall_threshold_s=DEFAULT_STALL_THRESHOLD_S):
+        self.heartbeat_interval_s = heartbeat_interval_s
+        self.stall_threshold_s = stall_threshold_s
+
+        # Heartbeat lateness in seconds
+        self.lag = LatencyStats()
+        self.max_lag_s = 0.0
+
+        # Stalls seen by the watch thread, and the stack of the last one
+        self.stalls = 0
+        self.last_stall_stack = None
+
+        self._loop = None
+        self._loop_thread_id = None
+        self._expected = None
+        self._last_beat = None
+        self._in_stall = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, loop):
+        """Start the heartbeat on loop and the watch thread. Call from the loop's thread."""
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._expected = loop.time() + self.heartbeat_interval_s
+        loop.call_at(self._expected, self._beat)
+
+        self._thread = threading.Thread(target=self._watch, name="loop_monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        lag = self.lag.percentiles("loop_lag")
+        stats = {
+            "stalls": self.stalls,
+            "max_lag_ms": self.max_lag_s * 1000,
+        }
+        if lag is not None:
+            stats["lag_ms"] = {key: value * 1000 if key != "count" else value for key, value in lag.items()}
+        return stats
+
+    def _beat(self):
+        """Heartbeat, runs on the loop"""
+        now = self._loop.time()
+        lag = max(0.0, now - self._expected)
+        self.lag.add("loop_lag", lag)
+        self.max_lag_s = max(self.max_lag_s, lag)
+        self._last_beat = time.monotonic()
+
+        if not self._stop.is_set():
+            self._expected = now + self.heartbeat_interval_s
+            self._loop.call_at(self._expected, self._beat)
+
+    def _watch(self):
+        """Watch thread, checks the heartbeat is still running"""
+        while not self._stop.wait(self.stall_threshold_s / 2):
+            blocked_s = time.monotonic() - self._last_beat - self.heartbeat_interval_s
+            if blocked_s > self.stall_threshold_s:
+                if not self._in_stall:
+                    self._in_stall = True
+                    self.stalls += 1
+                    self.last_stall_stack = self._loop_stack()
+                    logger.warning(f"Event loop blocked for {blocked_s:.3f} s, at:\n{self.last_stall_stack}")
+            elif self._in_stall:
+                self._in_stall = False
+
+    def _loop_stack(self):
+        """Formatted current stack of the loop's thread"""
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return "(loop thread not running)"
+        return "".join(traceback.format_stack(frame))
+
+
+class DeadlineFailsafe:
+    def __init__(self, name, action, grace_s=1.0):
+        """
+        Calls action from its own thread if arm()'s deadline plus grace_s passes without
+        disarm() being called. The thread only wakes at deadlines.
+        """
+        self.name = name
+        self.action = action
+        self.grace_s = grace_s
+
+        # Number of times the action has been run
+        self.triggered = 0
+
+        self._deadline = None
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def arm(self, duration_s: float):
+        """Expect disarm() within duration_s (plus the grace time)"""
+        with self._condition:
+            self._deadline = time.monotonic() + duration_s + self.grace_s
+            self._condition.notify()
+
+    def disarm(self):
+        with self._condition:
+            self._deadline = None
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if self._deadline is None:
+                        self._condition.wait()
+                        continue
+                    remaining = self._deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._stopped:
+                    return
+                missed_by = time.monotonic() - self._deadline
+                self._deadline = None
+                self.triggered += 1
+
+            logger.error(f"{self.name} - Deadline missed by {missed_by:.3f} s, running failsafe")
+            try:
+                self.action()
+            except Exception as e:
+                logger.error(f"{self.name} - An unexpected exception occurred: {e}")
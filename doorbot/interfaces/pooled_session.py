@@ -0,0 +1,32 @@
+"""
+A long lived aiohttp session shared by the calls of an API client.
+
+Keeping one session means connections to the server are kept alive and reused, rather than
+opened for every call. The session is created on first use, as aiohttp needs it made inside
+the running event loop, and again if it has been closed.
+"""
+import aiohttp
+
+
+class PooledSession:
+    def __init__(self, max_connections=4, keepalive_timeout_s=60.0, **connector_kwargs):
+        """connector_kwargs are passed on to the aiohttp.TCPConnector, eg. DNS cache settings"""
+        self.max_connections = max_connections
+        self.keepalive_timeout_s = keepalive_timeout_s
+        self.connector_kwargs = connector_kwargs
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections, keepalive_timeout=self.keepalive_timeout_s,
+                **self.connector_kwargs)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        """Close the session and its pooled connections"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
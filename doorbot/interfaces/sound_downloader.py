@@ -1,42 +1,177 @@
 """
 Download custom unlock sounds.
 
-The class is disposable - to start a fresh round of downloads with new user 
-list, create a new instance of this class.
+The class is disposable - to start a fresh round of downloads with new user
+list, create a new instance of this class and await download_all().
 
-Stores the sounds as {file_name}_{sound_hash}.mp3 so if the hash changes, 
-a new one will be created. It does not cleanup old sound files.
+Stores the sounds as {file_name}_{sound_hash}.mp3 so if the hash changes,
+a new one will be created. Old sound files are cleaned up by SoundStore.
+
+Sounds are downloaded with aiohttp, up to max_concurrent at once. Each one is streamed to
+a .part file beside its final name and renamed into place once complete, so a sound file
+is never seen half written. If a download is interrupted, the next round resumes the .part
+file with an HTTP Range request. Responses that aren't audio, or are larger than max_bytes,
+are rejected.
+
+on_download is called with (sound_hash, file_path) for each sound written, so the
+player's sound index can be updated without scanning the directory. The hashes of sounds
+that failed or were rejected are kept in failed_hashes, to try again in a later round.
 """
 
 import os
+import asyncio
 import logging
-from urllib.request import urlretrieve
+import aiohttp
+from aiohttp import ClientError
+from asyncio.exceptions import TimeoutError
 from urllib.parse import urlparse
 
+from doorbot.interfaces.custom_sound_index import sound_file_name, PART_SUFFIX
+
 logger = logging.getLogger(__name__)
 
+DEFAULT_MAX_CONCURRENT = 4
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+
+# Seconds allowed for each download, and between reads from the server
+DOWNLOAD_TIMEOUT_S = 120.0
+READ_TIMEOUT_S = 30.0
+
+CHUNK_BYTES = 64 * 1024
+
+# S3 serves uploads without a recognised extension as octet-stream
+ALLOWED_CONTENT_TYPES = ("application/octet-stream", "binary/octet-stream")
+
+
+class SoundRejected(Exception):
+    """The server's response isn't a sound we should keep"""
+
+
+def is_sound_content_type(content_type):
+    return content_type.startswith("audio/") or content_type in ALLOWED_CONTENT_TYPES
+
+
 class SoundDownloader:
-    def __init__(self, users_with_custom_sounds, download_directory):
+    def __init__(self, users_with_custom_sounds, download_directory, on_download=None,
+                 max_concurrent=DEFAULT_MAX_CONCURRENT, max_bytes=DEFAULT_MAX_BYTES):
         self.users = users_with_custom_sounds
-        self.current_user_index = 0
+        self.on_download = on_download
+        self.max_concurrent = max_concurrent
+        self.max_bytes = max_bytes
 
         self.download_directory = download_directory
         os.makedirs(self.download_directory, exist_ok=True)
 
-    def download_next_sound(self):
-        while self.current_user_index < len(self.users):
-            key, user = list(self.users.items())[self.current_user_index]
-            self.current_user_index += 1
+        # Outcome counts and bytes received, for stats
+        self.downloaded = 0
+        self.skipped = 0
+        self.resumed = 0
+        self.failed = 0
+        self.bytes_received = 0
+        self.failed_hashes = set()
+
+    def sound_path(self, sound_hash, url):
+        file_name = os.path.splitext(os.path.basename(urlparse(url).path))[0]
+        return os.path.join(self.download_directory, sound_file_name(file_name, sound_hash))
 
+    async def download_all(self):
+        """Download the sounds that aren't already on disk. Returns stats() once done."""
+        sounds = {}
+        for user in self.users.values():
             if "sound" in user and "sound_url" in user:
-                sound_hash = user["sound"]
-                url = user["sound_url"]
-                file_name = os.path.splitext(os.path.basename(urlparse(url).path))[0]
-                file_path = os.path.join(self.download_directory, f"{file_name}_{sound_hash}.mp3")
-                if not os.path.exists(file_path):
-                    urlretrieve(url, file_path)
-                    logger.debug(f"Downloaded sound file '{file_path}'")
-                    return True
+                path = self.sound_path(user["sound"], user["sound_url"])
+                if os.path.exists(path):
+                    self.skipped += 1
+                else:
+                    sounds[path] = (user["sound"], user["sound_url"])
+
+        if sounds:
+            semaphore = asyncio.Semaphore(self.max_concurrent)
+            connector = aiohttp.TCPConnector(limit=self.max_concurrent)
+            timeout = aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT_S, sock_read=READ_TIMEOUT_S)
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+                async def download(path, sound_hash, url):
+                    async with semaphore:
+                        await self._download(session, path, sound_hash, url)
+
+                await asyncio.gather(*[download(path, *sound) for path, sound in sounds.items()])
+
+        logger.debug(f"Sound downloads: {self.stats()}")
+        return self.stats()
+
+    def stats(self):
+        return {
+            "downloaded": self.downloaded,
+            "skipped": self.skipped,
+            "resumed": self.resumed,
+            "failed": self.failed,
+            "bytes_received": self.bytes_received,
+        }
+
+    async def _download(self, session, path, sound_hash, url):
+        part_path = path + PART_SUFFIX
+        try:
+            await self._fetch(session, url, part_path)
+            os.replace(part_path, path)
+        except SoundRejected as e:
+            logger.warning(f"Rejected sound '{url}': {e}")
+            self._remove(part_path)
+            self.failed += 1
+            self.failed_hashes.add(sound_hash)
+            return
+        except (ClientError, TimeoutError, OSError) as e:
+            # Keep what was received to resume from next time
+            logger.warning(f"Failed to download sound '{url}': {type(e).__name__}: {e}")
+            self.failed += 1
+            self.failed_hashes.add(sound_hash)
+            return
+
+        self.downloaded += 1
+        logger.debug(f"Downloaded sound file '{path}'")
+        if self.on_download is not None:
+            self.on_download(sound_hash, path)
+
+    async def _fetch(self, session, url, part_path):
+        """Stream url into part_path, resuming it if it has already been started"""
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else None
+
+        async with session.get(url, headers=headers) as response:
+            if response.status == 416:
+                # Nothing more to send for the range, so the part file can't be resumed
+                raise SoundRejected("Range not satisfiable, discarding partial download")
+            response.raise_for_status()
+
+            if not is_sound_content_type(response.content_type):
+                raise SoundRejected(f"Content type '{response.content_type}' isn't audio")
+
+            if response.status == 206:
+                if not response.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+                    raise SoundRejected(f"Unexpected range '{response.headers.get('Content-Range')}'")
+                self.resumed += 1
+                mode = "ab"
+            else:
+                # Server ignored the range, start again
+                offset = 0
+                mode = "wb"
+
+            if response.content_length is not None and offset + response.content_length > self.max_bytes:
+                raise SoundRejected(f"{offset + response.content_length} bytes is over the {self.max_bytes} byte limit")
+
+            size = offset
+            with open(part_path, mode) as file:
+                async for chunk in response.content.iter_chunked(CHUNK_BYTES):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise SoundRejected(f"Over the {self.max_bytes} byte limit")
+                    file.write(chunk)
+                    self.bytes_received += len(chunk)
 
-        return False
+            if response.content_length is not None and size != offset + response.content_length:
+                raise ClientError(f"Incomplete, got {size - offset} of {response.content_length} bytes")
 
+    @staticmethod
+    def _remove(path):
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,153 @@
+"""
+Process downloaded custom sounds so they are quick and predictable to play.
+
+Members upload arbitrary MP3s: high bitrates, long durations and all sorts of loudness.
+Decoding those at unlock time on a Pi 2 makes the sound late and the CPU use spiky. After
+download, each sound is run through ffmpeg once to:
+
+    - trim it to max_duration_s, fading out the last half second
+    - normalise its loudness (EBU R128 loudnorm) to loudness_lufs
+    - transcode it to mono 16 bit PCM WAV at sample_rate, which needs no decoding to play
+
+The result is written beside the MP3 as {file_name}_{sound_hash}.wav (see
+custom_sound_index.processed_path), so it is cached by sound hash and CustomSoundIndex
+picks it over the original. The original is kept to process again from.
+
+Sounds are processed one at a time, niced, so the door stays responsive. If ffmpeg isn't
+installed, or fails on a sound, the original MP3 is played as before.
+"""
+
+import os
+import shutil
+import asyncio
+import logging
+from asyncio.exceptions import TimeoutError
+
+from doorbot.interfaces.custom_sound_index import processed_path, PART_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_DURATION_S = 10.0
+DEFAULT_SAMPLE_RATE = 22050
+DEFAULT_LOUDNESS_LUFS = -16.0
+
+# Seconds allowed for ffmpeg to process one sound
+PROCESS_TIMEOUT_S = 60.0
+
+FADE_OUT_S = 0.5
+
+
+class SoundIngest:
+    def __init__(self, max_duration_s=DEFAULT_MAX_DURATION_S, sample_rate=DEFAULT_SAMPLE_RATE,
+                 loudness_lufs=DEFAULT_LOUDNESS_LUFS, ffmpeg_path=None):
+        """ffmpeg_path defaults to ffmpeg on the PATH. Processing is skipped if there isn't one."""
+        self.max_duration_s = max_duration_s
+        self.sample_rate = sample_rate
+        self.loudness_lufs = loudness_lufs
+        self.ffmpeg_path = ffmpeg_path or shutil.which("ffmpeg")
+        self.nice_path = shutil.which("nice")
+
+        # Held while running ffmpeg, so sounds are processed one at a time and two calls for
+        # the same sound can't write the same part file
+        self._lock = asyncio.Lock()
+
+        # Sound hashes ffmpeg failed on, not tried again until restart
+        self.failed_hashes = set()
+
+        # Outcome counts, for stats
+        self.processed = 0
+        self.cached = 0
+        self.failed = 0
+
+        if self.ffmpeg_path is None:
+            logger.warning("ffmpeg not found, custom sounds will be played as downloaded")
+
+    @property
+    def available(self):
+        return self.ffmpeg_path is not None
+
+    def command(self, source_path, output_path):
+        """ffmpeg command line to process source_path into output_path"""
+        fade_start_s = max(0.0, self.max_duration_s - FADE_OUT_S)
+        command = [
+            self.ffmpeg_path, "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+            "-i", source_path,
+            "-t", f"{self.max_duration_s:g}",
+            "-af", f"afade=t=out:st={fade_start_s:g}:d={FADE_OUT_S:g},"
+                   f"loudnorm=I={self.loudness_lufs:g}:TP=-1.5:LRA=11",
+            "-ac", "1", "-ar", str(self.sample_rate), "-c:a", "pcm_s16le",
+            "-f", "wav", output_path,
+        ]
+        if self.nice_path is not None:
+            command = [self.nice_path, "-n", "10"] + command
+        return command
+
+    async def process(self, sound_hash, source_path):
+        """
+        Return the path of the processed variant of a downloaded sound, making it if needed.
+        Returns None if it can't be processed, so the original should be played.
+        """
+        output_path = processed_path(source_path)
+        if not self.available:
+            return output_path if os.path.exists(output_path) else None
+
+        async with self._lock:
+            # Checked with the lock held, in case it was being processed by another call
+            if os.path.exists(output_path):
+                self.cached += 1
+                return output_path
+            if sound_hash in self.failed_hashes:
+                return None
+            return await self._process(sound_hash, source_path, output_path)
+
+    async def _process(self, sound_hash, source_path, output_path):
+        part_path = output_path + PART_SUFFIX
+        try:
+            await self._run(self.command(source_path, part_path))
+            os.replace(part_path, output_path)
+        except (OSError, TimeoutError, RuntimeError) as e:
+            logger.warning(f"Failed to process sound '{source_path}': {type(e).__name__}: {e}")
+            self.failed_hashes.add(sound_hash)
+            self.failed += 1
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return None
+
+        self.processed += 1
+        logger.debug(f"Processed sound '{source_path}' to '{output_path}'")
+        return output_path
+
+    async def process_all(self, sounds, on_processed=None):
+        """
+        Process a dict of sound hash to downloaded path, one at a time. on_processed is
+        called with (sound_hash, processed path) for each one newly made. Returns stats().
+        """
+        for sound_hash, source_path in sounds.items():
+            if not os.path.exists(source_path):
+                continue
+            already_processed = os.path.exists(processed_path(source_path))
+            output_path = await self.process(sound_hash, source_path)
+            if output_path is not None and not already_processed and on_processed is not None:
+                on_processed(sound_hash, output_path)
+        return self.stats()
+
+    def stats(self):
+        return {
+            "available": self.available,
+            "processed": self.processed,
+            "cached": self.cached,
+            "failed": self.failed,
+        }
+
+    @staticmethod
+    async def _run(command):
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), PROCESS_TIMEOUT_S)
+        except TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace').strip()}")
@@ -1,24 +1,54 @@
 """
 Play sounds for key access
+
+Uses one libvlc instance and media player for the life of the app. The granted and denied
+sounds are loaded and parsed up front, and recently played custom sounds are kept in a
+small LRU cache, so playing a sound is just swapping the media on the player.
 """
 
 import os
-import fnmatch
 import logging
 import time
+from collections import OrderedDict
 import vlc
 
+from doorbot.interfaces.custom_sound_index import CustomSoundIndex
+
 logger = logging.getLogger(__name__)
 
+# Number of recently played custom sounds kept loaded, ready to play
+MEDIA_CACHE_SIZE = 16
+
 class SoundPlayer:
-    def __init__(self, sound_dir="", custom_sound_dir=""):
+    def __init__(self, sound_dir="", custom_sound_dir="", media_cache_size=MEDIA_CACHE_SIZE):
         self.sound_dir = sound_dir
         self.custom_sound_dir = custom_sound_dir
-        self.player = None
+
+        # Downloaded custom sounds by hash, so finding one doesn't scan the directory
+        self.sound_index = CustomSoundIndex(custom_sound_dir)
+
+        # Long lived libvlc state, reused for every sound
+        self.instance = vlc.Instance()
+        self.player = self.instance.media_player_new()
+        self.player.event_manager().event_attach(vlc.EventType.MediaPlayerPlaying, self._on_playing)
+
+        # Granted and denied sounds stay loaded. Custom sounds are cached by path, most recent last.
+        self.granted_path = os.path.join(self.sound_dir, "granted.mp3")
+        self.denied_path = os.path.join(self.sound_dir, "denied.mp3")
+        self._preloaded_media = {}
+        for path in (self.granted_path, self.denied_path):
+            if os.path.exists(path):
+                self._preloaded_media[path] = self._load_media(path)
+        self.media_cache_size = media_cache_size
+        self._media_cache = OrderedDict()
+
+        # Time from play_sound being called until vlc reports it is playing, for the last sound
+        self._play_called_at = None
+        self.last_start_latency_s = None
 
     def play_access_granted_or_custom(self, user):
         # Fallback option if no custom sound is simply "access granted"
-        sound_to_play = os.path.join(self.sound_dir, "granted.mp3")
+        sound_to_play = self.granted_path
 
         if user is None:
             user = {}
@@ -27,7 +57,7 @@ class SoundPlayer:
         # See if user has custom sound and it has been downloaded
         if "sound" in user:
             sound_hash = user["sound"]
-            file_path = self._find_sound_by_hash(sound_hash)
+            file_path = self.find_sound_by_hash(sound_hash)
             if file_path:
                 sound_to_play = file_path
             else:
@@ -36,17 +66,35 @@ class SoundPlayer:
         logger.debug(f"Playing access granted for '{username}': {sound_to_play}")
         self.play_sound(sound_to_play)        
 
+    def play_access_granted_for(self, record):
+        """Play the custom sound already resolved for a UserManager AccessRecord, or access granted"""
+        sound_to_play = record.sound_path
+        if sound_to_play is None:
+            if record.sound_hash is not None:
+                logger.warning(f"Could not find custom sound for '{record.name}': '{record.sound_hash}', falling back to default")
+            sound_to_play = self.granted_path
+
+        logger.debug(f"Playing access granted for '{record.name}': {sound_to_play}")
+        self.play_sound(sound_to_play)
+
     def play_denied(self):
         logger.debug(f"Playing access denied")
-        sound_to_play = os.path.join(self.sound_dir, "denied.mp3")
-        self.play_sound(sound_to_play)        
+        self.play_sound(self.denied_path)
 
-    def _find_sound_by_hash(self, sound_hash):
-        if os.path.exists(self.custom_sound_dir):
-            for file_name in os.listdir(self.custom_sound_dir):
-                if fnmatch.fnmatch(file_name, f"*_{sound_hash}.mp3"):
-                    return os.path.join(self.custom_sound_dir, file_name)
-        return None
+    def find_sound_by_hash(self, sound_hash):
+        """Return path to the downloaded custom sound with the given hash, or None"""
+        return self.sound_index.find(sound_hash)
+
+    def custom_sound_downloaded(self, sound_hash, path):
+        """Called by SoundDownloader or SoundIngest when it has written a new custom sound"""
+        self.sound_index.add(sound_hash, path)
+
+    def custom_sound_removed(self, sound_hash, path):
+        """Called by SoundStore when it has deleted a custom sound"""
+        self.sound_index.remove(sound_hash)
+        media = self._media_cache.pop(path, None)
+        if media is not None:
+            media.release()
 
     def is_playing(self):
         return self.player is not None and self.player.is_playing()
@@ -62,15 +110,56 @@ class SoundPlayer:
                     break
 
     def play_sound(self, path):
-        if self.player is not None:
-            # Its important to always stop because is_playing isn't necessarily up to date
-            # and playing multiple media files are once breaks libvlc.
-            self.player.stop()
-        if os.path.exists(path):
+        # Its important to always stop because is_playing isn't necessarily up to date
+        # and playing multiple media files are once breaks libvlc.
+        self.player.stop()
+        media = self._get_media(path)
+        if media is not None:
             logger.debug(f"Play {path}")
-            self.player = vlc.MediaPlayer(path)
+            self._play_called_at = time.perf_counter()
+            self.player.set_media(media)
             self.player.play()
         else:
             logger.error(f"Sound does not exist: '{path}'")
 
+    def _get_media(self, path):
+        """Return loaded media for path, loading and caching it if needed. None if the file doesn't exist."""
+        media = self._preloaded_media.get(path)
+        if media is not None:
+            return media
+
+        media = self._media_cache.get(path)
+        if media is not None:
+            self._media_cache.move_to_end(path)
+            return media
+
+        if not os.path.exists(path):
+            return None
+
+        media = self._load_media(path)
+        self._media_cache[path] = media
+        while len(self._media_cache) > self.media_cache_size:
+            _, evicted = self._media_cache.popitem(last=False)
+            evicted.release()
+        return media
+
+    def _load_media(self, path):
+        media = self.instance.media_new_path(path)
+        # Parses in the background so it is ready before it is played
+        media.parse_with_options(vlc.MediaParseFlag.local, -1)
+        return media
+
+    def stats(self):
+        latency_ms = None if self.last_start_latency_s is None else self.last_start_latency_s * 1000
+        return {
+            "cached_media": len(self._media_cache),
+            "last_start_latency_ms": latency_ms,
+        }
+
+    def _on_playing(self, event):
+        """vlc event callback (from a vlc thread) when playback has started"""
+        if self._play_called_at is not None:
+            self.last_start_latency_s = time.perf_counter() - self._play_called_at
+            self._play_called_at = None
+
 
@@ -0,0 +1,180 @@
+"""
+Cleanup and disk quota for the downloaded custom sounds.
+
+SoundDownloader stores sounds as {file_name}_{sound_hash}.mp3 (with a processed .wav beside
+it from SoundIngest) and never removes them, so old sounds pile up as members change
+theirs. The store keeps a manifest of every sound hash with the number of users
+referencing it (from the current key list) and when it was last used (downloaded or
+played).
+
+collect() is a mark and sweep: sound files (and partial downloads) whose hash no user
+references are deleted. Then, if the sounds left are over quota_bytes, the least recently
+used are evicted, all of a sound's files together, until they fit. An evicted sound isn't
+downloaded again until it is played (mark_used() returns True for the first play after it
+was evicted), so it doesn't churn with the downloader.
+
+The manifest is saved atomically to manifest_path after each collect. By default that is
+beside the directory rather than in it, so saving it doesn't change the directory's mtime
+and make CustomSoundIndex rescan. on_remove is called with (sound_hash, file_path) for
+each sound deleted, so the player's sound index can be updated.
+"""
+
+import os
+import json
+import time
+import logging
+
+from doorbot.interfaces.custom_sound_index import sound_hash_from_file_name, PART_SUFFIX
+from doorbot.interfaces.key_cache import write_atomic
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+class SoundStore:
+    def __init__(self, directory, quota_bytes=None, manifest_path=None, on_remove=None):
+        """quota_bytes is the most space the sounds can take, None for no limit"""
+        self.directory = directory
+        self.quota_bytes = quota_bytes
+        self.manifest_path = manifest_path or os.path.normpath(directory) + MANIFEST_SUFFIX
+        self.on_remove = on_remove
+
+        # Sound hash to {"refs": users referencing it, "last_used": unix time,
+        # "evicted": unix time if evicted for the quota}
+        self.manifest = self._load_manifest()
+
+        # Totals over all collects, for stats
+        self.removed = 0
+        self.evicted = 0
+        self.reclaimed_bytes = 0
+        self.total_bytes = 0
+
+    def update_references(self, users_with_custom_sounds):
+        """Count the users referencing each sound hash, from the full list of users with custom sounds"""
+        refs = {}
+        for user in users_with_custom_sounds.values():
+            if "sound" in user:
+                refs[user["sound"]] = refs.get(user["sound"], 0) + 1
+
+        now = time.time()
+        for sound_hash, entry in self.manifest.items():
+            entry["refs"] = refs.pop(sound_hash, 0)
+        for sound_hash, count in refs.items():
+            self.manifest[sound_hash] = {"refs": count, "last_used": now}
+
+    def mark_used(self, sound_hash, now=None):
+        """
+        Record that a sound was downloaded or played. Returns True if it had been evicted for
+        the quota, ie. it is wanted again and should be downloaded.
+        """
+        was_evicted = not self.wanted(sound_hash)
+        entry = self.manifest.setdefault(sound_hash, {"refs": 0})
+        entry["last_used"] = time.time() if now is None else now
+        return was_evicted
+
+    def wanted(self, sound_hash):
+        """False if the sound was evicted for the quota and hasn't been used since"""
+        entry = self.manifest.get(sound_hash)
+        if entry is None or "evicted" not in entry:
+            return True
+        return entry.get("last_used", 0) > entry["evicted"]
+
+    def collect(self):
+        """Delete unreferenced sounds, then evict least recently used ones over the quota"""
+        files = self._scan()
+        removed = []
+        evicted = []
+        reclaimed_bytes = 0
+
+        # Sweep sounds no user references
+        for path, (sound_hash, size) in list(files.items()):
+            if self.manifest.get(sound_hash, {}).get("refs", 0) == 0:
+                reclaimed_bytes += self._remove(path, sound_hash)
+                del files[path]
+                if not path.endswith(PART_SUFFIX) and sound_hash not in removed:
+                    removed.append(sound_hash)
+
+        # Evict the least recently used until under the quota
+        total_bytes = sum(size for _, size in files.values())
+        if self.quota_bytes is not None and total_bytes > self.quota_bytes:
+            now = time.time()
+            by_hash = {}
+            for path, (sound_hash, size) in files.items():
+                by_hash.setdefault(sound_hash, []).append(path)
+
+            def last_used(sound_hash):
+                return self.manifest.get(sound_hash, {}).get("last_used", 0)
+
+            for sound_hash in sorted(by_hash, key=last_used):
+                if total_bytes <= self.quota_bytes:
+                    break
+                for path in by_hash[sound_hash]:
+                    reclaimed_bytes += self._remove(path, sound_hash)
+                    total_bytes -= files.pop(path)[1]
+                if not all(path.endswith(PART_SUFFIX) for path in by_hash[sound_hash]):
+                    evicted.append(sound_hash)
+                    self.manifest[sound_hash]["evicted"] = now
+
+        # Forget sounds that are gone and no longer referenced
+        on_disk = {sound_hash for sound_hash, _ in files.values()} - set(evicted)
+        self.manifest = {sound_hash: entry for sound_hash, entry in self.manifest.items()
+                         if entry.get("refs", 0) > 0 or sound_hash in on_disk}
+        self._save_manifest()
+
+        self.removed += len(removed)
+        self.evicted += len(evicted)
+        self.reclaimed_bytes += reclaimed_bytes
+        self.total_bytes = total_bytes
+        if removed or evicted:
+            logger.info(f"Removed {len(removed)} unused and evicted {len(evicted)} custom sounds, "
+                        f"reclaimed {reclaimed_bytes} bytes ({total_bytes} bytes in use)")
+        return {"removed": removed, "evicted": evicted, "reclaimed_bytes": reclaimed_bytes,
+                "total_bytes": total_bytes}
+
+    def stats(self):
+        return {
+            "sounds": len(self.manifest),
+            "removed": self.removed,
+            "evicted": self.evicted,
+            "reclaimed_bytes": self.reclaimed_bytes,
+            "total_bytes": self.total_bytes,
+        }
+
+    def _scan(self):
+        """Sound and partial download files in the directory, path to (sound hash, size)"""
+        files = {}
+        if not os.path.isdir(self.directory):
+            return files
+        for file_name in os.listdir(self.directory):
+            sound_hash = sound_hash_from_file_name(file_name.removesuffix(PART_SUFFIX))
+            if sound_hash is not None:
+                path = os.path.join(self.directory, file_name)
+                files[path] = (sound_hash, os.path.getsize(path))
+        return files
+
+    def _remove(self, path, sound_hash):
+        """Delete a sound file, returns the bytes freed"""
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return 0
+        logger.debug(f"Deleted custom sound '{path}'")
+        if self.on_remove is not None and not path.endswith(PART_SUFFIX):
+            self.on_remove(sound_hash, path)
+        return size
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path) as file:
+                return json.load(file)
+        except ValueError as e:
+            logger.error(f"Sound manifest {self.manifest_path} is corrupt, starting a new one: {e}")
+            return {}
+
+    def _save_manifest(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_path)), exist_ok=True)
+        write_atomic(self.manifest_path, json.dumps(self.manifest, separators=(",", ":")).encode())
@@ -1,77 +1,190 @@
 """
 Connect to tidy auth API and download keys and unlock sound info
+
+Requests share a PooledSession, with DNS lookups cached too, so the connection to the
+tidyauth server is reused between key refreshes. Each endpoint has its own timeout. Connection
+errors, timeouts and 5xx responses are retried with bounded exponential backoff and jitter.
+
+Door keys are downloaded conditionally. The ETag and Last-Modified validators from the last
+download are sent with the next request, and a hash of the last body is kept for servers
+that don't support them. If the server replies 304, or the body hashes the same, the keys
+are unchanged and the json isn't parsed again. The validators of new keys are only kept once
+the caller has applied and saved them and calls commit_keys_validators(), so keys that
+failed to apply are downloaded again.
 """
+import json
+import asyncio
+import random
+import hashlib
 import logging
 import aiohttp
-from aiohttp import ClientSession, ClientResponseError, ClientConnectionError
+from aiohttp import ClientResponseError, ClientConnectionError
 from asyncio.exceptions import TimeoutError
 
+from doorbot.interfaces.pooled_session import PooledSession
+
 logger = logging.getLogger(__name__)
 
+# Total timeout in seconds for each endpoint
+TEST_ROUTE_TIMEOUT_S = 60.0
+DOOR_KEYS_TIMEOUT_S = 30.0
+SOUND_DATA_TIMEOUT_S = 10.0
+
 class TidyAuthClient:
-    def __init__(self, base_url, token):
+    def __init__(self, base_url, token, max_connections=4, keepalive_timeout_s=60.0,
+                 dns_cache_ttl_s=300, retries=3, backoff_base_s=0.5, backoff_max_s=8.0):
+        """
+        retries is the number of extra attempts after a failure that may be temporary. The
+        wait before retry n (from 0) is backoff_base_s * 2^n, capped at backoff_max_s, with
+        random jitter of up to half of it.
+        """
         self.base_url = base_url
         self.token = token
+        self._pool = PooledSession(max_connections=max_connections, keepalive_timeout_s=keepalive_timeout_s,
+                                   use_dns_cache=True, ttl_dns_cache=dns_cache_ttl_s)
+        self.retries = retries
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+
+        # Validators and body hash from the last door keys that were committed, and those of
+        # the keys last returned, waiting for commit_keys_validators()
+        self._keys_etag = None
+        self._keys_last_modified = None
+        self._keys_digest = None
+        self._pending_keys_validators = None
+
+        # Number of retries made, and door key downloads by outcome, for stats
+        self.retry_count = 0
+        self.keys_not_modified = 0
+        self.keys_unchanged = 0
+        self.keys_parsed = 0
+
+    async def close(self):
+        await self._pool.close()
+
+    def backoff_delay(self, attempt):
+        """Seconds to wait before retry number attempt (from 0)"""
+        delay = min(self.backoff_max_s, self.backoff_base_s * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.0)
+
+    def stats(self):
+        return {
+            "retries": self.retry_count,
+            "keys_not_modified": self.keys_not_modified,
+            "keys_unchanged": self.keys_unchanged,
+            "keys_parsed": self.keys_parsed,
+        }
+
+    async def _get(self, name, path, params, timeout_s, read, headers=None):
+        """
+        GET base_url + path and return await read(response), retrying temporary failures.
+        Returns None if it fails.
+        """
+        session = self._pool.session
+        timeout = aiohttp.ClientTimeout(total=timeout_s)
+        attempt = 0
+        while True:
+            try:
+                async with session.get(f"{self.base_url}{path}", params=params, headers=headers,
+                                       timeout=timeout) as response:
+                    if response.status >= 500:
+                        response.raise_for_status()
+                    return await read(response)
+            except ClientResponseError as e:
+                error = f"ClientResponseError: {e}"
+                temporary = e.status >= 500
+            except ValueError as e:
+                error = f"JSONDecodeError: {e}"
+                temporary = False
+            except ClientConnectionError as e:
+                error = f"ClientConnectionError: Could not connect to server: {e}"
+                temporary = True
+            except TimeoutError as e:
+                error = f"TimeoutError: {e}"
+                temporary = True
+            except Exception as e:
+                error = f"Unexpected error: {e}"
+                temporary = False
+
+            if not temporary or attempt >= self.retries:
+                logger.error(f"{name} - {error}")
+                return None
+
+            delay = self.backoff_delay(attempt)
+            logger.warning(f"{name} - {error}, retrying in {delay:.1f} s")
+            self.retry_count += 1
+            attempt += 1
+            await asyncio.sleep(delay)
 
     async def test_route(self):
         params = {"token": self.token}
-        try:
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with ClientSession(timeout=timeout) as session:
-                async with session.get(f"{self.base_url}/", params=params) as response:
-                    if response.status == 200:
-                        logger.debug("test_route - Valid token")
-                        return True
-                    elif response.status == 401:
-                        logger.debug("test_route - Invalid token")
-                    else:
-                        logger.debug(f"test_route - Unexpected response: {response.status}")
-        except ClientResponseError as e:
-            logger.error(f"test_route - ClientResponseError: {e}")
-        except ClientConnectionError as e:
-            logger.error(f"test_route - ClientConnectionError: Could not connect to server: {e}")
-        except TimeoutError as e:
-            logger.error(f"test_route - TimeoutError: {e}")
-        except Exception as e:
-            logger.error(f"test_route - Unexpected error: {e}")
-        return False
+
+        async def read(response):
+            if response.status == 200:
+                logger.debug("test_route - Valid token")
+                return True
+            elif response.status == 401:
+                logger.debug("test_route - Invalid token")
+            else:
+                logger.debug(f"test_route - Unexpected response: {response.status}")
+            return False
+
+        result = await self._get("test_route", "/", params, TEST_ROUTE_TIMEOUT_S, read)
+        return result is True
 
     async def get_door_keys(self):
+        """
+        Returns the door keys, or None if they haven't changed since the last call (or the
+        download failed).
+        """
         update_source = "tidyhq"
         params = {"token": self.token, "update": update_source}
-        try:
-            async with ClientSession() as session:
-                async with session.get(f"{self.base_url}/api/v1/keys/door", params=params) as response:
-                    response.raise_for_status()
-                    return await response.json()
-        except ClientResponseError as e:
-            logger.error(f"get_door_keys - ClientResponseError: {e}")
-        except ValueError as e:
-            logger.error(f"get_door_keys - JSONDecodeError: {e}")
-        except ClientConnectionError as e:
-            logger.error(f"get_door_keys - ClientConnectionError: Could not connect to server: {e}")
-        except TimeoutError as e:
-            logger.error(f"get_door_keys - TimeoutError: {e}")
-        except Exception as e:
-            logger.error(f"get_door_keys - Unexpected error: {e}")
-        return None
+        headers = {}
+        if self._keys_etag is not None:
+            headers["If-None-Match"] = self._keys_etag
+        if self._keys_last_modified is not None:
+            headers["If-Modified-Since"] = self._keys_last_modified
+
+        async def read(response):
+            if response.status == 304:
+                logger.debug("get_door_keys - Not modified")
+                self.keys_not_modified += 1
+                return None
+            response.raise_for_status()
+
+            body = await response.read()
+            digest = hashlib.sha256(body).hexdigest()
+            if digest == self._keys_digest:
+                logger.debug("get_door_keys - Unchanged")
+                self.keys_unchanged += 1
+                self._set_keys_validators(response, digest)
+                return None
+
+            keys = json.loads(body)
+            self.keys_parsed += 1
+            self._pending_keys_validators = (response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                                             digest)
+            return keys
+
+        return await self._get("get_door_keys", "/api/v1/keys/door", params, DOOR_KEYS_TIMEOUT_S, read, headers)
+
+    def commit_keys_validators(self):
+        """Call once the keys last returned by get_door_keys() have been applied and saved"""
+        if self._pending_keys_validators is not None:
+            self._keys_etag, self._keys_last_modified, self._keys_digest = self._pending_keys_validators
+            self._pending_keys_validators = None
+
+    def _set_keys_validators(self, response, digest):
+        self._keys_etag = response.headers.get("ETag")
+        self._keys_last_modified = response.headers.get("Last-Modified")
+        self._keys_digest = digest
 
     async def get_sound_data(self, tidyhq_id):
         params = {"token": self.token, "tidyhq_id": tidyhq_id}
-        try:
-            async with ClientSession() as session:
-                async with session.get(f"{self.base_url}/api/v1/data/sound", params=params) as response:
-                    # Gives 401 if user doesn"t have any sound, don"t raise_for_status.
-                    # The contents differentiates it
-                    return await response.json()
-        except ClientResponseError as e:
-            logger.error(f"get_sound_data - ClientResponseError: {e}")
-        except ValueError as e:
-            logger.error(f"get_sound_data - JSONDecodeError: {e}")
-        except ClientConnectionError as e:
-            logger.error(f"get_sound_data - ClientConnectionError: Could not connect to server: {e}")
-        except TimeoutError as e:
-            logger.error(f"get_sound_data - TimeoutError: {e}")
-        except Exception as e:
-            logger.error(f"get_sound_data - Unexpected error: {e}")
-        return None
+
+        async def read(response):
+            # Gives 401 if user doesn"t have any sound, don"t raise_for_status.
+            # The contents differentiates it
+            return await response.json()
+
+        return await self._get("get_sound_data", "/api/v1/data/sound", params, SOUND_DATA_TIMEOUT_S, read)
@@ -0,0 +1,207 @@
+"""
+One scheduler for all of doorbot's timed behaviour (relock, LED reset, key refresh, sensor poll).
+
+Named timers are kept in a heap ordered by deadline. A single coroutine, run(), sleeps
+until the earliest deadline and then dispatches the callbacks that are due, so adding a
+timer doesn't add another polling coroutine. Scheduling a timer that already has a
+deadline replaces it. Periodic timers are rescheduled one interval after they fire.
+
+Callbacks can be plain functions, which are called straight away in the loop, or coroutine
+functions, which are run as tasks so a slow one (eg. downloading keys) can't hold up the
+others. If a timer is due while its task is still running, it is run again when the task
+finishes. After an exception a periodic timer waits at least error_backoff_s before it
+runs again.
+
+How late each timer is dispatched after its deadline is recorded for stats.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from doorbot.interfaces.latency_trace import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+# Seconds a periodic timer waits after an exception before running again
+DEFAULT_ERROR_BACKOFF_S = 5.0
+
+
+class Timer:
+    __slots__ = ("name", "callback", "interval_s", "error_backoff_s", "deadline", "seq", "task",
+                 "rerun", "fired", "skipped", "errors")
+
+    def __init__(self, name, callback, interval_s=None, error_backoff_s=DEFAULT_ERROR_BACKOFF_S):
+        self.name = name
+        self.callback = callback
+        self.interval_s = interval_s
+        self.error_backoff_s = error_backoff_s
+
+        # time.monotonic() deadline, None if not scheduled. seq identifies the live heap entry.
+        self.deadline = None
+        self.seq = None
+
+        # Running task for coroutine callbacks, and whether it was due again while running
+        self.task = None
+        self.rerun = False
+
+        self.fired = 0
+        self.skipped = 0
+        self.errors = 0
+
+
+class TimerScheduler:
+    def __init__(self):
+        self.timers = {}
+
+        # (deadline, seq, name). Entries for timers since rescheduled or cancelled are
+        # left in place and skipped when they reach the top.
+        self._heap = []
+        self._seq = itertools.count()
+
+        # Dispatch lateness per timer in seconds
+        self.jitter = LatencyStats()
+
+        # Set by the loop callback at the earliest deadline to wake run()
+        self._loop = None
+        self._wake = asyncio.Event()
+        self._wake_handle = None
+        self._wake_at = None
+
+        # Number of times run() has woken up
+        self.wakeups = 0
+
+    def add(self, name, callback, interval_s=None, delay_s=None, error_backoff_s=DEFAULT_ERROR_BACKOFF_S):
+        """
+        Register a named timer. If interval_s, it repeats every interval_s. It first fires
+        after delay_s if given, else after interval_s for periodic timers. Otherwise it
+        waits until schedule() is called.
+        """
+        if name in self.timers:
+            raise ValueError(f"Timer '{name}' already exists")
+        self.timers[name] = Timer(name, callback, interval_s, error_backoff_s)
+        if delay_s is None:
+            delay_s = interval_s
+        if delay_s is not None:
+            self.schedule(name, delay_s)
+
+    def schedule(self, name, delay_s: float):
+        """Set the timer to fire in delay_s seconds, replacing any deadline it already has"""
+        timer = self.timers[name]
+        timer.deadline = time.monotonic() + delay_s
+        timer.seq = next(self._seq)
+        heapq.heappush(self._heap, (timer.deadline, timer.seq, name))
+        self._arm()
+
+    def cancel(self, name):
+        """Stop the timer without firing. Periodic timers stay stopped until scheduled again."""
+        timer = self.timers[name]
+        timer.deadline = None
+        timer.seq = None
+        self._arm()
+
+    def remaining(self, name):
+        """Seconds until the timer fires, or None if it isn't scheduled"""
+        deadline = self.timers[name].deadline
+        if deadline is None:
+            return None
+        return max(0.0, deadline - time.monotonic())
+
+    async def run(self):
+        """Dispatch timers as they become due. Runs forever."""
+        self._loop = asyncio.get_running_loop()
+        while True:
+            self._dispatch_due()
+            self._arm()
+            await self._wake.wait()
+            self._wake.clear()
+            self.wakeups += 1
+
+    def stats(self):
+        stats = {}
+        for name, timer in self.timers.items():
+            timer_stats = {"fired": timer.fired, "skipped": timer.skipped, "errors": timer.errors}
+            jitter = self.jitter.percentiles(name)
+            if jitter is not None:
+                timer_stats["jitter_ms"] = {key: value * 1000 if key != "count" else value
+                                            for key, value in jitter.items()}
+            stats[name] = timer_stats
+        return stats
+
+    def _next_deadline(self):
+        """Earliest live deadline, dropping stale heap entries. None if nothing is scheduled."""
+        while self._heap:
+            deadline, seq, name = self._heap[0]
+            if self.timers[name].seq == seq:
+                return deadline
+            heapq.heappop(self._heap)
+        return None
+
+    def _arm(self):
+        """Make sure run() is woken at the earliest deadline"""
+        if self._loop is None:
+            # Not running yet, run() arms when it starts
+            return
+        deadline = self._next_deadline()
+        if deadline == self._wake_at:
+            return
+        if self._wake_handle is not None:
+            self._wake_handle.cancel()
+            self._wake_handle = None
+        self._wake_at = deadline
+        if deadline is not None:
+            self._wake_handle = self._loop.call_later(max(0.0, deadline - time.monotonic()), self._on_wake)
+
+    def _on_wake(self):
+        self._wake_handle = None
+        self._wake_at = None
+        self._wake.set()
+
+    def _dispatch_due(self):
+        now = time.monotonic()
+        while True:
+            deadline = self._next_deadline()
+            if deadline is None or deadline > now:
+                break
+            _, _, name = heapq.heappop(self._heap)
+            timer = self.timers[name]
+            timer.deadline = None
+            timer.seq = None
+            self.jitter.add(name, now - deadline)
+            if timer.interval_s is not None:
+                self.schedule(name, timer.interval_s)
+            self._fire(timer)
+
+    def _fire(self, timer: Timer):
+        if asyncio.iscoroutinefunction(timer.callback):
+            if timer.task is not None and not timer.task.done():
+                timer.skipped += 1
+                timer.rerun = True
+                return
+            timer.fired += 1
+            timer.task = self._loop.create_task(timer.callback())
+            timer.task.add_done_callback(lambda task: self._task_done(timer, task))
+        else:
+            timer.fired += 1
+            try:
+                timer.callback()
+            except Exception as e:
+                self._failed(timer, e)
+
+    def _task_done(self, timer: Timer, task):
+        if task.cancelled():
+            return
+        e = task.exception()
+        if e is not None:
+            self._failed(timer, e)
+        elif timer.rerun:
+            self.schedule(timer.name, 0)
+        timer.rerun = False
+
+    def _failed(self, timer: Timer, e):
+        timer.errors += 1
+        logger.error(f"{timer.name} - An unexpected exception occurred: {e}")
+        if timer.interval_s is not None:
+            self.schedule(timer.name, max(timer.interval_s, timer.error_backoff_s))
@@ -1,89 +1,381 @@
 """
 Manaage downloading, storing and authorising keys and sounds for each user.
+
+user_data is the key list as downloaded from tidyauth (keyed by 10 digit key string).
+From it an index keyed by integer card id is built so authorising a read is a single
+dict lookup of a compact AccessRecord.
+
+When keys are downloaded the new keys are applied first, updating only the index entries
+for keys that were added, removed or modified. Sound urls for new or changed sounds are
+then looked up concurrently, so access changes aren't held up by them.
+
+If an index_path is given, the index is instead a MappedKeyIndex file (see key_index) and
+user_data is only held in memory while downloaded keys are being applied. The index is
+written after the key cache, and reused at startup if it is newer than the cache, so the
+key list isn't loaded at all then. This saves several MB on low RAM Pis. A Bloom filter of
+the card ids in the mapped index lets most unknown cards be denied without searching it.
+
+Denied cards are remembered for denied_ttl_s (see key_filter.RecentlyDenied) so the same
+unknown card read repeatedly only asks for one key refresh.
+
+The keys are cached on disk with key_cache. Changes are appended to its journal, with a
+full snapshot only when there wasn't a usable cache or the journal needs compacting.
 """
 
 import os
 import json
+import asyncio
 import logging
 
+from doorbot.interfaces import key_cache
+from doorbot.interfaces.key_index import MappedKeyIndex
+from doorbot.interfaces.key_filter import BloomFilter, RecentlyDenied
+from doorbot.interfaces.key_diff import KeyChanges, diff_keys
+
 logger = logging.getLogger(__name__)
 
+# Door unlock times in seconds
+DEFAULT_UNLOCK_TIME_S = 5.0
+DELAYED_UNLOCK_TIME_S = 30.0
+
+# Bit flags for tidyauth groups that change door behaviour
+GROUP_FLAGS = {
+    "delayed": 0x01,
+}
+FLAG_DELAYED = GROUP_FLAGS["delayed"]
+
+# Default number of sound url lookups in flight at once
+DEFAULT_MAX_SOUND_FETCHES = 4
+
+# Default seconds a denied card is remembered for, before it can trigger another key refresh
+DEFAULT_DENIED_TTL_S = 60.0
+
+
+class AccessRecord:
+    """Everything needed to grant access for one key, precomputed from user_data"""
+
+    __slots__ = ("key", "name", "door", "flags", "unlock_time_s", "sound_hash", "sound_path")
+
+    def __init__(self, key, name, door, flags, unlock_time_s, sound_hash=None, sound_path=None):
+        self.key = key
+        self.name = name
+        self.door = door
+        self.flags = flags
+        self.unlock_time_s = unlock_time_s
+        self.sound_hash = sound_hash
+        self.sound_path = sound_path
+
+    @classmethod
+    def from_user(cls, key, user, sound_resolver=None):
+        flags = 0
+        for group in user.get("groups", []):
+            flags |= GROUP_FLAGS.get(group, 0)
+
+        unlock_time_s = DELAYED_UNLOCK_TIME_S if flags & FLAG_DELAYED else DEFAULT_UNLOCK_TIME_S
+
+        sound_hash = user.get("sound")
+        sound_path = None
+        if sound_hash is not None and sound_resolver is not None:
+            sound_path = sound_resolver(sound_hash)
+
+        return cls(key=key, name=user.get("name", "Unknown"), door=user.get("door"), flags=flags,
+                   unlock_time_s=unlock_time_s, sound_hash=sound_hash, sound_path=sound_path)
+
+    def __repr__(self):
+        return (f"AccessRecord(key={self.key!r}, name={self.name!r}, door={self.door}, flags={self.flags}, "
+                f"unlock_time_s={self.unlock_time_s}, sound_hash={self.sound_hash!r}, "
+                f"sound_path={self.sound_path!r})")
+
+
 class UserManager:
-    def __init__(self, api_client, cache_path):
+    def __init__(self, api_client, cache_path, sound_resolver=None, max_sound_fetches=DEFAULT_MAX_SOUND_FETCHES,
+                 journal_max_bytes=key_cache.DEFAULT_JOURNAL_MAX_BYTES, index_path=None,
+                 denied_ttl_s=DEFAULT_DENIED_TTL_S):
+        """
+        sound_resolver is an optional function taking a sound hash and returning the path
+        to the downloaded sound file (or None). Used to fill in AccessRecord.sound_path.
+        max_sound_fetches limits the sound url lookups made at once.
+        journal_max_bytes is the size at which the key cache journal is compacted.
+        index_path, if given, is where to write a memory-mapped index used in place of
+        keeping the keys in memory.
+        denied_ttl_s is how long a denied card is remembered before it can ask for another
+        key refresh.
+        """
         self.api_client = api_client
         self.cache_path = cache_path
+        self.cache = key_cache.KeyCache(cache_path, journal_max_bytes)
+        self.sound_resolver = sound_resolver
+        self.max_sound_fetches = max_sound_fetches
+
+        # Integer card id to AccessRecord, or a MappedKeyIndex that makes them on lookup
+        self.index = {}
+        self.mapped_index = None
+        if index_path is not None:
+            self.mapped_index = MappedKeyIndex(index_path, self._make_record)
+
+        # Bloom filter of the mapped index's card ids
+        self.key_filter = None
+
+        self.recently_denied = RecentlyDenied(denied_ttl_s)
+
+        # Cards denied by the filter, and denied reads that did or didn't ask for a refresh, for stats
+        self.filter_rejections = 0
+        self.denied_refreshes = 0
+        self.denied_suppressed = 0
 
         # Load initial copy of keys from disk in case network is down on startup
-        self.user_data = self._load_keys()
+        self.user_data = None
+        if not self._open_mapped_index():
+            self.user_data = self._load_keys()
+            self._build_index()
 
-        if self.user_data is None or len(self.user_data) == 0:
+        if self.key_count() == 0:
             logger.error("No keys were loaded")
+        self._release_user_data()
+
+    def lookup(self, card_id: int):
+        """Return the AccessRecord for an authorised card id, or None if not authorised"""
+        if self.key_filter is not None and card_id not in self.key_filter:
+            self.filter_rejections += 1
+            return None
+        return self.index.get(card_id)
+
+    def note_denied(self, card_id: int):
+        """
+        Record a denied read. Returns True if the keys should be refreshed in case the card
+        was just added, False if it was already denied recently.
+        """
+        if self.recently_denied.add(card_id):
+            self.denied_refreshes += 1
+            return True
+        self.denied_suppressed += 1
+        return False
 
     def is_key_authorised(self, key):
         """Return True if key is authorised to open the door"""
+        if self.mapped_index is not None:
+            return self.get_user_details(key) is not None
         return self.user_data is not None and key in self.user_data
-    
+
     def key_count(self):
+        if self.mapped_index is not None:
+            return len(self.mapped_index)
         if self.user_data is None:
             return 0
         return len(self.user_data)
-    
+
     def get_user_details(self, key):
+        if self.mapped_index is not None:
+            card_id = self._card_id(key)
+            details = self.mapped_index.get_details(card_id) if card_id is not None else None
+            if details is not None and details[0] == key:
+                return details[1]
+            return None
         if self.user_data is not None and key in self.user_data:
             return self.user_data[key]
         return None
 
-    def get_users_with_custom_sounds(self):
-        # Filter to those with custom sound
+    def get_users_with_custom_sounds(self, keys=None):
+        """Users with a custom sound, optionally only those in keys"""
+        if self.mapped_index is not None:
+            return {key: user for key, user in self.mapped_index.items()
+                    if "sound" in user and (keys is None or key in keys)}
+        if self.user_data is None:
+            return {}
+        if keys is None:
+            keys = self.user_data.keys()
+        users = {}
+        for key in keys:
+            user = self.user_data.get(key)
+            if user is not None and "sound" in user:
+                users[key] = user
+        return users
+
+    def resolve_sounds(self):
+        """Look up sound paths again for index entries that don't have one yet (eg. after downloading)"""
+        if self.sound_resolver is None or self.mapped_index is not None:
+            # Mapped index records are made (and their sound resolved) on each lookup
+            return
+        for record in self.index.values():
+            if record.sound_hash is not None and record.sound_path is None:
+                record.sound_path = self.sound_resolver(record.sound_hash)
+
+    def update_sound(self, sound_hash, path):
+        """Point index entries using a sound at a new file for it, eg. its processed variant"""
+        if self.mapped_index is not None:
+            return
+        for record in self.index.values():
+            if record.sound_hash == sound_hash:
+                record.sound_path = path
+
+    def forget_sound(self, sound_hash):
+        """Clear the sound path of index entries using a sound that has been deleted"""
+        self.update_sound(sound_hash, None)
+
+    def _make_record(self, key, user):
+        return AccessRecord.from_user(key, user, self.sound_resolver)
+
+    def _build_index(self):
+        if self.mapped_index is not None:
+            self._write_mapped_index()
+            return
+        index = {}
         if self.user_data is not None:
-            return {key: user for key, user in self.user_data.items() if "sound" in user}
-        return {}
+            for key, user in self.user_data.items():
+                card_id = self._card_id(key)
+                if card_id is not None:
+                    index[card_id] = AccessRecord.from_user(key, user, self.sound_resolver)
+        self.index = index
+
+    def _update_index(self, changes: KeyChanges):
+        """Update just the index entries for changed keys"""
+        if self.mapped_index is not None:
+            # Rewritten once the keys are saved, see download_keys
+            return
+        for key in changes.removed:
+            card_id = self._card_id(key)
+            if card_id is not None:
+                self.index.pop(card_id, None)
+        for key in changes.added + changes.modified:
+            card_id = self._card_id(key)
+            if card_id is not None:
+                self.index[card_id] = AccessRecord.from_user(key, self.user_data[key], self.sound_resolver)
+
+    def _open_mapped_index(self):
+        """Open an existing mapped index if it was written after the last change to the key cache"""
+        if self.mapped_index is None or not os.path.exists(self.mapped_index.path):
+            return False
+        cache_modified_ns = self.cache.modified_ns()
+        if cache_modified_ns is None or os.stat(self.mapped_index.path).st_mtime_ns <= cache_modified_ns:
+            return False
+        try:
+            self.mapped_index.open()
+        except ValueError as e:
+            logger.warning(f"Rebuilding key index: {e}")
+            return False
+        self.index = self.mapped_index
+        self.key_filter = BloomFilter(self.mapped_index.card_ids())
+        logger.debug(f"Opened index of {len(self.mapped_index)} keys at {self.mapped_index.path}")
+        return True
+
+    def _write_mapped_index(self):
+        users_by_card_id = {}
+        for key, user in (self.user_data or {}).items():
+            card_id = self._card_id(key)
+            if card_id is not None:
+                users_by_card_id[card_id] = (key, user)
+        self.mapped_index.write(users_by_card_id)
+        self.index = self.mapped_index
+        self.key_filter = BloomFilter(users_by_card_id)
 
-    async def download_keys(self):
+    def _current_keys(self):
+        """user_data, loaded from the cache if it was released to save memory"""
+        if self.user_data is None and self.mapped_index is not None:
+            return self._load_keys()
+        return self.user_data
+
+    def _release_user_data(self):
+        """With a mapped index, the keys aren't kept in memory between downloads"""
+        if self.mapped_index is not None:
+            self.user_data = None
+
+    @staticmethod
+    def _card_id(key):
+        try:
+            return int(key)
+        except ValueError:
+            logger.warning(f"Skipping key that isn't a card number: '{key}'")
+            return None
+
+    async def download_keys(self) -> KeyChanges:
         """
         Download keys and populate custom sound info.
-        Returns True if keys changed.
+        Returns the KeyChanges, which is false if nothing changed.
         """
         # Download keys
         new_keys = await self.api_client.get_door_keys()
+        if new_keys is None:
+            return KeyChanges()
 
-        if new_keys is not None:
-            # Iterate through users and fetch sound URLs if sound hash has changed
-            for key, data in new_keys.items():
-                if "sound" in data and "tidyhq" in data:
-                    # Check if sound hash has changed
-                    fetch = True
-                    existing_user_details = self.get_user_details(key)
-                    if existing_user_details is not None and "sound" in existing_user_details:
-                        if existing_user_details["sound"] == data["sound"]:
-                            # Sound hash has not changed, don"t both fetching URL
-                            fetch = False
-                    if fetch:
-                        # Sound hash has changed
-                        sound_data = await self.api_client.get_sound_data(data["tidyhq"])
-                        if sound_data is not None and "url" in sound_data:
-                            data["sound_url"] = sound_data["url"]
-                    else:
-                        data["sound_url"] = existing_user_details["sound_url"]
-            if new_keys != self.user_data:
-                # Keys successfully downloaded and are different, save
-                self.user_data = new_keys
+        old_keys = self._current_keys()
+
+        # Keep sound URLs for sound hashes that haven't changed, the rest are looked up after
+        fetch_keys = []
+        for key, data in new_keys.items():
+            if "sound" in data and "tidyhq" in data:
+                existing_user_details = old_keys.get(key) if old_keys is not None else None
+                if (existing_user_details is not None and existing_user_details.get("sound") == data["sound"]
+                        and "sound_url" in existing_user_details):
+                    data["sound_url"] = existing_user_details["sound_url"]
+                else:
+                    fetch_keys.append(key)
+
+        changes = diff_keys(old_keys, new_keys)
+        self.user_data = old_keys
+        if new_keys != old_keys:
+            # Keys successfully downloaded and are different, apply and save
+            self.user_data = new_keys
+            self._update_index(changes)
+            if old_keys is None:
                 self._save_keys()
+            else:
+                # Every field is saved, not just those compared for KeyChanges
+                upserted = [key for key, user in new_keys.items() if old_keys.get(key) != user]
+                self._save_changes(upserted, changes.removed)
+            if self.mapped_index is not None:
+                # After saving, so the index is newer than the cache at the next startup
+                self._write_mapped_index()
+            if changes.keys_changed:
+                logger.debug(f"Keys changed {changes.summary()}")
+        # Only now that they're saved, so keys that failed to apply aren't seen as unchanged
+        self.api_client.commit_keys_validators()
+
+        if fetch_keys:
+            changes.sounds.update(await self._fetch_sound_urls(fetch_keys))
+            if changes.sounds:
+                self._save_changes(changes.sounds, [])
+                if self.mapped_index is not None:
+                    self._write_mapped_index()
+        self._release_user_data()
+        return changes
+
+    async def _fetch_sound_urls(self, keys):
+        """Look up sound URLs for keys in user_data concurrently. Returns the keys filled in."""
+        semaphore = asyncio.Semaphore(self.max_sound_fetches)
+
+        async def fetch(key):
+            user = self.user_data[key]
+            async with semaphore:
+                sound_data = await self.api_client.get_sound_data(user["tidyhq"])
+            if sound_data is not None and "url" in sound_data:
+                user["sound_url"] = sound_data["url"]
                 return True
-        return False
+            return False
+
+        results = await asyncio.gather(*[fetch(key) for key in keys])
+        filled = [key for key, found in zip(keys, results) if found]
+        logger.debug(f"Looked up {len(filled)} of {len(keys)} sound URLs")
+        return filled
 
     def _load_keys(self):
-        if os.path.exists(self.cache_path):
-            with open(self.cache_path, "r") as file:
-                keys = json.load(file)
-            logger.debug(f"Loaded keys from {self.cache_path}")
-            return keys
-        else:
-            logger.warn(f"No keys file found at {self.cache_path}")
-            return None
+        return self.cache.load()
 
     def _save_keys(self):
-        with open(self.cache_path, "w") as file:
-            json.dump(self.user_data, file, indent=4)
-        logger.debug(f"Saved keys to {self.cache_path}")
+        self.cache.save(self.user_data)
+
+    def _save_changes(self, upserted, deleted):
+        self.cache.append(self.user_data, upserted, deleted)
+
+    def stats(self):
+        return {
+            "keys": self.key_count(),
+            "cache": self.cache.stats(),
+            "filter_rejections": self.filter_rejections,
+            "denied_refreshes": self.denied_refreshes,
+            "denied_suppressed": self.denied_suppressed,
+        }
 
+    def export_json(self, json_path):
+        """Write the current keys to json_path as readable json"""
+        with open(json_path, "w") as file:
+            json.dump(self._current_keys(), file, indent=4)
@@ -50,6 +50,11 @@ class decoder:
 
         self.in_code = False
 
+        # pigpio ticks (microseconds) of the last bit edge and of the timeout that ended
+        # the last code. Used to trace read latency.
+        self.last_edge_tick = None
+        self.code_end_tick = None
+
         self.pi.set_mode(gpio_0, pigpio.INPUT)
         self.pi.set_mode(gpio_1, pigpio.INPUT)
 
@@ -65,6 +70,8 @@ class decoder:
         """
 
         if level < pigpio.TIMEOUT:
+            self.last_edge_tick = tick
+
             if self.in_code == False:
                 self.bits = 1
                 self.num = 0
@@ -99,6 +106,7 @@ class decoder:
                     self.pi.set_watchdog(self.gpio_0, 0)
                     self.pi.set_watchdog(self.gpio_1, 0)
                     self.in_code = False
+                    self.code_end_tick = tick
                     self.callback(self.bits, self.num)
 
     def cancel(self):
@@ -0,0 +1,133 @@
+"""
+Wiegand frame formats, looked up by frame length in bits.
+
+Each format declares its parity checks as bit masks, so checking a frame is a popcount
+per check rather than a loop over the bits. The card id is extracted with a shift and mask.
+
+Bit positions in the format definitions are numbered like the format documents: from 0 at
+the first bit to arrive (the most significant bit of the value from the decoder).
+
+Format references:
+https://github.com/paulo-raca/YetAnotherArduinoWiegandLibrary/blob/master/src/Wiegand.cpp
+https://github.com/RfidResearchGroup/proxmark3/blob/master/client/src/wiegand_formats.c
+"""
+
+EVEN = 0
+ODD = 1
+
+
+def positions_mask(bits, positions):
+    """Mask for the given bit positions (0 is the first bit to arrive) in a frame of bits length"""
+    mask = 0
+    for position in positions:
+        mask |= 1 << (bits - 1 - position)
+    return mask
+
+
+class ParityCheck:
+    """Parity of the bits in mask (which includes the parity bit itself) must be EVEN or ODD"""
+
+    __slots__ = ("parity_position", "mask", "parity")
+
+    def __init__(self, bits, parity_position, covered_positions, parity):
+        self.parity_position = parity_position
+        self.mask = positions_mask(bits, [parity_position, *covered_positions])
+        self.parity = parity
+
+
+class WiegandFormat:
+    __slots__ = ("name", "bits", "parity_checks", "id_shift", "id_mask")
+
+    def __init__(self, name, bits, parity_checks, id_first_position, id_bits):
+        """
+        parity_checks are listed in the order the parity bits are calculated when encoding.
+        The card id is id_bits long, starting at id_first_position.
+        """
+        self.name = name
+        self.bits = bits
+        self.parity_checks = tuple(parity_checks)
+        self.id_shift = bits - id_first_position - id_bits
+        self.id_mask = (1 << id_bits) - 1
+
+    def parity_ok(self, value):
+        for check in self.parity_checks:
+            if (value & check.mask).bit_count() & 1 != check.parity:
+                return False
+        return True
+
+    def card_id(self, value):
+        return (value >> self.id_shift) & self.id_mask
+
+    def encode(self, card_id):
+        """Build a frame with valid parity for card_id (for testing and simulating readers)"""
+        value = (card_id & self.id_mask) << self.id_shift
+        for check in self.parity_checks:
+            if (value & check.mask).bit_count() & 1 != check.parity:
+                value |= 1 << (self.bits - 1 - check.parity_position)
+        return value
+
+    def __repr__(self):
+        return f"WiegandFormat({self.name!r}, bits={self.bits})"
+
+
+def _half_parity_format(name, bits):
+    """
+    Standard formats where the first parity bit is even parity over the leading half of the
+    frame and the last parity bit is odd parity over the trailing half. The card id is
+    everything between the parity bits.
+    """
+    half = bits // 2
+    return WiegandFormat(
+        name=name, bits=bits,
+        parity_checks=[
+            ParityCheck(bits, 0, range(1, half), EVEN),
+            ParityCheck(bits, bits - 1, range(half, bits - 1), ODD),
+        ],
+        id_first_position=1, id_bits=bits - 2)
+
+
+# Corporate 1000 35-bit parity bits cover two out of every three bits
+_C1K35_EVEN_POSITIONS = [p for p in range(2, 34) if p % 3 != 1]
+_C1K35_ODD_POSITIONS = [p for p in range(1, 33) if p % 3 != 0]
+
+# Formats by frame length in bits. Only one format per length.
+FORMATS = {}
+
+
+def register(wiegand_format: WiegandFormat):
+    FORMATS[wiegand_format.bits] = wiegand_format
+
+
+def lookup(bits):
+    """Return the format for a frame length, or None if there isn't one"""
+    return FORMATS.get(bits)
+
+
+# 26-bit H10301 is the 24-bit wiegand data with parity. Its the most widely supported format.
+register(_half_parity_format("H10301", 26))
+
+# 34-bit is 32-bits of data with parity, the same way as 26-bit.
+register(_half_parity_format("34-bit", 34))
+
+# HID Corporate 1000 35-bit. 12-bit company id then 20-bit card number, the card id is both.
+register(WiegandFormat(
+    name="Corporate 1000", bits=35,
+    parity_checks=[
+        ParityCheck(35, 1, _C1K35_EVEN_POSITIONS, EVEN),
+        ParityCheck(35, 34, _C1K35_ODD_POSITIONS, ODD),
+        ParityCheck(35, 0, range(1, 35), ODD),
+    ],
+    id_first_position=2, id_bits=32))
+
+# HID H10304 37-bit. 16-bit facility code then 19-bit card number, the card id is both.
+# Parity halves overlap at position 18.
+register(WiegandFormat(
+    name="H10304", bits=37,
+    parity_checks=[
+        ParityCheck(37, 0, range(1, 19), EVEN),
+        ParityCheck(37, 36, range(18, 36), ODD),
+    ],
+    id_first_position=1, id_bits=35))
+
+# Raw 32-bit NFC card UID, no parity
+register(WiegandFormat(name="NFC UID", bits=32, parity_checks=[], id_first_position=0, id_bits=32))
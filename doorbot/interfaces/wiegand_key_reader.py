@@ -1,68 +1,113 @@
 """
 Class to read both RFID and NFC keys using Doorbot 1.3 hat.
 
-Since the callback is probably coming from another thread, the keys and any error messages
-are stored in global lists. The main application can read these out whenever convenient.
+The callback comes from the pigpio callback thread, so reads are handed over to the
+asyncio loop with call_soon_threadsafe and put on an asyncio queue. The main
+application awaits next_read() and only wakes up when a key or error arrives.
+
+A card held against a reader repeats the same read. Repeats of the same card on the same
+reader within the duplicate window are merged into the first read. The queue is bounded,
+if it fills up the oldest reads are dropped.
 """
 
+import asyncio
+import threading
+import time
+from collections import deque
+
 from doorbot.interfaces import wiegand
+from doorbot.interfaces import wiegand_formats
+from doorbot.interfaces.latency_trace import ReadTrace
 
 singleton_key_reader = None
 
+# Default seconds a repeat read of the same card on the same reader is merged into the first.
+# Each repeat extends the window so a card held against the reader is only read once.
+DEFAULT_DUPLICATE_WINDOW_S = 2.0
 
-def callback(bits, value, reader_type):
-    """Called when a wiegand string is read"""
-    if bits == 26 or bits == 34:
-        # 26-bits is the 24-bit wiegand data with parity. Its the most widely supported format.
-
-        # Parity checking from here:
-        # https://github.com/paulo-raca/YetAnotherArduinoWiegandLibrary/blob/master/src/Wiegand.cpp
-
-        # The trailing half of the bits are odd parity (including parity bit).
-        # Trailing half is what arrives last - the low bits.
-        count_trailing = 0
-        for i in range(0, bits//2):
-            if (value >> i) & 0x01 == 0x01:
-                count_trailing += 1
-        trailing_parity_odd = (count_trailing % 2 == 1)
-
-        # Leading half is even parity (high bits)
-        count_leading = 0
-        for i in range(bits//2, bits):
-            if (value >> i) & 0x01 == 0x01:
-                count_leading += 1
-        leading_parity_even = (count_leading % 2 == 0)
-
-        if trailing_parity_odd and leading_parity_even:
-            # Extract the card value from inner 24-bits (drop first and last parity bits)
-            card_id = (value >> 1) & (2**(bits-2)-1)
-            singleton_key_reader.pending_keys.append(card_id)
-        else:
-            msg = f"ERROR ({reader_type=}): Invalid Parity - {value} (0x{value:0X})"
-            singleton_key_reader.pending_errors.append(msg)
+# Default number of reads held waiting for the app before the oldest are dropped
+DEFAULT_MAX_PENDING = 16
+
+
+class ReadEvent:
+    """A single read from one of the wiegand readers, either a valid key or an error"""
+
+    def __init__(self, reader_type, card_id=None, error=None, trace=None):
+        self.reader_type = reader_type
+        self.card_id = card_id
+        self.error = error
+        self.trace = trace if trace is not None else ReadTrace()
 
+    def is_key(self):
+        return self.card_id is not None
+
+    def __repr__(self):
+        if self.is_key():
+            return f"ReadEvent({self.reader_type}, card_id={self.card_id})"
+        return f"ReadEvent({self.reader_type}, error={self.error!r})"
+
+
+def callback(bits, value, reader_type, decoder=None):
+    """Called when a wiegand string is read"""
+    if decoder is not None:
+        trace = ReadTrace(decoder.last_edge_tick, decoder.code_end_tick)
     else:
+        trace = ReadTrace()
+
+    wiegand_format = wiegand_formats.lookup(bits)
+
+    if wiegand_format is None:
         msg = f"ERROR ({reader_type=}): Unexpected Number Bits - {bits=}, {value=} (0x{value:0X})"
-        singleton_key_reader.pending_errors.append(msg)
+        singleton_key_reader.push(ReadEvent(reader_type, error=msg))
+
+    elif not wiegand_format.parity_ok(value):
+        msg = f"ERROR ({reader_type=}): Invalid Parity ({wiegand_format.name}) - {value} (0x{value:0X})"
+        singleton_key_reader.push(ReadEvent(reader_type, error=msg))
+
+    else:
+        card_id = wiegand_format.card_id(value)
+        singleton_key_reader.push(ReadEvent(reader_type, card_id=card_id, trace=trace))
 
 
 def callback_rfid(bits, value):
-    callback(bits, value, "RFID")
+    callback(bits, value, "RFID", singleton_key_reader.w_rfid)
 
 
 def callback_nfc(bits, value):
-    callback(bits, value, "NFC")
+    callback(bits, value, "NFC", singleton_key_reader.w_nfc)
 
 
 class KeyReader:
-    def __init__(self, pigpio_pi):
+    def __init__(self, pigpio_pi, duplicate_window_s=DEFAULT_DUPLICATE_WINDOW_S,
+                 max_pending=DEFAULT_MAX_PENDING):
         """
-        Sets up decoders for RFID and NFC. When keys are read, keys will get 
-        stored in pending_keys if valid or pending_errors if not.
+        Sets up decoders for RFID and NFC. When keys or errors are read they are
+        queued as ReadEvents. Await next_read() to get them.
+
+        duplicate_window_s: repeats of a card on the same reader within this time are merged.
+        max_pending: reads held before the oldest are dropped.
         """
-        # The callback adds keys to this list. So check here for new key reads.
-        self.pending_keys = []
-        self.pending_errors = []
+        self.duplicate_window_s = duplicate_window_s
+        self.max_pending = max_pending
+
+        # Created before the event loop is running. The queue binds to the loop on first use.
+        self.queue = asyncio.Queue(maxsize=max_pending)
+
+        # Loop the callbacks hand reads over to. Until next_read() is first awaited, reads
+        # are held in _early_reads (eg. a key presented while the app is starting up).
+        self._loop = None
+        self._early_reads = deque(maxlen=max_pending)
+        self._lock = threading.Lock()
+
+        # Last key read by each reader type as (card_id, time.monotonic())
+        self._last_keys = {}
+
+        # Number of times the consumer has been woken by next_read()
+        self.wakeups = 0
+
+        # Reads merged as duplicates and reads dropped because the queue was full
+        self.merged = 0
+        self.dropped = 0
 
         # Set this instance as the singleton for callbacks
         global singleton_key_reader
@@ -71,3 +116,53 @@ class KeyReader:
         self.pi = pigpio_pi
         self.w_rfid = wiegand.decoder(self.pi, 5, 6, callback_rfid)
         self.w_nfc = wiegand.decoder(self.pi, 12, 13, callback_nfc)
+
+    def push(self, event: ReadEvent):
+        """Queue a read. Safe to call from any thread."""
+        with self._lock:
+            if event.is_key() and self._is_duplicate(event):
+                self.merged += 1
+                return
+
+            if self._loop is None:
+                if len(self._early_reads) == self._early_reads.maxlen:
+                    self.dropped += 1
+                self._early_reads.append(event)
+                return
+            loop = self._loop
+        loop.call_soon_threadsafe(self._enqueue, event)
+
+    def _is_duplicate(self, event: ReadEvent):
+        """Whether event repeats the last key read on its reader. Call with _lock held."""
+        now = time.monotonic()
+        last = self._last_keys.get(event.reader_type)
+        self._last_keys[event.reader_type] = (event.card_id, now)
+        return last is not None and last[0] == event.card_id and now - last[1] < self.duplicate_window_s
+
+    def _enqueue(self, event: ReadEvent):
+        """Add to the queue, dropping the oldest read if full. Runs in the event loop."""
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    async def next_read(self) -> ReadEvent:
+        """Wait until a key or error has been read and return it"""
+        if self._loop is None:
+            with self._lock:
+                self._loop = asyncio.get_running_loop()
+                for event in self._early_reads:
+                    self._enqueue(event)
+                self._early_reads.clear()
+
+        event = await self.queue.get()
+        self.wakeups += 1
+        return event
+
+    def stats(self):
+        return {
+            "wakeups": self.wakeups,
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "pending": self.queue.qsize() + len(self._early_reads),
+        }
@@ -11,21 +11,59 @@ The mocking strategy (borrowed from tools/interactive_slack_testing.py):
 3. Test the real implementation with mocked dependencies
 """
 
+import os
 import sys
+import json
 import asyncio
+import logging
+import importlib.util
+from logging.handlers import RotatingFileHandler
 from unittest.mock import Mock
 
+import pytest
+from aiohttp import web
+
+from doorbot.interfaces import key_cache
+from doorbot.interfaces.key_diff import KeyChanges
+from doorbot.interfaces.custom_sound_index import sound_file_name
+
 # ===== MOCK HARDWARE CLASSES =====
 
 class MockPigpio:
+    # Same values as the real pigpio module so interface code can be imported
+    INPUT = 0
+    OUTPUT = 1
+    PUD_UP = 2
+    FALLING_EDGE = 1
+    TIMEOUT = 2
+
     def pi(self):
         return MockPi()
 
+class MockCallback:
+    def __init__(self, gpio, edge, func):
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+    def cancel(self):
+        pass
+
 class MockPi:
     def __init__(self):
         self.connected = True
+        self.callbacks = []
     def stop(self):
         pass
+    def set_mode(self, gpio, mode):
+        pass
+    def set_pull_up_down(self, gpio, pud):
+        pass
+    def set_watchdog(self, gpio, timeout):
+        pass
+    def callback(self, gpio, edge, func):
+        cb = MockCallback(gpio, edge, func)
+        self.callbacks.append(cb)
+        return cb
 
 class MockDoorbotHatGpio:
     def __init__(self, pi):
@@ -36,8 +74,12 @@ class MockDoorbotHatGpio:
         return {0: False, 1: False}
 
 class MockKeyReader:
-    def __init__(self, pi):
-        pass
+    def __init__(self, pi, **kwargs):
+        self.queue = asyncio.Queue()
+    async def next_read(self):
+        return await self.queue.get()
+    def stats(self):
+        return {}
     def start_reading(self):
         pass
     def stop_reading(self):
@@ -52,41 +94,63 @@ class MockBlinkstickInterface:
         self.set_colour_name("white")
 
 class MockTidyAuthClient:
-    def __init__(self, base_url, token):
+    def __init__(self, base_url, token, **kwargs):
+        pass
+    async def close(self):
         pass
+    def stats(self):
+        return {}
 
 class MockUserManager:
-    def __init__(self, api_client, cache_path):
+    def __init__(self, api_client, cache_path, sound_resolver=None, **kwargs):
+        self.user_data = {}
+        self.index = {}
+    def lookup(self, card_id):
+        return self.index.get(card_id)
+    def is_key_authorised(self, key):
+        return key in self.user_data
+    def get_user_details(self, key):
+        return self.user_data.get(key)
+    def resolve_sounds(self):
         pass
     async def download_keys(self):
+        return KeyChanges()
+    def note_denied(self, card_id):
         return True
+    def update_sound(self, sound_hash, path):
+        pass
+    def forget_sound(self, sound_hash):
+        pass
     def key_count(self):
         return 42
+    def stats(self):
+        return {}
 
 class MockSoundDownloader:
-    def __init__(self, users_with_custom_sounds, download_directory):
-        pass
-    def download_next_sound(self):
-        return False
+    def __init__(self, users_with_custom_sounds, download_directory, on_download=None, **kwargs):
+        self.failed_hashes = set()
+    async def download_all(self):
+        return {"downloaded": 0, "skipped": 0, "resumed": 0, "failed": 0, "bytes_received": 0}
 
 class MockSoundPlayer:
     def __init__(self, sound_dir, custom_sound_dir):
         pass
     def play_sound(self, sound_name):
         pass
-
-class MockMonotonicWaiter:
-    def __init__(self, name):
-        self.name = name
-        self._duration = 0
-    def set_wait_time(self, duration_s):
-        self._duration = duration_s
-    async def wait(self):
-        if self._duration > 0:
-            self._duration = 0
-            return True
-        await asyncio.sleep(0.1)
-        return False
+    def play_access_granted_or_custom(self, user):
+        pass
+    def play_access_granted_for(self, record):
+        pass
+    def find_sound_by_hash(self, sound_hash):
+        return None
+    def custom_sound_downloaded(self, sound_hash, path):
+        pass
+    def custom_sound_removed(self, sound_hash, path):
+        pass
+    def play_denied(self):
+        pass
+    def stats(self):
+        return {}
 
 class MockTextToSpeech:
     def non_blocking_speak(self, text):
@@ -115,9 +179,151 @@ def setup_hardware_mocks():
     sys.modules['doorbot.interfaces.user_manager'] = Mock(UserManager=MockUserManager)
     sys.modules['doorbot.interfaces.sound_downloader'] = Mock(SoundDownloader=MockSoundDownloader)
     sys.modules['doorbot.interfaces.sound_player'] = Mock(SoundPlayer=MockSoundPlayer)
-    sys.modules['doorbot.interfaces.monotonic_waiter'] = Mock(MonotonicWaiter=MockMonotonicWaiter)
     sys.modules['doorbot.interfaces.text_to_speech'] = mock_tts_module
 
 # Install the mocks immediately when this module is imported
 # This ensures they're in place before any test file imports doorbot.app
 setup_hardware_mocks()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def log_to_tmp(tmp_path_factory):
+    """
+    Move the log file doorbot.app opens on import (log_path in config.json) to a temporary
+    directory, so test runs and benchmarks don't fill up the real log.
+    """
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        if isinstance(handler, RotatingFileHandler):
+            tmp_handler = RotatingFileHandler(str(tmp_path_factory.mktemp("logs") / "doorbot.log"),
+                                              maxBytes=handler.maxBytes, backupCount=handler.backupCount)
+            tmp_handler.setLevel(handler.level)
+            tmp_handler.setFormatter(handler.formatter)
+            root_logger.removeHandler(handler)
+            handler.close()
+            root_logger.addHandler(tmp_handler)
+    yield
+
+
+# ===== REAL INTERFACE LOADING =====
+
+def import_real_interface(module_name):
+    """
+    Load the real doorbot.interfaces module, bypassing the mock installed in sys.modules.
+
+    The module is not registered in sys.modules so doorbot.app still gets the mock.
+    """
+    path = os.path.join(os.path.dirname(__file__), '..', 'interfaces', f'{module_name}.py')
+    spec = importlib.util.spec_from_file_location(f'doorbot.interfaces.{module_name}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# ===== LOCAL HTTP STUB SERVERS =====
+
+@pytest.fixture
+async def stub_server():
+    """
+    Start local aiohttp servers for a test.
+
+    Call with an aiohttp web.Application, returns the base url. Servers are shut down
+    at the end of the test.
+    """
+    runners = []
+
+    async def start(web_app):
+        runner = web.AppRunner(web_app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        runners.append(runner)
+        port = runner.addresses[0][1]
+        return f"http://127.0.0.1:{port}"
+
+    yield start
+
+    for runner in runners:
+        await runner.cleanup()
+
+
+# ===== SHARED TEST DATA =====
+
+# Door keys as returned by TidyAuth
+USERS = {
+    "0123456789": {
+        "door": 3,
+        "groups": [],
+        "name": "Gentleman",
+        "sound": "cd3d9dd904aca51abc55dbe7b7cc7b28",
+        "tidyhq": 4321,
+        "sound_url": "https://example.com/gadget_whoo.mp3",
+    },
+    "0000000042": {
+        "door": 1,
+        "groups": ["delayed"],
+        "name": "Lady",
+        "tidyhq": 1234,
+    },
+}
+
+
+def many_users(count):
+    """Door keys for count members, a third with custom sounds, for benchmarks"""
+    keys = {}
+    for i in range(count):
+        user = {"door": 1, "groups": ["delayed"] if i % 10 == 0 else [], "name": f"Member Number {i}",
+                "tidyhq": 100000 + i}
+        if i % 3 == 0:
+            user["sound"] = f"{i:032x}"
+            user["sound_url"] = f"https://tidyhq-sounds.s3.amazonaws.com/sounds/{i:032x}.mp3"
+        keys[f"{i:0>10}"] = user
+    return keys
+
+
+class FakeApiClient:
+    """Stands in for TidyAuthClient in UserManager tests, recording sound lookups"""
+
+    def __init__(self, keys=None, sounds=None, sound_delay_s=0.0):
+        self.keys = keys
+        self.sounds = sounds or {}
+        self.sound_delay_s = sound_delay_s
+        self.sound_requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        # Called with the tidyhq id at the start of each sound lookup
+        self.on_sound_request = None
+
+    async def get_door_keys(self):
+        return json.loads(json.dumps(self.keys)) if self.keys is not None else None
+
+    def commit_keys_validators(self):
+        pass
+
+    async def get_sound_data(self, tidyhq_id):
+        self.sound_requests.append(tidyhq_id)
+        if self.on_sound_request is not None:
+            self.on_sound_request(tidyhq_id)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.sound_delay_s)
+        finally:
+            self.in_flight -= 1
+        return self.sounds.get(tidyhq_id)
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    """Key cache file holding USERS"""
+    path = str(tmp_path / "user_cache.json")
+    key_cache.save(path, USERS)
+    return path
+
+
+def write_sound(directory, name, sound_hash, data=b"ID3"):
+    """Write a downloaded custom sound file into directory, returns its path"""
+    path = directory / sound_file_name(name, sound_hash)
+    path.write_bytes(data)
+    return str(path)
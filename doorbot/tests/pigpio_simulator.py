@@ -0,0 +1,188 @@
+"""
+Simulated pigpio pi for replaying wiegand edge streams into the decoders.
+
+Edges are (gpio, level, tick) tuples like pigpio passes to callbacks, with ticks in
+microseconds. Between edges the simulated clock is advanced and any watchdogs that expire
+are fired with level TIMEOUT, the same as pigpio does when a gpio has no level change for
+the watchdog time. That is what ends a code in wiegand.decoder.
+
+Streams can be synthesised with frame_edges() or loaded from a recording with
+read_edge_file(), which takes one "gpio,level,tick" per line.
+"""
+
+# Same values as the real pigpio module
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+TIMEOUT = 2
+
+TICK_WRAP = 1 << 32
+
+# Typical wiegand reader timing
+PULSE_US = 50
+INTERVAL_US = 2000
+
+
+class SimulatedCallback:
+    def __init__(self, pi, gpio, edge, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+
+    def wants(self, gpio, level):
+        if gpio != self.gpio:
+            return False
+        if level == TIMEOUT or self.edge == EITHER_EDGE:
+            return True
+        return (self.edge == FALLING_EDGE) == (level == 0)
+
+    def cancel(self):
+        if self in self.pi.callbacks:
+            self.pi.callbacks.remove(self)
+
+
+class SimulatedPi:
+    def __init__(self):
+        self.connected = True
+        self.callbacks = []
+
+        # Simulated time in microseconds, not wrapped (callbacks get it wrapped to 32 bits)
+        self.tick = 0
+
+        # (wrapped, unwrapped) tick of the last replayed edge
+        self._last_edge = None
+
+        # gpio to watchdog timeout in ms, and the tick the watchdog is counting from
+        self.watchdogs = {}
+        self.watchdog_start = {}
+
+        # Number of watchdog timeouts fired
+        self.timeouts_fired = 0
+
+    def stop(self):
+        pass
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def set_pull_up_down(self, gpio, pud):
+        pass
+
+    def get_current_tick(self):
+        return self.tick % TICK_WRAP
+
+    def callback(self, gpio, edge, func):
+        cb = SimulatedCallback(self, gpio, edge, func)
+        self.callbacks.append(cb)
+        return cb
+
+    def set_watchdog(self, gpio, timeout_ms):
+        if timeout_ms == 0:
+            self.watchdogs.pop(gpio, None)
+            self.watchdog_start.pop(gpio, None)
+        else:
+            self.watchdogs[gpio] = timeout_ms
+            self.watchdog_start[gpio] = self.tick
+
+    def replay(self, edges, flush=True):
+        """
+        Deliver edges in order, firing watchdog timeouts due in between. Ticks may be 32-bit
+        wrapped (as recorded from pigpio) or unwrapped. If flush, remaining watchdogs are run
+        out afterwards so the last code completes.
+        """
+        for gpio, level, tick in edges:
+            self.advance_to(self._unwrap(tick))
+            if gpio in self.watchdog_start:
+                # Any level change restarts the watchdog
+                self.watchdog_start[gpio] = self.tick
+            self._deliver(gpio, level)
+        if flush:
+            self.flush()
+
+    def advance_to(self, tick):
+        """Move the simulated clock forward to tick, firing any watchdogs that expire on the way"""
+        while True:
+            due = self._next_watchdog()
+            if due is None or due[1] > tick:
+                break
+            gpio, deadline = due
+            self.tick = deadline
+            # pigpio repeats the timeout every watchdog period until it is cancelled
+            self.watchdog_start[gpio] = deadline
+            self.timeouts_fired += 1
+            self._deliver(gpio, TIMEOUT)
+        self.tick = max(self.tick, tick)
+
+    def flush(self, max_timeouts=16):
+        """Fire watchdogs until none are left (or max_timeouts have fired)"""
+        for _ in range(max_timeouts):
+            due = self._next_watchdog()
+            if due is None:
+                return
+            self.advance_to(due[1])
+
+    def _next_watchdog(self):
+        """Return (gpio, deadline tick) of the next watchdog to expire, or None"""
+        due = None
+        for gpio, timeout_ms in self.watchdogs.items():
+            deadline = self.watchdog_start[gpio] + timeout_ms * 1000
+            if due is None or deadline < due[1]:
+                due = (gpio, deadline)
+        return due
+
+    def _deliver(self, gpio, level):
+        for cb in list(self.callbacks):
+            if cb.wants(gpio, level):
+                cb.func(gpio, level, self.tick % TICK_WRAP)
+
+    def _unwrap(self, tick):
+        """Turn a possibly 32-bit wrapped tick into the unwrapped simulated clock"""
+        if tick >= TICK_WRAP:
+            return tick
+        if self._last_edge is None:
+            unwrapped = self.tick - self.tick % TICK_WRAP + tick
+            if unwrapped < self.tick:
+                unwrapped += TICK_WRAP
+        else:
+            last_wrapped, last_unwrapped = self._last_edge
+            unwrapped = last_unwrapped + (tick - last_wrapped) % TICK_WRAP
+        self._last_edge = (tick, unwrapped)
+        return unwrapped
+
+
+def frame_edges(bits, value, gpio_0, gpio_1, start_tick, pulse_us=PULSE_US, interval_us=INTERVAL_US):
+    """
+    Edges for one wiegand frame, most significant bit first. Each bit is a low pulse on
+    gpio_0 for a 0 or gpio_1 for a 1.
+    """
+    edges = []
+    tick = start_tick
+    for i in range(bits - 1, -1, -1):
+        gpio = gpio_1 if (value >> i) & 1 else gpio_0
+        edges.append((gpio, 0, tick))
+        edges.append((gpio, 1, tick + pulse_us))
+        tick += interval_us
+    return edges
+
+
+def frames_edges(frames, gpio_0, gpio_1, start_tick=0, gap_us=20000, interval_us=INTERVAL_US):
+    """Edges for several (bits, value) frames, gap_us from the last bit of one to the first of the next"""
+    edges = []
+    tick = start_tick
+    for bits, value in frames:
+        edges.extend(frame_edges(bits, value, gpio_0, gpio_1, tick, interval_us=interval_us))
+        tick += (bits - 1) * interval_us + gap_us
+    return edges
+
+
+def read_edge_file(path):
+    """Load a recorded edge stream, one "gpio,level,tick" per line. Blank lines and # comments skipped."""
+    edges = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                gpio, level, tick = (int(part) for part in line.split(","))
+                edges.append((gpio, level, tick))
+    return edges
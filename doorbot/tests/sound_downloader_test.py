@@ -1,7 +1,7 @@
 from doorbot.interfaces.sound_downloader import SoundDownloader
 from doorbot.interfaces.tidyauth_client import TidyAuthClient
 from doorbot.interfaces.user_manager import UserManager
-import time
+import asyncio
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
@@ -17,6 +17,4 @@ print(f"Got {len(users)} with sounds")
 sound_downloader = SoundDownloader(users_with_custom_sounds=users, download_directory=download_directory)
 
 # Download the sound files
-while sound_downloader.download_next_sound():
-    print("got another!")
-    time.sleep(0.01)
+print(asyncio.run(sound_downloader.download_all()))
@@ -0,0 +1,68 @@
+"""
+Stub sound file server for testing SoundDownloader against a real HTTP server.
+
+Serve StubSoundServer.app() with the stub_server fixture from conftest.py. Sounds are
+served from /sounds/{name} with Range support, and faults can be injected per sound.
+"""
+
+import asyncio
+
+from aiohttp import web
+
+
+class StubSoundServer:
+    def __init__(self, sounds=None, content_type="audio/mpeg", delay_s=0.0):
+        """sounds: file contents by name"""
+        self.sounds = sounds if sounds is not None else {}
+        self.content_type = content_type
+        self.delay_s = delay_s
+
+        # Names whose response is cut off after this many bytes (once each)
+        self.drop_after = {}
+
+        # Ignore Range headers and always send the whole file
+        self.ignore_range = False
+
+        # (name, Range header) of each request
+        self.requests = []
+
+    def app(self):
+        web_app = web.Application()
+        web_app.router.add_get('/sounds/{name}', self.handle_sound)
+        return web_app
+
+    def url(self, base_url, name):
+        return f"{base_url}/sounds/{name}"
+
+    async def handle_sound(self, request):
+        name = request.match_info["name"]
+        range_header = request.headers.get("Range")
+        self.requests.append((name, range_header))
+        if self.delay_s:
+            await asyncio.sleep(self.delay_s)
+        if name not in self.sounds:
+            return web.Response(status=404)
+
+        body = self.sounds[name]
+        start = 0
+        status = 200
+        headers = {"Content-Type": self.content_type}
+        if range_header is not None and not self.ignore_range:
+            start = int(range_header.removeprefix("bytes=").rstrip("-"))
+            if start >= len(body):
+                return web.Response(status=416, headers={"Content-Range": f"bytes */{len(body)}"})
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{len(body) - 1}/{len(body)}"
+        headers["Content-Length"] = str(len(body) - start)
+
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        drop_after = self.drop_after.pop(name, None)
+        if drop_after is not None:
+            await response.write(body[start:start + drop_after])
+            # Cut the connection mid body
+            request.transport.close()
+            return response
+        await response.write(body[start:])
+        await response.write_eof()
+        return response
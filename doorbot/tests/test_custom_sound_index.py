@@ -0,0 +1,111 @@
+"""
+Tests for the custom sound index used by SoundPlayer to find sounds by hash.
+"""
+
+import os
+
+from doorbot.interfaces.custom_sound_index import (
+    CustomSoundIndex, sound_file_name, sound_hash_from_file_name, processed_path)
+from doorbot.tests.conftest import import_real_interface, write_sound
+from doorbot.tests.sound_stub import StubSoundServer
+
+sound_downloader = import_real_interface('sound_downloader')
+
+HASH_A = "cd3d9dd904aca51abc55dbe7b7cc7b28"
+HASH_B = "0123456789abcdef0123456789abcdef"
+
+
+def touch_directory(directory):
+    """Make sure the directory mtime moves even on filesystems with coarse timestamps"""
+    stat = os.stat(directory)
+    os.utime(directory, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+class TestCustomSoundIndex:
+
+    def test_file_names(self):
+        assert sound_file_name("gadget_whoo", HASH_A) == f"gadget_whoo_{HASH_A}.mp3"
+        assert sound_hash_from_file_name(f"gadget_whoo_{HASH_A}.mp3") == HASH_A
+        assert sound_hash_from_file_name("granted.mp3") is None
+        assert sound_hash_from_file_name(f"gadget_{HASH_A}.wav") == HASH_A
+        assert sound_hash_from_file_name(f"gadget_{HASH_A}.ogg") is None
+        assert processed_path(f"/sounds/gadget_{HASH_A}.mp3") == f"/sounds/gadget_{HASH_A}.wav"
+
+    def test_built_from_directory(self, tmp_path):
+        path = write_sound(tmp_path, "gadget_whoo", HASH_A)
+        (tmp_path / "notes.txt").write_text("not a sound")
+
+        index = CustomSoundIndex(str(tmp_path))
+
+        assert index.find(HASH_A) == path
+        assert index.find(HASH_B) is None
+        assert len(index) == 1
+
+    def test_prefers_processed_variant(self, tmp_path):
+        processed = processed_path(write_sound(tmp_path, "gadget_whoo", HASH_A))
+        open(processed, "wb").close()
+
+        index = CustomSoundIndex(str(tmp_path))
+
+        assert index.find(HASH_A) == processed
+        assert len(index) == 1
+
+    def test_find_does_not_rescan_unchanged_directory(self, tmp_path):
+        write_sound(tmp_path, "gadget_whoo", HASH_A)
+        index = CustomSoundIndex(str(tmp_path))
+
+        for _ in range(100):
+            index.find(HASH_A)
+            index.find(HASH_B)
+
+        assert index.scans == 1
+
+    def test_add_is_incremental(self, tmp_path):
+        index = CustomSoundIndex(str(tmp_path))
+        path = write_sound(tmp_path, "new", HASH_B)
+        index.add(HASH_B, path)
+
+        assert index.find(HASH_B) == path
+        assert index.scans == 1
+
+    def test_external_changes_are_picked_up(self, tmp_path):
+        index = CustomSoundIndex(str(tmp_path))
+        path = write_sound(tmp_path, "copied_in", HASH_A)
+        touch_directory(tmp_path)
+
+        assert index.find(HASH_A) == path
+        assert index.scans == 2
+
+        os.remove(path)
+        touch_directory(tmp_path)
+        assert index.find(HASH_A) is None
+
+    def test_remove(self, tmp_path):
+        path = write_sound(tmp_path, "gadget_whoo", HASH_A)
+        index = CustomSoundIndex(str(tmp_path))
+        os.remove(path)
+        index.remove(HASH_A)
+
+        assert index.find(HASH_A) is None
+        assert index.scans == 1
+
+    def test_missing_directory(self, tmp_path):
+        index = CustomSoundIndex(str(tmp_path / "missing"))
+        assert index.find(HASH_A) is None
+
+        (tmp_path / "missing").mkdir()
+        path = write_sound(tmp_path / "missing", "late", HASH_A)
+        assert index.find(HASH_A) == path
+
+    async def test_downloader_updates_index(self, tmp_path, stub_server):
+        stub = StubSoundServer({"gadget_whoo.mp3": b"ID3"})
+        base_url = await stub_server(stub.app())
+        download_dir = tmp_path / "custom_sounds"
+        index = CustomSoundIndex(str(download_dir))
+
+        users = {"0123456789": {"sound": HASH_A, "sound_url": stub.url(base_url, "gadget_whoo.mp3")}}
+        downloader = sound_downloader.SoundDownloader(users, str(download_dir), on_download=index.add)
+        await downloader.download_all()
+
+        assert index.find(HASH_A) == str(download_dir / sound_file_name("gadget_whoo", HASH_A))
+        assert index.scans == 1
@@ -0,0 +1,150 @@
+"""
+Tests for the pooled home assistant client against a local stub server.
+"""
+
+import asyncio
+import time
+import statistics
+
+import pytest
+import requests
+from aiohttp import web
+
+from doorbot.interfaces.home_assistant_client import HomeAssistantClient
+
+
+class StubHomeAssistant:
+    """Records requests and the client connections they arrived on"""
+
+    def __init__(self, delay_s=0.0):
+        self.delay_s = delay_s
+        self.requests = []
+        self.connections = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def app(self):
+        web_app = web.Application()
+        web_app.router.add_put('/api/webhook/{hook}', self.handle_webhook)
+        web_app.router.add_post('/api/states/{entity}', self.handle_state)
+        return web_app
+
+    async def _record(self, request):
+        self.connections.add(request.transport.get_extra_info('peername'))
+        self.requests.append((request.method, request.path, request.headers.get('Authorization'),
+                              await request.json()))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay_s)
+        finally:
+            self.in_flight -= 1
+
+    async def handle_webhook(self, request):
+        await self._record(request)
+        return web.Response(status=200)
+
+    async def handle_state(self, request):
+        await self._record(request)
+        body = await request.json()
+        return web.json_response({"entity_id": request.match_info['entity'], **body}, status=201)
+
+
+@pytest.fixture
+async def client():
+    ha = HomeAssistantClient(token="secret", max_concurrent=2)
+    yield ha
+    await ha.close()
+
+
+class TestHomeAssistantClient:
+
+    async def test_call_webhook(self, stub_server, client):
+        stub = StubHomeAssistant()
+        base_url = await stub_server(stub.app())
+
+        assert await client.call_webhook(f"{base_url}/api/webhook/abc", {"ts": "1.2"})
+        assert stub.requests == [("PUT", "/api/webhook/abc", None, {"ts": "1.2"})]
+
+    async def test_set_state(self, stub_server, client):
+        stub = StubHomeAssistant()
+        base_url = await stub_server(stub.app())
+
+        result = await client.set_state(f"{base_url}/api/states/binary_sensor.front_door",
+                                        state="on", attributes={"device_class": "door"})
+
+        assert result["state"] == "on"
+        method, path, auth, body = stub.requests[0]
+        assert auth == "Bearer secret"
+        assert body == {"state": "on", "attributes": {"device_class": "door"}}
+
+    async def test_connection_is_reused(self, stub_server, client):
+        stub = StubHomeAssistant()
+        base_url = await stub_server(stub.app())
+
+        for i in range(10):
+            assert await client.call_webhook(f"{base_url}/api/webhook/abc", {"ts": str(i)})
+
+        assert len(stub.requests) == 10
+        assert len(stub.connections) == 1
+
+    async def test_timeout_per_call(self, stub_server, client):
+        stub = StubHomeAssistant(delay_s=0.5)
+        base_url = await stub_server(stub.app())
+
+        start = time.monotonic()
+        assert not await client.call_webhook(f"{base_url}/api/webhook/abc", {}, timeout_s=0.05)
+        assert time.monotonic() - start < 0.4
+
+    async def test_concurrency_is_bounded(self, stub_server, client):
+        stub = StubHomeAssistant(delay_s=0.05)
+        base_url = await stub_server(stub.app())
+
+        results = await asyncio.gather(*[
+            client.call_webhook(f"{base_url}/api/webhook/abc", {"ts": str(i)}) for i in range(8)])
+
+        assert all(results)
+        assert stub.max_in_flight == 2
+
+    async def test_unreachable_server_returns_failure(self, client):
+        assert not await client.call_webhook("http://127.0.0.1:1/api/webhook/abc", {}, timeout_s=0.5)
+        assert await client.set_state("http://127.0.0.1:1/api/states/x", state="on", timeout_s=0.5) is None
+
+
+@pytest.mark.slow
+class TestHomeAssistantClientBenchmark:
+
+    CALLS = 200
+
+    async def test_latency_pooled_vs_requests(self, stub_server, client):
+        """Compare per call latency of the pooled client against a fresh requests call each time"""
+        stub = StubHomeAssistant()
+        base_url = await stub_server(stub.app())
+        url = f"{base_url}/api/webhook/abc"
+
+        pooled = []
+        for i in range(self.CALLS):
+            start = time.perf_counter()
+            await client.call_webhook(url, {"ts": str(i)})
+            pooled.append(time.perf_counter() - start)
+
+        def requests_put():
+            start = time.perf_counter()
+            requests.put(url, json={"ts": "0"}, timeout=1)
+            return time.perf_counter() - start
+
+        unpooled = []
+        for _ in range(self.CALLS):
+            # Run in a thread as the stub server needs the event loop to answer
+            unpooled.append(await asyncio.to_thread(requests_put))
+
+        def summary(samples):
+            samples = sorted(samples)
+            p95 = samples[int(len(samples) * 0.95)]
+            return f"median {statistics.median(samples) * 1000:.2f} ms, p95 {p95 * 1000:.2f} ms"
+
+        print(f"\nHomeAssistantClient (pooled): {summary(pooled)}")
+        print(f"requests (new connection):   {summary(unpooled)}")
+
+        # Pooled client used one connection for all its calls, requests used one per call
+        assert len(stub.connections) == 1 + self.CALLS
@@ -0,0 +1,234 @@
+"""
+Tests for the atomic, checksummed door key cache and its change journal, with load and save
+benchmarks for 10k users.
+"""
+
+import json
+import os
+import time
+
+import pytest
+
+from doorbot.interfaces import key_cache
+from doorbot.interfaces.key_cache import KeyCache
+from doorbot.tests.conftest import import_real_interface, many_users, FakeApiClient, USERS
+
+UserManager = import_real_interface('user_manager').UserManager
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "user_cache.json")
+
+
+class TestKeyCache:
+
+    def test_round_trip(self, path):
+        key_cache.save(path, USERS)
+
+        assert key_cache.load(path) == USERS
+        with open(path, "rb") as file:
+            assert file.read(4) == key_cache.MAGIC
+
+    def test_missing(self, path):
+        assert key_cache.load(path) is None
+
+    def test_legacy_json_loaded(self, path):
+        with open(path, "w") as file:
+            json.dump(USERS, file, indent=4)
+
+        assert key_cache.load(path) == USERS
+
+    @pytest.mark.parametrize("damage", ["flip", "truncate", "header"])
+    def test_corrupt_cache_ignored(self, path, damage, caplog):
+        key_cache.save(path, USERS)
+        with open(path, "rb") as file:
+            data = bytearray(file.read())
+        if damage == "flip":
+            data[-5] ^= 0xff
+        elif damage == "truncate":
+            data = data[:len(data) // 2]
+        else:
+            data = data[:6]
+        with open(path, "wb") as file:
+            file.write(data)
+
+        assert key_cache.load(path) is None
+        assert "corrupt" in caplog.text
+
+    def test_failed_save_keeps_old_cache(self, path, monkeypatch):
+        key_cache.save(path, USERS)
+
+        def power_cut(src, dst):
+            raise OSError("power cut")
+
+        monkeypatch.setattr(key_cache.os, "replace", power_cut)
+        with pytest.raises(OSError):
+            key_cache.save(path, {"0000000001": {"name": "New"}})
+
+        assert key_cache.load(path) == USERS
+        assert not os.path.exists(f"{path}.tmp")
+
+    def test_export_json(self, path, tmp_path):
+        key_cache.save(path, USERS)
+        json_path = str(tmp_path / "keys.json")
+
+        key_cache.export_json(path, json_path)
+
+        with open(json_path) as file:
+            assert json.load(file) == USERS
+
+    def test_user_manager_uses_cache(self, path, tmp_path):
+        with open(path, "w") as file:
+            json.dump(USERS, file)
+        manager = UserManager(api_client=None, cache_path=path)
+        manager._save_keys()
+
+        assert key_cache.load(path) == USERS
+        assert UserManager(api_client=None, cache_path=path).lookup(42).name == "Lady"
+
+        manager.export_json(str(tmp_path / "keys.json"))
+        with open(tmp_path / "keys.json") as file:
+            assert json.load(file) == USERS
+
+
+class TestKeyJournal:
+
+    def test_changes_replayed(self, path):
+        cache = KeyCache(path)
+        keys = json.loads(json.dumps(USERS))
+        cache.save(keys)
+
+        keys["0000000042"]["door"] = 2
+        cache.append(keys, ["0000000042"], [])
+        keys["0000000007"] = {"name": "New"}
+        del keys["0123456789"]
+        cache.append(keys, ["0000000007"], ["0123456789"])
+
+        assert KeyCache(path).load() == keys
+        assert cache.stats()["snapshots"] == 1
+        assert cache.stats()["journal_appends"] == 2
+
+    def test_first_save_is_snapshot(self, path):
+        cache = KeyCache(path)
+        cache.append(USERS, list(USERS), [])
+
+        assert not os.path.exists(cache.journal_path)
+        assert key_cache.load(path) == USERS
+
+    def test_torn_record_dropped(self, path):
+        cache = KeyCache(path)
+        keys = dict(USERS)
+        cache.save(keys)
+        keys["0000000001"] = {"name": "One"}
+        cache.append(keys, ["0000000001"], [])
+        good_size = os.path.getsize(cache.journal_path)
+        with open(cache.journal_path, "ab") as file:
+            file.write(key_cache.encode_record({"0000000002": {"name": "Two"}}, [])[:-3])
+
+        reloaded = KeyCache(path)
+        assert reloaded.load() == keys
+        assert os.path.getsize(cache.journal_path) == good_size
+
+        # Later appends aren't lost behind the torn record
+        keys["0000000003"] = {"name": "Three"}
+        reloaded.append(keys, ["0000000003"], [])
+        assert KeyCache(path).load() == keys
+
+    def test_compacted_past_threshold(self, path):
+        cache = KeyCache(path, journal_max_bytes=200)
+        keys = dict(USERS)
+        cache.save(keys)
+        for i in range(10):
+            keys[f"{i:0>10}"] = {"name": f"User {i}"}
+            cache.append(keys, [f"{i:0>10}"], [])
+
+        assert cache.stats()["snapshots"] > 1
+        assert cache.journal_bytes < 200 + 100
+        assert KeyCache(path).load() == keys
+
+    def test_journal_without_snapshot_ignored(self, path):
+        cache = KeyCache(path)
+        cache.save(USERS)
+        cache.append(USERS, ["0000000042"], [])
+        os.remove(path)
+
+        assert KeyCache(path).load() is None
+
+    async def test_download_journals_changes(self, path):
+        key_cache.save(path, USERS)
+        keys = json.loads(json.dumps(USERS))
+        keys["0000000042"]["tidyhq"] = 999
+        keys["0000000007"] = {"door": 1, "groups": [], "name": "New", "tidyhq": 7}
+        manager = UserManager(FakeApiClient(keys), path)
+        snapshot_mtime = os.stat(path).st_mtime_ns
+
+        assert await manager.download_keys()
+
+        assert os.stat(path).st_mtime_ns == snapshot_mtime
+        assert manager.stats()["cache"]["journal_appends"] == 1
+        assert UserManager(FakeApiClient(keys), path).user_data == keys
+
+
+@pytest.mark.slow
+class TestKeyCacheBenchmark:
+
+    USERS = 10000
+    RUNS = 5
+
+    def best_of(self, func):
+        times = []
+        for _ in range(self.RUNS):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def test_load_and_save_10k_users(self, tmp_path):
+        keys = many_users(self.USERS)
+        cache_path = str(tmp_path / "user_cache.bin")
+        json_path = str(tmp_path / "user_cache.json")
+
+        def save_json():
+            with open(json_path, "w") as file:
+                json.dump(keys, file, indent=4)
+
+        def load_json():
+            with open(json_path) as file:
+                return json.load(file)
+
+        save_json_s = self.best_of(save_json)
+        save_cache_s = self.best_of(lambda: key_cache.save(cache_path, keys))
+        load_json_s = self.best_of(load_json)
+        load_cache_s = self.best_of(lambda: key_cache.load(cache_path))
+
+        json_size = os.path.getsize(json_path)
+        cache_size = os.path.getsize(cache_path)
+        print(f"\n{self.USERS} users: indented json {json_size / 1024:.0f} KiB, "
+              f"save {save_json_s * 1000:.1f} ms, load {load_json_s * 1000:.1f} ms; "
+              f"cache {cache_size / 1024:.0f} KiB, save {save_cache_s * 1000:.1f} ms (with fsync), "
+              f"load {load_cache_s * 1000:.1f} ms")
+
+        assert key_cache.load(cache_path) == keys
+        assert cache_size < json_size / 4
+        assert load_cache_s < load_json_s * 2
+
+    def test_journal_vs_snapshot_10k_users(self, tmp_path):
+        keys = many_users(self.USERS)
+        cache = KeyCache(str(tmp_path / "user_cache.bin"))
+        cache.save(keys)
+
+        def change_one_key():
+            keys["0000000005"]["door"] += 1
+            cache.append(keys, ["0000000005"], [])
+
+        append_s = self.best_of(change_one_key)
+        append_bytes = cache.stats()["bytes_written"] - os.path.getsize(cache.path)
+        snapshot_s = self.best_of(lambda: cache.save(keys))
+        snapshot_bytes = os.path.getsize(cache.path)
+
+        print(f"\nOne changed key of {self.USERS}: journal append {append_s * 1000:.2f} ms, "
+              f"{append_bytes // self.RUNS} bytes; full snapshot {snapshot_s * 1000:.1f} ms, {snapshot_bytes} bytes")
+
+        assert append_bytes // self.RUNS < snapshot_bytes / 100
+        assert append_s < snapshot_s
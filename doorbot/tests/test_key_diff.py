@@ -0,0 +1,68 @@
+"""
+Tests for the key list diff used to update the authorisation index and report key changes.
+"""
+
+from doorbot.interfaces.key_diff import KeyChanges, diff_keys
+
+OLD = {
+    "0000000001": {"name": "One", "door": 1, "groups": [], "tidyhq": 1},
+    "0000000002": {"name": "Two", "door": 1, "groups": [], "sound": "aa", "tidyhq": 2,
+                   "sound_url": "https://example.com/aa.mp3"},
+    "0000000003": {"name": "Three", "door": 2, "groups": ["delayed"], "tidyhq": 3},
+}
+
+
+def copy(keys):
+    return {key: dict(user) for key, user in keys.items()}
+
+
+class TestDiffKeys:
+
+    def test_no_changes(self):
+        changes = diff_keys(OLD, copy(OLD))
+        assert not changes
+        assert changes.summary() == "+0 / −0 / ~0"
+
+    def test_added_removed(self):
+        new = copy(OLD)
+        del new["0000000001"]
+        new["0000000004"] = {"name": "Four", "door": 1, "groups": []}
+        new["0000000005"] = {"name": "Five", "door": 1, "groups": []}
+
+        changes = diff_keys(OLD, new)
+
+        assert changes.added == ["0000000004", "0000000005"]
+        assert changes.removed == ["0000000001"]
+        assert changes.modified == []
+        assert changes.summary() == "+2 / −1 / ~0"
+
+    def test_modified_fields(self):
+        for field, value in [("door", 3), ("groups", ["delayed"]), ("sound", "bb"), ("name", "Deux")]:
+            new = copy(OLD)
+            new["0000000002"][field] = value
+            assert diff_keys(OLD, new).modified == ["0000000002"], field
+
+    def test_sound_added_and_removed(self):
+        new = copy(OLD)
+        new["0000000001"]["sound"] = "cc"
+        del new["0000000002"]["sound"]
+        assert diff_keys(OLD, new).modified == ["0000000001", "0000000002"]
+
+    def test_other_fields_ignored(self):
+        new = copy(OLD)
+        del new["0000000002"]["sound_url"]
+        new["0000000003"]["tidyhq"] = 33
+        assert not diff_keys(OLD, new)
+
+    def test_from_nothing(self):
+        changes = diff_keys(None, OLD)
+        assert changes.added == list(OLD)
+        assert changes.keys_changed
+
+        assert diff_keys(OLD, None).removed == list(OLD)
+
+    def test_sound_only_changes(self):
+        changes = KeyChanges()
+        changes.sounds.add("0000000002")
+        assert changes
+        assert not changes.keys_changed
@@ -0,0 +1,140 @@
+"""
+Tests for the unknown card fast paths: the Bloom filter of card ids and the recently denied
+cards that don't trigger another key refresh.
+"""
+
+import random
+import time
+
+import pytest
+
+from doorbot.interfaces import key_cache
+from doorbot.interfaces.key_filter import BloomFilter, RecentlyDenied
+from doorbot.tests.conftest import import_real_interface
+
+UserManager = import_real_interface('user_manager').UserManager
+
+
+def random_card_ids(count, seed):
+    rng = random.Random(seed)
+    return {rng.randrange(10 ** 10) for _ in range(count)}
+
+
+class TestBloomFilter:
+
+    def test_no_false_negatives(self):
+        card_ids = random_card_ids(10000, seed=1)
+        bloom = BloomFilter(card_ids)
+
+        assert all(card_id in bloom for card_id in card_ids)
+
+    def test_false_positive_rate(self):
+        card_ids = random_card_ids(10000, seed=1)
+        bloom = BloomFilter(card_ids)
+        unknown = random_card_ids(20000, seed=2) - card_ids
+
+        false_positives = sum(1 for card_id in unknown if card_id in bloom)
+
+        assert false_positives / len(unknown) < 0.02
+
+    def test_sequential_card_ids(self):
+        bloom = BloomFilter(range(1000, 2000))
+
+        assert all(card_id in bloom for card_id in range(1000, 2000))
+        assert sum(1 for card_id in range(2000, 12000) if card_id in bloom) < 200
+
+    def test_empty(self):
+        bloom = BloomFilter([])
+
+        assert 42 not in bloom
+
+
+class TestRecentlyDenied:
+
+    def test_refresh_once_per_ttl(self):
+        denied = RecentlyDenied(ttl_s=60)
+
+        assert denied.add(42, now=0)
+        assert not denied.add(42, now=30)
+        assert denied.add(7, now=30)
+        assert denied.add(42, now=60)
+
+    def test_bounded(self):
+        denied = RecentlyDenied(ttl_s=60, max_cards=3)
+        for card_id in range(3):
+            denied.add(card_id, now=card_id)
+
+        assert denied.add(100, now=10)
+        assert len(denied) == 3
+        # The oldest card was forgotten
+        assert denied.add(0, now=11)
+
+    def test_expired_cards_dropped_first(self):
+        denied = RecentlyDenied(ttl_s=5, max_cards=2)
+        denied.add(1, now=0)
+        denied.add(2, now=4)
+
+        denied.add(3, now=6)
+
+        assert not denied.add(2, now=7)
+
+
+@pytest.fixture
+def mapped_manager(tmp_path):
+    keys = {f"{card_id:0>10}": {"name": f"User {card_id}", "door": 1, "groups": []} for card_id in range(100, 200)}
+    cache_path = str(tmp_path / "user_cache.json")
+    key_cache.save(cache_path, keys)
+    return UserManager(None, cache_path, index_path=str(tmp_path / "user_index.bin"), denied_ttl_s=60)
+
+
+class TestUserManagerDenied:
+
+    def test_filter_rejects_unknown_cards(self, mapped_manager):
+        for card_id in range(1000, 2000):
+            assert mapped_manager.lookup(card_id) is None
+
+        assert mapped_manager.lookup(150).name == "User 150"
+        assert mapped_manager.stats()["filter_rejections"] > 950
+
+    def test_filter_rebuilt_when_index_reopened(self, mapped_manager, tmp_path):
+        reopened = UserManager(None, mapped_manager.cache_path, index_path=mapped_manager.mapped_index.path)
+
+        assert reopened.key_filter is not None
+        assert reopened.lookup(150).name == "User 150"
+
+    def test_repeated_denied_card_refreshes_once(self, mapped_manager):
+        refreshes = [mapped_manager.note_denied(42) for _ in range(5)]
+
+        assert refreshes == [True, False, False, False, False]
+        assert mapped_manager.note_denied(43)
+        assert mapped_manager.stats()["denied_suppressed"] == 4
+
+
+@pytest.mark.slow
+class TestDeniedLookupBenchmark:
+
+    USERS = 10000
+    READS = 20000
+
+    def test_unknown_card_lookups(self, tmp_path):
+        card_ids = sorted(random_card_ids(self.USERS, seed=3))
+        keys = {f"{card_id:0>10}": {"name": f"User {card_id}", "door": 1, "groups": []} for card_id in card_ids}
+        cache_path = str(tmp_path / "user_cache.json")
+        key_cache.save(cache_path, keys)
+        manager = UserManager(None, cache_path, index_path=str(tmp_path / "user_index.bin"))
+        unknown = list(random_card_ids(self.READS, seed=4) - set(card_ids))
+
+        def time_lookups():
+            start = time.perf_counter()
+            for card_id in unknown:
+                manager.lookup(card_id)
+            return (time.perf_counter() - start) / len(unknown)
+
+        with_filter = time_lookups()
+        manager.key_filter = None
+        without_filter = time_lookups()
+
+        print(f"\nUnknown card lookup in a mapped index of {self.USERS}: binary search {without_filter * 1e6:.2f} us, "
+              f"Bloom filter first {with_filter * 1e6:.2f} us")
+
+        assert with_filter < without_filter
@@ -0,0 +1,178 @@
+"""
+Tests for the memory-mapped key index and UserManager's low memory mode, with a resident
+memory benchmark for 10k users.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from doorbot.interfaces import key_cache
+from doorbot.interfaces.key_index import MappedKeyIndex
+from doorbot.tests.conftest import import_real_interface, many_users, FakeApiClient, USERS
+
+UserManager = import_real_interface('user_manager').UserManager
+
+@pytest.fixture
+def index_path(tmp_path):
+    return str(tmp_path / "user_index.bin")
+
+
+class TestMappedKeyIndex:
+
+    @pytest.mark.parametrize("count", [0, 1, 2, 7, 100])
+    def test_binary_search(self, index_path, count):
+        card_ids = [i * 3 + 5 for i in range(count)]
+        index = MappedKeyIndex(index_path, make_record=lambda key, user: user["name"])
+        index.write({card_id: (f"{card_id:0>10}", {"name": f"User {card_id}"}) for card_id in reversed(card_ids)})
+
+        assert len(index) == count
+        for card_id in card_ids:
+            assert index.get(card_id) == f"User {card_id}"
+        for card_id in [0, 4, 6, 9999999999] + [card_id + 1 for card_id in card_ids]:
+            assert index.get(card_id) is None
+            assert card_id not in index
+        index.close()
+
+    def test_rewrite_remaps(self, index_path):
+        index = MappedKeyIndex(index_path, make_record=lambda key, user: key)
+        index.write({1: ("0000000001", {})})
+        index.write({2: ("0000000002", {})})
+
+        assert index.get(1) is None
+        assert index.get(2) == "0000000002"
+        assert list(index.items()) == [("0000000002", {})]
+        index.close()
+
+    def test_not_an_index(self, index_path):
+        with open(index_path, "wb") as file:
+            file.write(b"{}      ")
+
+        with pytest.raises(ValueError):
+            MappedKeyIndex(index_path, make_record=None).open()
+
+
+class TestUserManagerMappedIndex:
+
+    def test_lookup(self, cache_path, index_path):
+        manager = UserManager(FakeApiClient(), cache_path, sound_resolver={"cd3d9dd904aca51abc55dbe7b7cc7b28": "x.mp3"}.get,
+                              index_path=index_path)
+
+        assert manager.user_data is None
+        assert manager.key_count() == 2
+        record = manager.lookup(123456789)
+        assert record.name == "Gentleman"
+        assert record.sound_path == "x.mp3"
+        assert manager.lookup(42).unlock_time_s == 30.0
+        assert manager.lookup(43) is None
+
+    def test_json_api(self, cache_path, index_path):
+        manager = UserManager(FakeApiClient(), cache_path, index_path=index_path)
+
+        assert manager.is_key_authorised("0000000042")
+        assert not manager.is_key_authorised("0000000043")
+        assert manager.get_user_details("0123456789") == USERS["0123456789"]
+        assert list(manager.get_users_with_custom_sounds()) == ["0123456789"]
+        assert manager.get_users_with_custom_sounds(keys={"0000000042"}) == {}
+
+    async def test_download_updates_index(self, cache_path, index_path):
+        keys = json.loads(json.dumps(USERS))
+        del keys["0000000042"]
+        keys["0000000007"] = {"door": 1, "groups": [], "name": "New", "sound": "77", "tidyhq": 7}
+        api_client = FakeApiClient(keys=keys, sounds={7: {"url": "https://example.com/7.mp3"}})
+        manager = UserManager(api_client, cache_path, index_path=index_path)
+
+        changes = await manager.download_keys()
+
+        assert changes.summary() == "+1 / −1 / ~0"
+        assert manager.user_data is None
+        assert manager.lookup(42) is None
+        assert manager.lookup(7).name == "New"
+        assert manager.get_user_details("0000000007")["sound_url"] == "https://example.com/7.mp3"
+        # Unchanged sound urls are carried over from the cache
+        assert not await manager.download_keys()
+        assert UserManager(api_client, cache_path).user_data["0000000007"]["sound_url"] == "https://example.com/7.mp3"
+
+    def test_current_index_reused(self, cache_path, index_path, monkeypatch):
+        UserManager(FakeApiClient(), cache_path, index_path=index_path)
+
+        def not_loaded(path):
+            raise AssertionError("Key cache loaded")
+
+        monkeypatch.setattr(key_cache, "load", not_loaded)
+        manager = UserManager(FakeApiClient(), cache_path, index_path=index_path)
+
+        assert manager.lookup(42).name == "Lady"
+
+    async def test_stale_index_rebuilt(self, cache_path, index_path):
+        UserManager(FakeApiClient(), cache_path, index_path=index_path)
+        keys = dict(USERS)
+        keys["0000000007"] = {"name": "New"}
+        cache = key_cache.KeyCache(cache_path)
+        cache.load()
+        cache.append(keys, ["0000000007"], [])
+        # Make sure the journal is newer even on file systems with coarse timestamps
+        index_ns = os.stat(index_path).st_mtime_ns
+        os.utime(cache.journal_path, ns=(index_ns + 1, index_ns + 1))
+
+        manager = UserManager(FakeApiClient(), cache_path, index_path=index_path)
+
+        assert manager.lookup(7).name == "New"
+
+    def test_no_cache(self, tmp_path, index_path):
+        manager = UserManager(FakeApiClient(), str(tmp_path / "missing.json"), index_path=index_path)
+
+        assert manager.key_count() == 0
+        assert manager.lookup(42) is None
+
+
+RSS_SCRIPT = textwrap.dedent("""
+    import gc, sys
+    from doorbot.interfaces.user_manager import UserManager
+
+    def rss_kib():
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+
+    gc.collect()
+    before = rss_kib()
+    index_path = sys.argv[2] if len(sys.argv) > 2 else None
+    manager = UserManager(None, sys.argv[1], index_path=index_path)
+    gc.collect()
+    for card_id in range(0, 10000, 97):
+        assert manager.lookup(card_id) is not None
+    print(rss_kib() - before)
+""")
+
+
+@pytest.mark.slow
+@pytest.mark.skipif(not os.path.exists("/proc/self/status"), reason="Needs /proc to read resident memory")
+class TestMappedIndexMemoryBenchmark:
+
+    USERS = 10000
+
+    def test_resident_memory_10k_users(self, tmp_path):
+        keys = many_users(self.USERS)
+        cache_path = str(tmp_path / "user_cache.json")
+        key_cache.save(cache_path, keys)
+        root = os.path.join(os.path.dirname(__file__), "..", "..")
+
+        def rss_used_kib(*args):
+            output = subprocess.check_output([sys.executable, "-c", RSS_SCRIPT, cache_path, *args], cwd=root)
+            return int(output)
+
+        in_memory = rss_used_kib()
+        first_start = rss_used_kib(str(tmp_path / "user_index.bin"))
+        mapped = rss_used_kib(str(tmp_path / "user_index.bin"))
+
+        print(f"\n{self.USERS} users resident memory: dicts {in_memory / 1024:.1f} MiB, "
+              f"mapped index {mapped / 1024:.1f} MiB (saves {(in_memory - mapped) / 1024:.1f} MiB), "
+              f"mapped index first start (building it) {first_start / 1024:.1f} MiB")
+
+        assert mapped < in_memory / 2
@@ -0,0 +1,127 @@
+"""
+Tests for single-flight, rate limited key refreshes.
+"""
+
+import asyncio
+
+import pytest
+
+from doorbot.interfaces.key_refresh import KeyRefresh
+
+
+class FakeDownload:
+    def __init__(self, duration_s=0.05):
+        self.duration_s = duration_s
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def __call__(self):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.duration_s)
+        finally:
+            self.in_flight -= 1
+
+
+async def settle(refresh):
+    while refresh.in_flight():
+        await asyncio.sleep(0.01)
+
+
+class TestKeyRefresh:
+
+    async def test_burst_of_requests_joins_one_download(self):
+        download = FakeDownload()
+        refresh = KeyRefresh(download, burst=3, refill_s=60, min_interval_s=0)
+
+        outcomes = [refresh.request() for _ in range(10)]
+        await settle(refresh)
+
+        assert outcomes == ["started"] + ["joined"] * 9
+        assert download.calls == 1
+
+    async def test_run_joins_requested_download(self):
+        download = FakeDownload()
+        refresh = KeyRefresh(download)
+
+        refresh.request()
+        await asyncio.gather(refresh.run(), refresh.run())
+
+        assert download.calls == 1
+        assert download.max_in_flight == 1
+
+    async def test_min_interval_defers_and_coalesces(self):
+        download = FakeDownload(duration_s=0)
+        refresh = KeyRefresh(download, burst=10, refill_s=60, min_interval_s=0.2)
+
+        assert refresh.request() == "started"
+        await settle(refresh)
+        assert refresh.request() == "deferred"
+        assert refresh.request() == "coalesced"
+        assert download.calls == 1
+
+        await asyncio.sleep(0.3)
+        assert download.calls == 2
+        assert refresh.stats()["coalesced"] == 1
+
+    async def test_token_bucket(self):
+        download = FakeDownload(duration_s=0)
+        refresh = KeyRefresh(download, burst=2, refill_s=0.2, min_interval_s=0)
+
+        outcomes = []
+        for _ in range(3):
+            outcomes.append(refresh.request())
+            await settle(refresh)
+
+        assert outcomes == ["started", "started", "deferred"]
+        await asyncio.sleep(0.1)
+        assert download.calls == 2
+        await asyncio.sleep(0.2)
+        assert download.calls == 3
+
+    async def test_periodic_download_satisfies_deferred(self):
+        download = FakeDownload(duration_s=0)
+        refresh = KeyRefresh(download, burst=1, refill_s=0.2, min_interval_s=0)
+        refresh.request()
+        await settle(refresh)
+        assert refresh.request() == "deferred"
+
+        await refresh.run()
+        await asyncio.sleep(0.3)
+
+        assert download.calls == 2
+        assert not refresh.stats()["pending"]
+
+    async def test_run_raises_download_errors(self):
+        async def fail():
+            raise RuntimeError("tidyauth down")
+
+        refresh = KeyRefresh(fail, min_interval_s=0)
+
+        with pytest.raises(RuntimeError):
+            await refresh.run()
+        # Not stuck in flight
+        assert refresh.request() == "started"
+        await settle(refresh)
+
+
+@pytest.mark.slow
+class TestKeyRefreshBenchmark:
+
+    async def test_burst_of_denied_reads(self):
+        """20 bad reads a second for 2 seconds"""
+        download = FakeDownload(duration_s=0.05)
+        refresh = KeyRefresh(download, burst=3, refill_s=60, min_interval_s=0.5)
+
+        for _ in range(40):
+            refresh.request()
+            await asyncio.sleep(0.05)
+        await settle(refresh)
+
+        print(f"\n40 denied reads over 2 s: {download.calls} downloads, {refresh.stats()}")
+
+        assert download.calls <= 3
+        assert download.max_in_flight == 1
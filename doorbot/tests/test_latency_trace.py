@@ -0,0 +1,92 @@
+"""
+Tests for key read latency tracing and the rolling per stage percentiles.
+"""
+
+import pytest
+
+from doorbot.interfaces.latency_trace import LatencyStats, ReadTrace, tick_diff_us
+from doorbot.tests.conftest import MockPi, import_real_interface
+
+wiegand_key_reader = import_real_interface('wiegand_key_reader')
+
+
+class TestReadTrace:
+
+    def test_tick_diff_wraps(self):
+        assert tick_diff_us(100, 350) == 250
+        assert tick_diff_us(0xFFFFFF00, 0x10) == 0x110
+
+    def test_stage_durations(self, monkeypatch):
+        clock = iter([10.0, 10.002, 10.003, 10.010])
+        monkeypatch.setattr("doorbot.interfaces.latency_trace.time.perf_counter", lambda: next(clock))
+
+        trace = ReadTrace(edge_tick=1_000, decode_tick=6_000)
+        trace.stamp("queue")
+        trace.stamp("authorise")
+        trace.stamp("relay")
+
+        durations = trace.stage_durations()
+        assert durations["decode"] == pytest.approx(0.005)
+        assert durations["queue"] == pytest.approx(0.002)
+        assert durations["authorise"] == pytest.approx(0.001)
+        assert durations["relay"] == pytest.approx(0.007)
+        assert trace.since_edge("relay") == pytest.approx(0.015)
+        assert trace.since_edge("slack") is None
+
+    def test_decoder_ticks_start_the_trace(self):
+        """The trace starts from the tick of the last wiegand edge seen by the decoder"""
+        pi = MockPi()
+        reader = wiegand_key_reader.KeyReader(pi)
+        decoder = reader.w_rfid
+
+        # Two bits then both gpios time out 5 ms after the last edge
+        decoder._cb(decoder.gpio_0, 0, 1_000)
+        decoder._cb(decoder.gpio_1, 0, 2_000)
+        decoder._cb(decoder.gpio_0, 2, 7_000)
+        decoder._cb(decoder.gpio_1, 2, 7_000)
+
+        event = reader._early_reads[0]
+        assert not event.is_key()
+        assert decoder.last_edge_tick == 2_000
+        assert event.trace.decode_s == 0.0  # Traces are only kept for valid keys
+
+        wiegand_key_reader.callback_rfid(26, 0x2468AC)
+        assert reader._early_reads[1].trace.decode_s == pytest.approx(0.005)
+
+
+class TestLatencyStats:
+
+    def test_percentiles(self):
+        stats = LatencyStats()
+        for ms in range(1, 101):
+            stats.add("relay", ms / 1000)
+
+        result = stats.percentiles("relay")
+        assert result["count"] == 100
+        assert result["p50"] == pytest.approx(0.050, abs=0.001)
+        assert result["p95"] == pytest.approx(0.095, abs=0.001)
+        assert result["p99"] == pytest.approx(0.099, abs=0.001)
+
+    def test_window_is_rolling(self):
+        stats = LatencyStats(window=10)
+        for _ in range(100):
+            stats.add("queue", 1.0)
+        for _ in range(10):
+            stats.add("queue", 0.001)
+        assert stats.percentiles("queue")["p99"] == 0.001
+
+    def test_add_trace_and_summary(self):
+        stats = LatencyStats()
+        trace = ReadTrace(edge_tick=0, decode_tick=5_000)
+        for stage in ("queue", "authorise", "relay", "sound", "slack"):
+            trace.stamp(stage)
+        stats.add_trace(trace)
+
+        summary = stats.summary()
+        assert list(summary) == ["decode", "queue", "authorise", "relay", "sound", "slack",
+                                 "tag_to_relay", "tag_to_slack"]
+        assert summary["tag_to_relay"]["p50"] >= 0.005
+        assert "tag_to_relay" in stats.format_summary()
+
+    def test_empty_summary(self):
+        assert LatencyStats().format_summary() == "No key reads yet"
@@ -0,0 +1,129 @@
+"""
+Tests for the event loop stall monitor and the relock deadline failsafe.
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from doorbot.interfaces.loop_monitor import LoopMonitor, DeadlineFailsafe
+
+
+def block_the_loop(seconds):
+    """Stands in for a blocking call made from the loop (eg. a synchronous http request)"""
+    time.sleep(seconds)
+
+
+@pytest.fixture
+async def monitor():
+    monitor = LoopMonitor(heartbeat_interval_s=0.02, stall_threshold_s=0.1)
+    monitor.start(asyncio.get_running_loop())
+    yield monitor
+    monitor.stop()
+
+
+class TestLoopMonitor:
+
+    async def test_no_stalls_when_idle(self, monitor):
+        await asyncio.sleep(0.3)
+
+        stats = monitor.stats()
+        assert stats["stalls"] == 0
+        assert stats["lag_ms"]["count"] >= 10
+        assert stats["lag_ms"]["p50"] < 10
+
+    async def test_stall_stack_captured(self, monitor):
+        await asyncio.sleep(0.05)
+        block_the_loop(0.4)
+        await asyncio.sleep(0.05)
+
+        assert monitor.stalls == 1
+        assert "block_the_loop" in monitor.last_stall_stack
+        assert monitor.max_lag_s >= 0.3
+
+    async def test_each_stall_counted_once(self, monitor):
+        for _ in range(2):
+            block_the_loop(0.3)
+            await asyncio.sleep(0.1)
+
+        assert monitor.stalls == 2
+
+    async def test_short_blocks_not_stalls(self, monitor):
+        for _ in range(5):
+            block_the_loop(0.03)
+            await asyncio.sleep(0.02)
+
+        assert monitor.stalls == 0
+
+
+def recording_failsafe(grace_s=0.05):
+    calls = []
+    failsafe = DeadlineFailsafe("test_failsafe", action=lambda: calls.append(time.monotonic()), grace_s=grace_s)
+    failsafe.calls = calls
+    failsafe.start()
+    return failsafe
+
+
+class TestDeadlineFailsafe:
+
+    def test_runs_when_deadline_missed(self):
+        failsafe = recording_failsafe()
+        armed_at = time.monotonic()
+        failsafe.arm(0.05)
+        time.sleep(0.2)
+        failsafe.stop()
+
+        assert len(failsafe.calls) == 1
+        assert 0.1 <= failsafe.calls[0] - armed_at < 0.15
+        assert failsafe.triggered == 1
+
+    def test_disarmed_in_time(self):
+        failsafe = recording_failsafe()
+        failsafe.arm(0.05)
+        time.sleep(0.02)
+        failsafe.disarm()
+        time.sleep(0.15)
+        failsafe.stop()
+
+        assert failsafe.calls == []
+
+    def test_rearm_extends(self):
+        failsafe = recording_failsafe()
+        failsafe.arm(0.05)
+        time.sleep(0.03)
+        rearmed_at = time.monotonic()
+        failsafe.arm(0.1)
+        time.sleep(0.25)
+        failsafe.stop()
+
+        assert len(failsafe.calls) == 1
+        assert failsafe.calls[0] - rearmed_at >= 0.15
+
+    def test_action_exception_logged(self, caplog):
+        def fail():
+            raise RuntimeError("relay write failed")
+
+        failsafe = DeadlineFailsafe("test_failsafe", action=fail, grace_s=0)
+        failsafe.start()
+        failsafe.arm(0.01)
+        time.sleep(0.1)
+        failsafe.stop()
+
+        assert failsafe.triggered == 1
+        assert "relay write failed" in caplog.text
+
+    async def test_relocks_while_loop_blocked(self):
+        """The door is relocked on time even though the loop can't run the relock timer"""
+        relocked = threading.Event()
+        failsafe = DeadlineFailsafe("relock_failsafe", action=relocked.set, grace_s=0.05)
+        failsafe.start()
+
+        failsafe.arm(0.05)
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.05, failsafe.disarm)
+        block_the_loop(0.3)
+        failsafe.stop()
+
+        assert relocked.is_set()
@@ -0,0 +1,29 @@
+"""
+Tests for the long lived aiohttp session shared by the API clients.
+"""
+
+from doorbot.interfaces.pooled_session import PooledSession
+
+
+class TestPooledSession:
+
+    async def test_session_reused(self):
+        pool = PooledSession(max_connections=2, use_dns_cache=True, ttl_dns_cache=60)
+        try:
+            session = pool.session
+            assert pool.session is session
+            assert session.connector.limit == 2
+        finally:
+            await pool.close()
+
+    async def test_new_session_after_close(self):
+        pool = PooledSession()
+        session = pool.session
+        await pool.close()
+
+        assert session.closed
+        assert pool.session is not session
+        assert not pool.session.closed
+        await pool.close()
+        # Closing again is harmless
+        await pool.close()
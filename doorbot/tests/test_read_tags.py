@@ -0,0 +1,197 @@
+"""
+Tests for the read_tags worker and the outbox workers in app.py.
+
+Reads are fed through the mock key reader queue and slack is mocked, so these check the
+door is unlocked straight away and the slack/webhook notifications are sent afterwards
+by the outbox workers.
+"""
+
+import asyncio
+import threading
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+from doorbot import app
+from doorbot.interfaces.custom_sound_index import sound_file_name
+from doorbot.interfaces.latency_trace import ReadTrace
+from doorbot.interfaces.sound_store import SoundStore
+from doorbot.tests.conftest import import_real_interface
+
+ReadEvent = import_real_interface('wiegand_key_reader').ReadEvent
+AccessRecord = import_real_interface('user_manager').AccessRecord
+
+KNOWN_TAG = "0001193046"
+KNOWN_USER = {"name": "Test User", "door": 1, "groups": [], "tidyhq": 1234}
+SOUND_HASH = "cd3d9dd904aca51abc55dbe7b7cc7b28"
+
+
+@pytest.fixture
+def users():
+    app.user_manager.user_data = {KNOWN_TAG: KNOWN_USER}
+    app.user_manager.index = {int(KNOWN_TAG): AccessRecord.from_user(KNOWN_TAG, KNOWN_USER)}
+    yield
+    app.user_manager.user_data = {}
+    app.user_manager.index = {}
+
+
+@pytest.fixture
+async def running_workers():
+    """Run read_tags and the outbox workers, cancel them afterwards"""
+    # Fresh queues bound to this test's event loop
+    with patch.object(app, "door_message_outbox", asyncio.Queue()), \
+            patch.object(app, "access_granted_webhook_outbox", asyncio.Queue()), \
+            patch.object(app.key_reader, "queue", asyncio.Queue()):
+        tasks = [
+            asyncio.create_task(app.read_tags()),
+            asyncio.create_task(app.door_message_worker()),
+            asyncio.create_task(app.access_granted_webhook_worker()),
+        ]
+        yield
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def wait_for(condition, timeout=1.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise TimeoutError("Condition not met")
+        await asyncio.sleep(0.01)
+
+
+class TestReadTagsOutbox:
+
+    async def test_unlock_does_not_wait_for_slack(self, users, running_workers):
+        slack_posted = asyncio.Event()
+
+        async def slow_post(**kwargs):
+            await asyncio.sleep(0.5)
+            slack_posted.set()
+            return {"ts": "1234.5678"}
+
+        with patch.object(app.app.client, "chat_postMessage", side_effect=slow_post), \
+                patch.object(app.home_assistant, "call_webhook", AsyncMock()) as mock_webhook:
+            app.hat_gpio.relay_state.clear()
+            app.key_reader.queue.put_nowait(ReadEvent("RFID", card_id=1193046))
+
+            await wait_for(lambda: app.hat_gpio.relay_state.get(app.config.relay_channel))
+            assert not slack_posted.is_set()
+
+            # Slack timestamp makes its way to the webhook once it is known
+            await wait_for(lambda: mock_webhook.called)
+            assert slack_posted.is_set()
+            assert mock_webhook.call_args.args[1] == {"ts": "1234.5678"}
+
+    async def test_denied_read_is_posted_without_webhook(self, users, running_workers):
+        post = AsyncMock(return_value={"ts": "1.0"})
+        with patch.object(app.app.client, "chat_postMessage", post), \
+                patch.object(app.home_assistant, "call_webhook", AsyncMock()) as mock_webhook:
+            app.key_reader.queue.put_nowait(ReadEvent("NFC", card_id=42))
+
+            await wait_for(lambda: post.called)
+            await asyncio.sleep(0.05)
+            assert "Access denied" in str(post.call_args.kwargs)
+            assert not mock_webhook.called
+
+    async def test_repeated_denied_card_refreshes_keys_once(self, users, running_workers):
+        post = AsyncMock(return_value={"ts": "1.0"})
+        with patch.object(app.app.client, "chat_postMessage", post), \
+                patch.object(app.user_manager, "note_denied", side_effect=[True, False, False]), \
+                patch.object(app.key_refresh, "request") as request:
+            for _ in range(3):
+                app.key_reader.queue.put_nowait(ReadEvent("NFC", card_id=42))
+
+            await wait_for(lambda: post.call_count == 3)
+            assert request.call_count == 1
+
+    async def test_slack_failure_does_not_stop_the_outbox(self, users, running_workers):
+        post = AsyncMock(side_effect=[Exception("slack down"), {"ts": "2.0"}])
+        with patch.object(app.app.client, "chat_postMessage", post):
+            app.queue_door_access(name="A", tag="1", status="s", level=1)
+            app.queue_door_access(name="B", tag="2", status="s", level=1)
+
+            await wait_for(lambda: post.call_count == 2)
+
+    async def test_grant_is_traced(self, users, running_workers):
+        post = AsyncMock(return_value={"ts": "1.0"})
+        with patch.object(app.app.client, "chat_postMessage", post), \
+                patch.object(app.home_assistant, "call_webhook", AsyncMock()), \
+                patch.object(app, "latency_stats", app.LatencyStats()) as stats:
+            app.key_reader.queue.put_nowait(ReadEvent("RFID", card_id=1193046))
+
+            await wait_for(lambda: "tag_to_slack" in stats.summary())
+            assert set(stats.summary()) == {"decode", "queue", "authorise", "relay", "sound", "slack",
+                                            "tag_to_relay", "tag_to_slack"}
+
+    def test_relay_stamped_before_unlock_is_logged(self):
+        trace = ReadTrace()
+        stages_when_logged = []
+        with patch.object(app.general_logger, "info",
+                          side_effect=lambda message: stages_when_logged.append([s for s, _ in trace.stamps])), \
+                patch.object(app.scheduler, "schedule"), \
+                patch.object(app.relock_failsafe, "arm"):
+            app.gpio_unlock(5, trace)
+
+        assert stages_when_logged == [["decode", "relay"]]
+
+    async def test_evicted_sound_downloaded_again_when_played(self, running_workers, tmp_path):
+        user = dict(KNOWN_USER, sound=SOUND_HASH)
+        (tmp_path / sound_file_name("whoo", SOUND_HASH)).write_bytes(b"\0" * 1000)
+        store = SoundStore(str(tmp_path), quota_bytes=0)
+        store.update_references({KNOWN_TAG: user})
+        assert store.collect()["evicted"] == [SOUND_HASH]
+
+        post = AsyncMock(return_value={"ts": "1.0"})
+        with patch.object(app, "sound_store", store), \
+                patch.object(app, "start_download_sounds") as download_sounds, \
+                patch.object(app.user_manager, "index", {int(KNOWN_TAG): AccessRecord.from_user(KNOWN_TAG, user)}), \
+                patch.object(app.app.client, "chat_postMessage", post), \
+                patch.object(app.home_assistant, "call_webhook", AsyncMock()):
+            for _ in range(2):
+                app.key_reader.queue.put_nowait(ReadEvent("RFID", card_id=1193046))
+
+            await wait_for(lambda: post.call_count == 2)
+            # Only the first play after eviction asks for it again
+            download_sounds.assert_called_once_with({KNOWN_TAG})
+            assert store.wanted(SOUND_HASH)
+
+
+class TestEventDrivenWorkers:
+
+    async def test_log_from_another_thread_posted(self, monkeypatch):
+        monkeypatch.setattr(app, "global_slack_log_queue", asyncio.Queue())
+        monkeypatch.setattr(app, "slack_log_loop", None)
+        post = AsyncMock(return_value={"ts": "1.0"})
+        with patch.object(app.app.client, "chat_postMessage", post):
+            app.general_logger.info("before the worker started")
+            worker = asyncio.create_task(app.slack_log_worker())
+            await asyncio.sleep(0)
+
+            thread = threading.Thread(target=app.general_logger.info, args=("from a thread token=secret",))
+            thread.start()
+            thread.join()
+
+            await wait_for(lambda: post.call_count == 2)
+            worker.cancel()
+
+        texts = [call.kwargs["text"] for call in post.call_args_list]
+        assert "before the worker started" in texts[0]
+        assert "from a thread token=REDACTED" in texts[1]
+
+    async def test_door_sensor_changes_sent_in_order(self, monkeypatch):
+        monkeypatch.setattr(app, "door_sensor_outbox", asyncio.Queue())
+        monkeypatch.setattr(app, "door_sensor_last_state", None)
+        states = iter([False, False, True, False])
+        monkeypatch.setattr(app.hat_gpio, "read_switches",
+                            lambda: {app.config.door_sensor_channel: next(states)})
+        with patch.object(app.home_assistant, "set_state", AsyncMock()) as set_state:
+            for _ in range(4):
+                app.read_door_sensor()
+            worker = asyncio.create_task(app.door_sensor_worker())
+
+            await wait_for(lambda: set_state.call_count == 3)
+            worker.cancel()
+
+        assert [call.kwargs["state"] for call in set_state.call_args_list] == ["on", "off", "on"]
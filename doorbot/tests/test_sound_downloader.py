@@ -0,0 +1,193 @@
+"""
+Tests for the async SoundDownloader against a local stub sound server, with a benchmark
+syncing 500 sounds.
+"""
+
+import hashlib
+import os
+import time
+from unittest.mock import patch
+
+import pytest
+
+from doorbot.interfaces.custom_sound_index import sound_file_name
+from doorbot.tests.conftest import import_real_interface
+from doorbot.tests.sound_stub import StubSoundServer
+
+sound_downloader = import_real_interface('sound_downloader')
+SoundDownloader = sound_downloader.SoundDownloader
+
+
+def sound_data(name, size=20000):
+    return (name.encode() * (size // len(name) + 1))[:size]
+
+
+def users_for(stub, base_url, names):
+    users = {}
+    for i, name in enumerate(names):
+        sound_hash = hashlib.md5(stub.sounds.get(name, b"")).hexdigest()
+        users[f"{i:0>10}"] = {"name": name, "sound": sound_hash, "sound_url": stub.url(base_url, name)}
+    return users
+
+
+@pytest.fixture
+def sounds_dir(tmp_path):
+    return str(tmp_path / "custom_sounds")
+
+
+class TestSoundDownloader:
+
+    async def test_downloads_and_notifies(self, stub_server, sounds_dir):
+        stub = StubSoundServer({"a.mp3": sound_data("a"), "b.mp3": sound_data("b")})
+        base_url = await stub_server(stub.app())
+        users = users_for(stub, base_url, ["a.mp3", "b.mp3"])
+        users["0000000099"] = {"name": "No sound"}
+        downloaded = {}
+
+        result = await SoundDownloader(users, sounds_dir, on_download=downloaded.__setitem__).download_all()
+
+        assert result["downloaded"] == 2
+        sound_hash = users["0000000000"]["sound"]
+        path = os.path.join(sounds_dir, sound_file_name("a", sound_hash))
+        assert downloaded[sound_hash] == path
+        with open(path, "rb") as file:
+            assert file.read() == sound_data("a")
+        assert not [name for name in os.listdir(sounds_dir) if name.endswith(".part")]
+
+    async def test_existing_sounds_skipped(self, stub_server, sounds_dir):
+        stub = StubSoundServer({"a.mp3": sound_data("a")})
+        users = users_for(stub, await stub_server(stub.app()), ["a.mp3"])
+        await SoundDownloader(users, sounds_dir).download_all()
+
+        result = await SoundDownloader(users, sounds_dir).download_all()
+
+        assert result["skipped"] == 1
+        assert len(stub.requests) == 1
+
+    async def test_bounded_concurrency(self, stub_server, sounds_dir):
+        names = [f"{i}.mp3" for i in range(12)]
+        stub = StubSoundServer({name: sound_data(name, 1000) for name in names}, delay_s=0.05)
+        users = users_for(stub, await stub_server(stub.app()), names)
+
+        start = time.perf_counter()
+        result = await SoundDownloader(users, sounds_dir, max_concurrent=4).download_all()
+        elapsed = time.perf_counter() - start
+
+        assert result["downloaded"] == 12
+        # 3 rounds of 4 at once
+        assert 0.15 <= elapsed < 0.5
+
+    async def test_interrupted_download_resumed(self, stub_server, sounds_dir):
+        data = sound_data("resume", 100000)
+        stub = StubSoundServer({"resume.mp3": data})
+        stub.drop_after["resume.mp3"] = 30000
+        users = users_for(stub, await stub_server(stub.app()), ["resume.mp3"])
+
+        first = await SoundDownloader(users, sounds_dir).download_all()
+        assert first["failed"] == 1
+        assert first["downloaded"] == 0
+
+        second = await SoundDownloader(users, sounds_dir).download_all()
+
+        assert second["downloaded"] == 1
+        assert second["resumed"] == 1
+        # Only the rest of the file was sent
+        resumed_from = int(stub.requests[1][1].removeprefix("bytes=").rstrip("-"))
+        assert resumed_from > 0
+        assert second["bytes_received"] == len(data) - resumed_from
+        with open(os.path.join(sounds_dir, os.listdir(sounds_dir)[0]), "rb") as file:
+            assert file.read() == data
+
+    async def test_range_ignored_restarts(self, stub_server, sounds_dir):
+        data = sound_data("restart", 50000)
+        stub = StubSoundServer({"restart.mp3": data})
+        stub.drop_after["restart.mp3"] = 10000
+        users = users_for(stub, await stub_server(stub.app()), ["restart.mp3"])
+        await SoundDownloader(users, sounds_dir).download_all()
+
+        stub.ignore_range = True
+        result = await SoundDownloader(users, sounds_dir).download_all()
+
+        assert result["downloaded"] == 1
+        assert result["resumed"] == 0
+        with open(os.path.join(sounds_dir, os.listdir(sounds_dir)[0]), "rb") as file:
+            assert file.read() == data
+
+    async def test_wrong_content_type_rejected(self, stub_server, sounds_dir):
+        stub = StubSoundServer({"error.mp3": b"<html>Access denied</html>"}, content_type="text/html")
+        users = users_for(stub, await stub_server(stub.app()), ["error.mp3"])
+
+        downloader = SoundDownloader(users, sounds_dir)
+        result = await downloader.download_all()
+
+        assert result["failed"] == 1
+        assert downloader.failed_hashes == {users["0000000000"]["sound"]}
+        assert os.listdir(sounds_dir) == []
+
+    async def test_too_large_rejected(self, stub_server, sounds_dir):
+        stub = StubSoundServer({"huge.mp3": sound_data("huge", 10000)})
+        users = users_for(stub, await stub_server(stub.app()), ["huge.mp3"])
+
+        result = await SoundDownloader(users, sounds_dir, max_bytes=5000).download_all()
+
+        assert result["failed"] == 1
+        assert os.listdir(sounds_dir) == []
+
+    async def test_failed_rename_does_not_stop_round(self, stub_server, sounds_dir):
+        stub = StubSoundServer({"a.mp3": sound_data("a"), "b.mp3": sound_data("b")})
+        users = users_for(stub, await stub_server(stub.app()), ["a.mp3", "b.mp3"])
+        replace = os.replace
+
+        def replace_or_fail(source, destination):
+            # As if another download had already moved the part file into place
+            if os.path.basename(source).startswith("a_"):
+                raise FileNotFoundError(source)
+            replace(source, destination)
+
+        with patch.object(sound_downloader.os, "replace", side_effect=replace_or_fail):
+            result = await SoundDownloader(users, sounds_dir).download_all()
+
+        assert result["downloaded"] == 1
+        assert result["failed"] == 1
+
+    async def test_missing_sound(self, stub_server, sounds_dir):
+        stub = StubSoundServer()
+        users = users_for(stub, await stub_server(stub.app()), ["gone.mp3"])
+
+        result = await SoundDownloader(users, sounds_dir).download_all()
+
+        assert result["failed"] == 1
+
+
+@pytest.mark.slow
+class TestSoundDownloaderBenchmark:
+
+    SOUNDS = 500
+    SIZE = 30000
+    DELAY_S = 0.01
+
+    async def test_sync_500_sounds(self, stub_server, tmp_path):
+        names = [f"member_{i}.mp3" for i in range(self.SOUNDS)]
+        stub = StubSoundServer({name: sound_data(name, self.SIZE) for name in names}, delay_s=self.DELAY_S)
+        users = users_for(stub, await stub_server(stub.app()), names)
+
+        async def time_sync(max_concurrent):
+            start = time.perf_counter()
+            result = await SoundDownloader(users, str(tmp_path / f"sounds_{max_concurrent}"),
+                                           max_concurrent=max_concurrent).download_all()
+            assert result["downloaded"] == self.SOUNDS
+            return time.perf_counter() - start
+
+        one_at_a_time = await time_sync(1)
+        concurrent = await time_sync(8)
+        start = time.perf_counter()
+        resync = await SoundDownloader(users, str(tmp_path / "sounds_8")).download_all()
+        resync_s = time.perf_counter() - start
+
+        print(f"\n{self.SOUNDS} sounds of {self.SIZE // 1000} kB with {self.DELAY_S * 1000:.0f} ms server latency: "
+              f"one at a time {one_at_a_time:.2f} s, 8 at once {concurrent:.2f} s, "
+              f"resync with all present {resync_s * 1000:.1f} ms (was at least {self.SOUNDS * 0.5:.0f} s "
+              f"at one sound per 0.5 s tick)")
+
+        assert resync["skipped"] == self.SOUNDS
+        assert concurrent < one_at_a_time / 3
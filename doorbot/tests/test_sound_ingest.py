@@ -0,0 +1,170 @@
+"""
+Tests for processing downloaded custom sounds with ffmpeg.
+
+ffmpeg is replaced by a small script that records its arguments, so these run without it.
+The real ffmpeg is only used by the slow test, which is skipped if it isn't installed.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import wave
+import shutil
+import subprocess
+
+import pytest
+
+from doorbot.interfaces.custom_sound_index import sound_file_name, processed_path, PART_SUFFIX
+from doorbot.interfaces import sound_ingest
+from doorbot.interfaces.sound_ingest import SoundIngest
+from doorbot.tests.conftest import write_sound
+
+HASH_A = "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
+HASH_B = "bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb"
+
+FAKE_FFMPEG = """#!{python}
+import sys, json, time
+args = sys.argv[1:]
+with open({log!r}, "a") as log:
+    log.write(json.dumps(args) + "\\n")
+source = args[args.index("-i") + 1]
+with open(source, "rb") as file:
+    data = file.read()
+if b"hang" in data:
+    time.sleep(10)
+if b"corrupt" in data:
+    sys.stderr.write("Invalid data found when processing input")
+    sys.exit(1)
+with open(args[-1], "wb") as file:
+    file.write(b"RIFF" + data)
+"""
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path):
+    """Path of the fake ffmpeg, and a function returning the argument lists it was run with"""
+    log_path = tmp_path / "ffmpeg.log"
+    path = tmp_path / "ffmpeg"
+    path.write_text(FAKE_FFMPEG.format(python=sys.executable, log=str(log_path)))
+    path.chmod(0o755)
+
+    def calls():
+        if not log_path.exists():
+            return []
+        return [json.loads(line) for line in log_path.read_text().splitlines()]
+
+    return str(path), calls
+
+
+class TestSoundIngest:
+
+    async def test_processed_beside_original(self, tmp_path, fake_ffmpeg):
+        ffmpeg_path, calls = fake_ffmpeg
+        path = write_sound(tmp_path, "a", HASH_A)
+        ingest = SoundIngest(max_duration_s=8, sample_rate=16000, ffmpeg_path=ffmpeg_path)
+
+        output_path = await ingest.process(HASH_A, path)
+
+        assert output_path == processed_path(path)
+        with open(output_path, "rb") as file:
+            assert file.read() == b"RIFFID3"
+        assert os.path.exists(path)
+        assert not os.path.exists(output_path + PART_SUFFIX)
+
+        args = calls()[0]
+        assert args[args.index("-t") + 1] == "8"
+        assert args[args.index("-ac") + 1] == "1"
+        assert args[args.index("-ar") + 1] == "16000"
+        assert "loudnorm=I=-16" in args[args.index("-af") + 1]
+
+    async def test_cached_by_hash(self, tmp_path, fake_ffmpeg):
+        ffmpeg_path, calls = fake_ffmpeg
+        path = write_sound(tmp_path, "a", HASH_A)
+        ingest = SoundIngest(ffmpeg_path=ffmpeg_path)
+
+        await ingest.process(HASH_A, path)
+        await ingest.process(HASH_A, path)
+
+        assert len(calls()) == 1
+        assert ingest.stats()["processed"] == 1
+        assert ingest.stats()["cached"] == 1
+
+    async def test_failure_falls_back_to_original(self, tmp_path, fake_ffmpeg):
+        ffmpeg_path, calls = fake_ffmpeg
+        path = write_sound(tmp_path, "a", HASH_A, data=b"corrupt")
+        ingest = SoundIngest(ffmpeg_path=ffmpeg_path)
+
+        assert await ingest.process(HASH_A, path) is None
+        # Not tried again
+        assert await ingest.process(HASH_A, path) is None
+
+        assert len(calls()) == 1
+        assert ingest.stats()["failed"] == 1
+        assert sorted(os.listdir(tmp_path)) == sorted(["ffmpeg", "ffmpeg.log", os.path.basename(path)])
+
+    async def test_same_sound_processed_once(self, tmp_path, fake_ffmpeg):
+        ffmpeg_path, calls = fake_ffmpeg
+        path = write_sound(tmp_path, "a", HASH_A)
+        ingest = SoundIngest(ffmpeg_path=ffmpeg_path)
+
+        results = await asyncio.gather(ingest.process(HASH_A, path), ingest.process(HASH_A, path))
+
+        assert results == [processed_path(path)] * 2
+        assert len(calls()) == 1
+
+    async def test_hung_ffmpeg_killed(self, tmp_path, fake_ffmpeg, monkeypatch):
+        ffmpeg_path, _ = fake_ffmpeg
+        monkeypatch.setattr(sound_ingest, "PROCESS_TIMEOUT_S", 0.5)
+        path = write_sound(tmp_path, "a", HASH_A, data=b"hang")
+        ingest = SoundIngest(ffmpeg_path=ffmpeg_path)
+
+        start = time.monotonic()
+        assert await ingest.process(HASH_A, path) is None
+
+        assert time.monotonic() - start < 5
+        assert ingest.stats()["failed"] == 1
+        assert not os.path.exists(processed_path(path) + PART_SUFFIX)
+
+    async def test_without_ffmpeg(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(shutil, "which", lambda name: None)
+        path = write_sound(tmp_path, "a", HASH_A)
+        ingest = SoundIngest()
+
+        assert not ingest.available
+        assert await ingest.process(HASH_A, path) is None
+
+    async def test_process_all(self, tmp_path, fake_ffmpeg):
+        ffmpeg_path, calls = fake_ffmpeg
+        path_a = write_sound(tmp_path, "a", HASH_A)
+        path_b = write_sound(tmp_path, "b", HASH_B)
+        open(processed_path(path_b), "wb").close()
+        processed = []
+        ingest = SoundIngest(ffmpeg_path=ffmpeg_path)
+
+        stats = await ingest.process_all({HASH_A: path_a, HASH_B: path_b, "c" * 32: str(tmp_path / "missing.mp3")},
+                                         on_processed=lambda sound_hash, path: processed.append((sound_hash, path)))
+
+        # Only newly processed sounds are reported
+        assert processed == [(HASH_A, processed_path(path_a))]
+        assert stats == {"available": True, "processed": 1, "cached": 1, "failed": 0}
+
+    @pytest.mark.slow
+    @pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg isn't installed")
+    async def test_real_ffmpeg(self, tmp_path):
+        # 30 s stereo 44.1 kHz MP3
+        path = str(tmp_path / sound_file_name("tone", HASH_A))
+        subprocess.run(["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", "sine=frequency=440:duration=30",
+                        "-ac", "2", "-ar", "44100", "-b:a", "320k", path], check=True)
+        ingest = SoundIngest(max_duration_s=5)
+
+        output_path = await ingest.process(HASH_A, path)
+
+        with wave.open(output_path) as sound:
+            duration_s = sound.getnframes() / sound.getframerate()
+            print(f"\n{os.path.getsize(path)} byte MP3 -> {os.path.getsize(output_path)} byte WAV, "
+                  f"{sound.getnchannels()} channel {sound.getframerate()} Hz {duration_s:.2f} s")
+            assert sound.getnchannels() == 1
+            assert sound.getframerate() == 22050
+            assert duration_s == pytest.approx(5, abs=0.1)
@@ -0,0 +1,273 @@
+"""
+Tests for SoundPlayer's persistent vlc player and media cache.
+
+libvlc isn't available everywhere the tests run, so the unit tests swap the module's vlc
+for a small stand-in that records what the player was asked to do. The latency benchmark
+uses the real libvlc and is skipped without it.
+"""
+
+import os
+import time
+import threading
+
+import pytest
+
+from doorbot.tests.conftest import import_real_interface
+
+sound_player_module = import_real_interface('sound_player')
+AccessRecord = import_real_interface('user_manager').AccessRecord
+
+SOUND_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'sounds')
+
+
+class FakeMedia:
+    def __init__(self, path):
+        self.path = path
+        self.parsed = False
+        self.released = False
+
+    def parse_with_options(self, flags, timeout):
+        self.parsed = True
+
+    def release(self):
+        self.released = True
+
+
+class FakeEventManager:
+    def __init__(self):
+        self.callbacks = {}
+
+    def event_attach(self, event_type, callback):
+        self.callbacks[event_type] = callback
+
+
+class FakeMediaPlayer:
+    def __init__(self):
+        self.media = None
+        self.played = []
+        self.stops = 0
+        self.events = FakeEventManager()
+
+    def event_manager(self):
+        return self.events
+
+    def set_media(self, media):
+        self.media = media
+
+    def play(self):
+        self.played.append(self.media.path)
+        self.events.callbacks[FakeVlc.EventType.MediaPlayerPlaying](None)
+
+    def stop(self):
+        self.stops += 1
+
+    def is_playing(self):
+        return False
+
+
+class FakeInstance:
+    def __init__(self):
+        self.players = []
+        self.media_loaded = []
+
+    def media_player_new(self):
+        player = FakeMediaPlayer()
+        self.players.append(player)
+        return player
+
+    def media_new_path(self, path):
+        self.media_loaded.append(path)
+        return FakeMedia(path)
+
+
+class FakeVlc:
+    class EventType:
+        MediaPlayerPlaying = "MediaPlayerPlaying"
+
+    class MediaParseFlag:
+        local = 0
+
+    instances = []
+
+    @classmethod
+    def Instance(cls):
+        instance = FakeInstance()
+        cls.instances.append(instance)
+        return instance
+
+
+@pytest.fixture
+def fake_vlc(monkeypatch):
+    FakeVlc.instances = []
+    monkeypatch.setattr(sound_player_module, 'vlc', FakeVlc)
+    return FakeVlc
+
+
+def write_custom_sounds(directory, count):
+    paths = []
+    for i in range(count):
+        path = directory / f"user{i}_{i:032x}.mp3"
+        path.write_bytes(b"ID3")
+        paths.append(str(path))
+    return paths
+
+
+class TestSoundPlayer:
+
+    def test_granted_and_denied_preloaded(self, fake_vlc, tmp_path):
+        player = sound_player_module.SoundPlayer(SOUND_DIR, str(tmp_path))
+        instance = fake_vlc.instances[0]
+
+        assert sorted(os.path.basename(p) for p in instance.media_loaded) == ["denied.mp3", "granted.mp3"]
+
+        player.play_denied()
+        player.play_access_granted_for(AccessRecord("0001234567", "Test", 1, 0, 5.0))
+        player.play_denied()
+
+        # Played without loading anything else, on the one player
+        assert len(instance.media_loaded) == 2
+        assert len(instance.players) == 1
+        assert [os.path.basename(p) for p in instance.players[0].played] == ["denied.mp3", "granted.mp3", "denied.mp3"]
+
+    def test_custom_sounds_cached(self, fake_vlc, tmp_path):
+        player = sound_player_module.SoundPlayer(SOUND_DIR, str(tmp_path))
+        instance = fake_vlc.instances[0]
+        path, = write_custom_sounds(tmp_path, 1)
+        record = AccessRecord("0001234567", "Test", 1, 0, 5.0, sound_hash=f"{0:032x}", sound_path=path)
+
+        player.play_access_granted_for(record)
+        player.play_access_granted_for(record)
+
+        assert instance.media_loaded.count(path) == 1
+        assert instance.players[0].played == [path, path]
+
+    def test_cache_evicts_least_recently_played(self, fake_vlc, tmp_path):
+        player = sound_player_module.SoundPlayer(SOUND_DIR, str(tmp_path), media_cache_size=2)
+        instance = fake_vlc.instances[0]
+        a, b, c = write_custom_sounds(tmp_path, 3)
+
+        player.play_sound(a)
+        player.play_sound(b)
+        player.play_sound(a)
+        player.play_sound(c)
+        media_b = instance.media_loaded.count(b)
+
+        # b was least recently played so it was evicted, a is still loaded
+        assert list(player._media_cache) == [a, c]
+        player.play_sound(a)
+        assert instance.media_loaded.count(a) == 1
+        player.play_sound(b)
+        assert instance.media_loaded.count(b) == media_b + 1
+
+    def test_evicted_media_released(self, fake_vlc, tmp_path):
+        player = sound_player_module.SoundPlayer(SOUND_DIR, str(tmp_path), media_cache_size=1)
+        a, b = write_custom_sounds(tmp_path, 2)
+
+        player.play_sound(a)
+        media_a = player._media_cache[a]
+        player.play_sound(b)
+
+        assert media_a.released
+        # Preloaded sounds are never evicted
+        player.play_denied()
+        assert len(player._media_cache) == 1
+
+    def test_removed_sound_media_released(self, fake_vlc, tmp_path):
+        player = sound_player_module.SoundPlayer(SOUND_DIR, str(tmp_path))
+        a, = write_custom_sounds(tmp_path, 1)
+
+        player.play_sound(a)
+        media_a = player._media_cache[a]
+        player.custom_sound_removed("unused", a)
+        # Not cached, nothing to release
+        player.custom_sound_removed("unused", str(tmp_path / "missing.mp3"))
+
+        assert media_a.released
+        assert a not in player._media_cache
+
+    def test_missing_sound_not_played(self, fake_vlc, tmp_path):
+        player = sound_player_module.SoundPlayer(SOUND_DIR, str(tmp_path))
+        instance = fake_vlc.instances[0]
+
+        player.play_sound(str(tmp_path / "missing.mp3"))
+
+        assert instance.players[0].played == []
+        assert instance.players[0].stops == 1
+        assert str(tmp_path / "missing.mp3") not in player._media_cache
+
+    def test_start_latency_recorded(self, fake_vlc, tmp_path):
+        player = sound_player_module.SoundPlayer(SOUND_DIR, str(tmp_path))
+        assert player.last_start_latency_s is None
+
+        player.play_denied()
+
+        assert player.last_start_latency_s is not None
+        assert player.last_start_latency_s >= 0
+        assert player.stats()["last_start_latency_ms"] >= 0
+
+
+def libvlc_available():
+    try:
+        return sound_player_module.vlc.Instance() is not None
+    except Exception:
+        return False
+
+
+def time_until_playing(media_player):
+    """Seconds from calling play() on a new vlc MediaPlayer until it reports it is playing"""
+    started = threading.Event()
+    vlc = sound_player_module.vlc
+    media_player.event_manager().event_attach(vlc.EventType.MediaPlayerPlaying, lambda event: started.set())
+    start = time.perf_counter()
+    media_player.play()
+    assert started.wait(5), "vlc did not start playing"
+    latency = time.perf_counter() - start
+    media_player.stop()
+    return latency
+
+
+def time_sound_player_start(player, path):
+    """Start latency SoundPlayer measured for playing path"""
+    player.last_start_latency_s = None
+    player.play_sound(path)
+    deadline = time.monotonic() + 5
+    while player.last_start_latency_s is None:
+        assert time.monotonic() < deadline, "vlc did not start playing"
+        time.sleep(0.001)
+    player.player.stop()
+    return player.last_start_latency_s
+
+
+@pytest.mark.slow
+@pytest.mark.skipif(not libvlc_available(), reason="libvlc is not installed")
+class TestSoundPlayerLatency:
+    """Time from the play call until vlc reports playing. Plays real audio."""
+
+    ROUNDS = 5
+
+    def test_cold_vs_warm_start(self, tmp_path):
+        vlc = sound_player_module.vlc
+        granted = os.path.join(SOUND_DIR, "granted.mp3")
+
+        # Cold: a new MediaPlayer (and libvlc instance) per sound, as before
+        cold = []
+        for _ in range(self.ROUNDS):
+            media_player = vlc.MediaPlayer(granted)
+            cold.append(time_until_playing(media_player))
+            media_player.release()
+
+        # Warm: the persistent player with granted.mp3 preloaded
+        player = sound_player_module.SoundPlayer(SOUND_DIR, str(tmp_path))
+        time.sleep(0.5)
+        warm = []
+        for _ in range(self.ROUNDS):
+            warm.append(time_sound_player_start(player, granted))
+
+        cold_ms = sorted(t * 1000 for t in cold)
+        warm_ms = sorted(t * 1000 for t in warm)
+        print(f"\nPlay call to playing, median of {self.ROUNDS}: "
+              f"cold {cold_ms[len(cold_ms) // 2]:.1f} ms, warm {warm_ms[len(warm_ms) // 2]:.1f} ms")
+        print(f"  cold: {', '.join(f'{t:.1f}' for t in cold_ms)}")
+        print(f"  warm: {', '.join(f'{t:.1f}' for t in warm_ms)}")
+
+        assert min(warm_ms) <= max(cold_ms)
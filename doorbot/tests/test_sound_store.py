@@ -0,0 +1,168 @@
+"""
+Tests for the custom sound store's mark and sweep cleanup and LRU disk quota.
+"""
+
+import json
+import os
+
+import pytest
+
+from doorbot.interfaces.custom_sound_index import CustomSoundIndex, sound_file_name, processed_path, PART_SUFFIX
+from doorbot.interfaces.sound_store import SoundStore
+from doorbot.tests.conftest import write_sound
+
+HASH_A = "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
+HASH_B = "bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb"
+HASH_C = "cccccccccccccccccccccccccccccccc"
+
+# Contents of a 1000 byte sound file
+SOUND = bytes(1000)
+
+
+def users(*sound_hashes):
+    return {f"{i:0>10}": {"name": f"User {i}", "sound": sound_hash} for i, sound_hash in enumerate(sound_hashes)}
+
+
+@pytest.fixture
+def sounds_dir(tmp_path):
+    directory = tmp_path / "custom_sounds"
+    directory.mkdir()
+    return directory
+
+
+class TestSoundStore:
+
+    def test_unreferenced_sounds_removed(self, sounds_dir):
+        path_a = write_sound(sounds_dir, "a", HASH_A, data=SOUND)
+        path_b = write_sound(sounds_dir, "b", HASH_B, data=bytes(3000))
+        removed = []
+        store = SoundStore(str(sounds_dir), on_remove=lambda sound_hash, path: removed.append((sound_hash, path)))
+
+        store.update_references(users(HASH_A, HASH_A))
+        result = store.collect()
+
+        assert os.path.exists(path_a)
+        assert not os.path.exists(path_b)
+        assert removed == [(HASH_B, path_b)]
+        assert result["removed"] == [HASH_B]
+        assert result["reclaimed_bytes"] == 3000
+        assert result["total_bytes"] == 1000
+        assert store.manifest[HASH_A]["refs"] == 2
+
+    def test_unreferenced_partial_downloads_removed(self, sounds_dir):
+        part_path = write_sound(sounds_dir, "b", HASH_B, data=SOUND) + PART_SUFFIX
+        os.rename(part_path.removesuffix(PART_SUFFIX), part_path)
+        kept_part_path = write_sound(sounds_dir, "a", HASH_A, data=SOUND) + PART_SUFFIX
+        os.rename(kept_part_path.removesuffix(PART_SUFFIX), kept_part_path)
+        store = SoundStore(str(sounds_dir))
+
+        store.update_references(users(HASH_A))
+        result = store.collect()
+
+        assert not os.path.exists(part_path)
+        assert os.path.exists(kept_part_path)
+        assert result["removed"] == []
+        assert result["reclaimed_bytes"] == 1000
+
+    def test_quota_evicts_least_recently_used(self, sounds_dir):
+        for name, sound_hash in [("a", HASH_A), ("b", HASH_B), ("c", HASH_C)]:
+            write_sound(sounds_dir, name, sound_hash, data=SOUND)
+        store = SoundStore(str(sounds_dir), quota_bytes=2000)
+        store.update_references(users(HASH_A, HASH_B, HASH_C))
+        store.mark_used(HASH_A, now=300)
+        store.mark_used(HASH_B, now=100)
+        store.mark_used(HASH_C, now=200)
+
+        result = store.collect()
+
+        assert result["evicted"] == [HASH_B]
+        assert result["total_bytes"] == 2000
+        assert sorted(os.listdir(sounds_dir)) == sorted(
+            [sound_file_name("a", HASH_A), sound_file_name("c", HASH_C)])
+
+    def test_processed_variant_evicted_with_sound(self, sounds_dir):
+        path_a = write_sound(sounds_dir, "a", HASH_A, data=SOUND)
+        with open(processed_path(path_a), "wb") as file:
+            file.write(b"\0" * 500)
+        write_sound(sounds_dir, "b", HASH_B, data=SOUND)
+        removed = []
+        store = SoundStore(str(sounds_dir), quota_bytes=2000,
+                           on_remove=lambda sound_hash, path: removed.append(path))
+        store.update_references(users(HASH_A, HASH_B))
+        store.mark_used(HASH_A, now=100)
+        store.mark_used(HASH_B, now=200)
+
+        result = store.collect()
+
+        assert result["evicted"] == [HASH_A]
+        assert sorted(removed) == sorted([path_a, processed_path(path_a)])
+        assert result["reclaimed_bytes"] == 1500
+        assert result["total_bytes"] == 1000
+
+    def test_evicted_sound_wanted_once_played(self, sounds_dir):
+        write_sound(sounds_dir, "a", HASH_A, data=SOUND)
+        write_sound(sounds_dir, "b", HASH_B, data=SOUND)
+        store = SoundStore(str(sounds_dir), quota_bytes=1000)
+        store.update_references(users(HASH_A, HASH_B))
+        store.mark_used(HASH_A, now=100)
+        store.mark_used(HASH_B, now=200)
+        store.collect()
+
+        assert not store.wanted(HASH_A)
+        assert store.wanted(HASH_B)
+        # Still referenced, so it's kept in the manifest
+        assert store.manifest[HASH_A]["refs"] == 1
+
+        assert store.mark_used(HASH_A)
+        assert store.wanted(HASH_A)
+        assert not store.mark_used(HASH_A)
+
+    def test_manifest_persisted(self, sounds_dir):
+        write_sound(sounds_dir, "a", HASH_A, data=SOUND)
+        store = SoundStore(str(sounds_dir))
+        store.update_references(users(HASH_A))
+        store.mark_used(HASH_A, now=1234)
+        store.collect()
+
+        reloaded = SoundStore(str(sounds_dir))
+
+        assert reloaded.manifest == {HASH_A: {"refs": 1, "last_used": 1234}}
+
+    def test_manifest_saved_outside_directory(self, sounds_dir):
+        write_sound(sounds_dir, "a", HASH_A, data=SOUND)
+        index = CustomSoundIndex(str(sounds_dir))
+        store = SoundStore(str(sounds_dir))
+        store.update_references(users(HASH_A))
+        store.collect()
+
+        index.find(HASH_A)
+
+        assert store.manifest_path == str(sounds_dir.parent / "custom_sounds.manifest.json")
+        # Saving the manifest didn't make the index scan the directory again
+        assert index.scans == 1
+
+    def test_gone_sounds_forgotten(self, sounds_dir):
+        write_sound(sounds_dir, "a", HASH_A, data=SOUND)
+        store = SoundStore(str(sounds_dir))
+        store.update_references(users(HASH_A, HASH_B))
+        store.collect()
+
+        store.update_references(users(HASH_A))
+        store.collect()
+
+        assert set(store.manifest) == {HASH_A}
+        assert store.stats()["sounds"] == 1
+
+    def test_corrupt_manifest(self, sounds_dir):
+        (sounds_dir.parent / "custom_sounds.manifest.json").write_text("{not json")
+
+        store = SoundStore(str(sounds_dir))
+
+        assert store.manifest == {}
+
+    def test_missing_directory(self, tmp_path):
+        store = SoundStore(str(tmp_path / "missing"))
+        store.update_references(users(HASH_A))
+
+        assert store.collect()["total_bytes"] == 0
+        assert json.loads((tmp_path / "missing.manifest.json").read_text())[HASH_A]["refs"] == 1
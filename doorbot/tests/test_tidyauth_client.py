@@ -0,0 +1,265 @@
+"""
+Tests for TidyAuthClient's shared session and retries against a local stub server.
+"""
+
+import json
+import random
+import time
+
+import pytest
+from aiohttp import web
+
+from doorbot.tests.conftest import import_real_interface
+from doorbot.tests.tidyauth_stub import StubTidyAuth
+
+tidyauth_client = import_real_interface('tidyauth_client')
+user_manager = import_real_interface('user_manager')
+
+KEYS = {
+    "0001234567": {"name": "Test User", "door": 1, "groups": []},
+    "0007654321": {"name": "Sound User", "door": 1, "groups": [], "sound": "abc", "tidyhq": "42"},
+}
+
+
+@pytest.fixture
+async def client_for(stub_server):
+    """Returns a function that starts a stub and returns a client for it"""
+    clients = []
+
+    async def start(stub, **kwargs):
+        base_url = await stub_server(stub.app())
+        kwargs.setdefault("backoff_base_s", 0.01)
+        client = tidyauth_client.TidyAuthClient(base_url, "secret", **kwargs)
+        clients.append(client)
+        return client
+
+    yield start
+
+    for client in clients:
+        await client.close()
+
+
+class TestTidyAuthClient:
+
+    async def test_endpoints(self, client_for):
+        stub = StubTidyAuth(keys=KEYS, sounds={"42": "http://sounds/abc.mp3"})
+        client = await client_for(stub)
+
+        assert await client.test_route()
+        assert await client.get_door_keys() == KEYS
+        assert await client.get_sound_data("42") == {"url": "http://sounds/abc.mp3"}
+        assert await client.get_sound_data("7") == {"error": "No sound"}
+        assert stub.requests[1] == ("/api/v1/keys/door", {"token": "secret", "update": "tidyhq"})
+
+    async def test_invalid_token(self, client_for):
+        stub = StubTidyAuth(token="other")
+        client = await client_for(stub)
+
+        assert not await client.test_route()
+        assert await client.get_door_keys() is None
+        # Not retried
+        assert len(stub.requests) == 2
+
+    async def test_connection_is_reused(self, client_for):
+        stub = StubTidyAuth(keys=KEYS)
+        client = await client_for(stub)
+
+        assert await client.get_door_keys() == KEYS
+        client.commit_keys_validators()
+        for _ in range(4):
+            assert await client.get_door_keys() is None
+        await client.get_sound_data("42")
+
+        assert len(stub.connections) == 1
+
+    async def test_server_error_retried(self, client_for):
+        stub = StubTidyAuth(keys=KEYS)
+        stub.failures = [500, 503]
+        client = await client_for(stub)
+
+        assert await client.get_door_keys() == KEYS
+        assert stub.count("/api/v1/keys/door") == 3
+        assert client.retry_count == 2
+
+    async def test_gives_up_after_retries(self, client_for):
+        stub = StubTidyAuth(keys=KEYS)
+        stub.failures = [500] * 10
+        client = await client_for(stub, retries=2)
+
+        assert await client.get_door_keys() is None
+        assert stub.count("/api/v1/keys/door") == 3
+
+    async def test_client_error_not_retried(self, client_for):
+        stub = StubTidyAuth(keys=KEYS)
+        stub.failures = [404]
+        client = await client_for(stub)
+
+        assert await client.get_door_keys() is None
+        assert stub.count("/api/v1/keys/door") == 1
+
+    async def test_endpoint_timeout(self, client_for, monkeypatch):
+        monkeypatch.setattr(tidyauth_client, "SOUND_DATA_TIMEOUT_S", 0.05)
+        stub = StubTidyAuth(sounds={"42": "http://sounds/abc.mp3"}, delay_s=0.3)
+        client = await client_for(stub, retries=1)
+
+        start = time.monotonic()
+        assert await client.get_sound_data("42") is None
+        assert time.monotonic() - start < 0.5
+        assert stub.count("/api/v1/data/sound") == 2
+
+    async def test_unreachable_server(self):
+        client = tidyauth_client.TidyAuthClient("http://127.0.0.1:1", "secret", retries=1, backoff_base_s=0.01)
+        try:
+            assert await client.get_door_keys() is None
+            assert client.retry_count == 1
+        finally:
+            await client.close()
+
+    def test_backoff_bounded_with_jitter(self):
+        client = tidyauth_client.TidyAuthClient("http://none", "secret", backoff_base_s=0.5, backoff_max_s=8.0)
+        random.seed(3)
+
+        delays = [client.backoff_delay(attempt) for attempt in range(8)]
+
+        for attempt, delay in enumerate(delays):
+            cap = min(8.0, 0.5 * 2 ** attempt)
+            assert cap / 2 <= delay <= cap
+        assert len(set(delays)) == len(delays)
+
+
+class JsonSpy:
+    """Stands in for the json module in tidyauth_client to count parses"""
+
+    def __init__(self):
+        self.parses = 0
+
+    def loads(self, *args, **kwargs):
+        self.parses += 1
+        return json.loads(*args, **kwargs)
+
+
+@pytest.fixture
+def json_spy(monkeypatch):
+    spy = JsonSpy()
+    monkeypatch.setattr(tidyauth_client, "json", spy)
+    return spy
+
+
+class TestConditionalKeyDownload:
+
+    async def test_etag_not_modified(self, client_for, json_spy):
+        stub = StubTidyAuth(keys=KEYS, etag=True)
+        client = await client_for(stub)
+
+        assert await client.get_door_keys() == KEYS
+        client.commit_keys_validators()
+        assert await client.get_door_keys() is None
+
+        etag = stub.request_headers[1]["If-None-Match"]
+        assert etag.startswith('"')
+        assert json_spy.parses == 1
+        assert client.stats()["keys_not_modified"] == 1
+
+    async def test_last_modified_not_modified(self, client_for, json_spy):
+        stub = StubTidyAuth(keys=KEYS, last_modified="Wed, 21 Oct 2026 07:28:00 GMT")
+        client = await client_for(stub)
+
+        assert await client.get_door_keys() == KEYS
+        client.commit_keys_validators()
+        assert await client.get_door_keys() is None
+
+        assert stub.request_headers[1]["If-Modified-Since"] == "Wed, 21 Oct 2026 07:28:00 GMT"
+        assert json_spy.parses == 1
+
+    async def test_unchanged_body_not_parsed(self, client_for, json_spy):
+        """A server without validators sends the whole body, which is recognised by its hash"""
+        stub = StubTidyAuth(keys=KEYS)
+        client = await client_for(stub)
+
+        assert await client.get_door_keys() == KEYS
+        client.commit_keys_validators()
+        for _ in range(3):
+            assert await client.get_door_keys() is None
+
+        assert "If-None-Match" not in stub.request_headers[1]
+        assert json_spy.parses == 1
+        assert client.stats()["keys_unchanged"] == 3
+
+    @pytest.mark.parametrize("etag", [True, False])
+    async def test_changed_keys_downloaded(self, client_for, json_spy, etag):
+        stub = StubTidyAuth(keys=dict(KEYS), etag=etag)
+        client = await client_for(stub)
+        assert await client.get_door_keys() == KEYS
+        client.commit_keys_validators()
+
+        stub.keys["0000000001"] = {"name": "New User", "door": 1, "groups": []}
+
+        assert await client.get_door_keys() == stub.keys
+        client.commit_keys_validators()
+        assert await client.get_door_keys() is None
+        assert json_spy.parses == 2
+
+    @pytest.mark.parametrize("etag", [True, False])
+    async def test_uncommitted_keys_downloaded_again(self, client_for, json_spy, etag):
+        """Keys the caller failed to apply aren't taken as unchanged the next time"""
+        stub = StubTidyAuth(keys=KEYS, etag=etag)
+        client = await client_for(stub)
+
+        assert await client.get_door_keys() == KEYS
+        assert await client.get_door_keys() == KEYS
+        client.commit_keys_validators()
+        assert await client.get_door_keys() is None
+        assert json_spy.parses == 2
+
+    async def test_invalid_body_not_remembered(self, stub_server, json_spy):
+        bodies = ["not json {", json.dumps(KEYS)]
+
+        async def handle_keys(request):
+            return web.Response(text=bodies[0], content_type="application/json")
+
+        web_app = web.Application()
+        web_app.router.add_get('/api/v1/keys/door', handle_keys)
+        client = tidyauth_client.TidyAuthClient(await stub_server(web_app), "secret")
+        try:
+            assert await client.get_door_keys() is None
+            assert await client.get_door_keys() is None
+            assert json_spy.parses == 2
+
+            bodies.pop(0)
+            assert await client.get_door_keys() == KEYS
+        finally:
+            await client.close()
+
+    async def test_user_manager_refresh_unchanged(self, client_for, json_spy, tmp_path):
+        stub = StubTidyAuth(keys=KEYS, sounds={"42": "http://sounds/abc.mp3"})
+        client = await client_for(stub)
+        manager = user_manager.UserManager(client, str(tmp_path / "user_cache.json"))
+
+        assert await manager.download_keys()
+        assert not await manager.download_keys()
+        assert not await manager.download_keys()
+
+        assert json_spy.parses == 1
+        assert manager.lookup(7654321).name == "Sound User"
+        # Sound urls were only looked up for the first download
+        assert stub.count("/api/v1/data/sound") == 1
+
+    async def test_user_manager_save_failure_downloads_again(self, client_for, json_spy, tmp_path):
+        stub = StubTidyAuth(keys=KEYS, etag=True)
+        client = await client_for(stub)
+        manager = user_manager.UserManager(client, str(tmp_path / "user_cache.json"))
+        save_keys = manager._save_keys
+
+        def fail_save():
+            raise OSError("No space left on device")
+
+        manager._save_keys = fail_save
+        with pytest.raises(OSError):
+            await manager.download_keys()
+        manager._save_keys = save_keys
+
+        # Parsed again rather than taken as unchanged from the ETag
+        await manager.download_keys()
+        assert json_spy.parses == 2
+        assert "If-None-Match" not in stub.request_headers[1]
+        assert manager.lookup(7654321).name == "Sound User"
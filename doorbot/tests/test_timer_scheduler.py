@@ -0,0 +1,222 @@
+"""
+Tests for the TimerScheduler that runs doorbot's relock, LED reset, key refresh and polling timers.
+"""
+
+import asyncio
+import random
+import time
+
+import pytest
+
+from doorbot.interfaces.timer_scheduler import TimerScheduler
+
+# How late a timer may fire and still count as on time
+ACCURACY_S = 0.010
+
+
+@pytest.fixture
+async def scheduler():
+    scheduler = TimerScheduler()
+    task = asyncio.create_task(scheduler.run())
+    yield scheduler
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def recorder():
+    """Callback that records the times it was called"""
+    calls = []
+
+    def callback():
+        calls.append(time.monotonic())
+    callback.calls = calls
+    return callback
+
+
+class TestTimerScheduler:
+
+    async def test_fires_at_deadline(self, scheduler):
+        relock = recorder()
+        scheduler.add('door_relock', relock)
+        await asyncio.sleep(0.05)
+        assert relock.calls == []
+
+        scheduled_at = time.monotonic()
+        scheduler.schedule('door_relock', 0.1)
+        await asyncio.sleep(0.2)
+
+        assert len(relock.calls) == 1
+        assert 0.1 <= relock.calls[0] - scheduled_at < 0.1 + ACCURACY_S
+
+    async def test_fires_in_deadline_order(self, scheduler):
+        order = []
+        for name in ['a', 'b', 'c']:
+            scheduler.add(name, lambda name=name: order.append(name))
+        scheduler.schedule('c', 0.06)
+        scheduler.schedule('a', 0.02)
+        scheduler.schedule('b', 0.04)
+        await asyncio.sleep(0.1)
+
+        assert order == ['a', 'b', 'c']
+
+    async def test_schedule_replaces_deadline(self, scheduler):
+        blinkstick = recorder()
+        scheduler.add('blinkstick_white', blinkstick)
+
+        scheduler.schedule('blinkstick_white', 0.05)
+        scheduler.schedule('blinkstick_white', 0.15)
+        scheduled_at = time.monotonic()
+        await asyncio.sleep(0.25)
+
+        assert len(blinkstick.calls) == 1
+        assert blinkstick.calls[0] - scheduled_at >= 0.15
+
+        # Brought earlier
+        scheduler.schedule('blinkstick_white', 1)
+        scheduler.schedule('blinkstick_white', 0.02)
+        await asyncio.sleep(0.05)
+        assert len(blinkstick.calls) == 2
+
+    async def test_cancel(self, scheduler):
+        relock = recorder()
+        scheduler.add('door_relock', relock)
+        scheduler.schedule('door_relock', 0.05)
+        assert scheduler.remaining('door_relock') > 0
+
+        scheduler.cancel('door_relock')
+        await asyncio.sleep(0.1)
+
+        assert relock.calls == []
+        assert scheduler.remaining('door_relock') is None
+
+    async def test_periodic(self, scheduler):
+        poll = recorder()
+        scheduler.add('door_sensor', poll, interval_s=0.05, delay_s=0)
+        await asyncio.sleep(0.23)
+
+        assert len(poll.calls) == 5
+
+    async def test_added_before_running(self):
+        """The app adds its timers at import, before the loop is running"""
+        poll = recorder()
+        scheduler = TimerScheduler()
+        scheduler.add('door_sensor', poll, interval_s=10, delay_s=0)
+
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.01)
+        task.cancel()
+
+        assert len(poll.calls) == 1
+
+    async def test_duplicate_name(self, scheduler):
+        scheduler.add('door_relock', recorder())
+        with pytest.raises(ValueError):
+            scheduler.add('door_relock', recorder())
+
+    async def test_coroutine_runs_as_task(self, scheduler):
+        relock = recorder()
+        started = asyncio.Event()
+
+        async def slow_update():
+            started.set()
+            await asyncio.sleep(0.2)
+
+        scheduler.add('keys_update', slow_update)
+        scheduler.add('door_relock', relock)
+        scheduler.schedule('keys_update', 0)
+        await started.wait()
+
+        # Not held up by the running update
+        scheduler.schedule('door_relock', 0.02)
+        await asyncio.sleep(0.05)
+        assert len(relock.calls) == 1
+
+    async def test_coroutine_due_while_running_runs_again(self, scheduler):
+        runs = 0
+
+        async def update():
+            nonlocal runs
+            runs += 1
+            await asyncio.sleep(0.1)
+
+        scheduler.add('keys_update', update)
+        scheduler.schedule('keys_update', 0)
+        await asyncio.sleep(0.02)
+
+        # Eg. a denied read while the keys are downloading
+        scheduler.schedule('keys_update', 0)
+        scheduler.schedule('keys_update', 0.01)
+        await asyncio.sleep(0.3)
+
+        assert runs == 2
+        assert scheduler.timers['keys_update'].skipped == 1
+
+    async def test_exception_backoff(self, scheduler):
+        calls = []
+
+        def poll():
+            calls.append(time.monotonic())
+            raise RuntimeError("read failed")
+
+        scheduler.add('door_sensor', poll, interval_s=0.01, delay_s=0, error_backoff_s=0.1)
+        await asyncio.sleep(0.15)
+
+        assert len(calls) == 2
+        assert calls[1] - calls[0] >= 0.1
+        assert scheduler.timers['door_sensor'].errors == 2
+
+    async def test_coroutine_exception_backoff(self, scheduler):
+        calls = []
+
+        async def update():
+            calls.append(time.monotonic())
+            raise RuntimeError("download failed")
+
+        scheduler.add('keys_update', update, interval_s=0.01, delay_s=0, error_backoff_s=0.1)
+        await asyncio.sleep(0.15)
+
+        assert len(calls) == 2
+        assert scheduler.stats()['keys_update']['errors'] == 2
+
+    async def test_stats(self, scheduler):
+        scheduler.add('door_relock', recorder())
+        scheduler.add('blinkstick_white', recorder())
+        scheduler.schedule('door_relock', 0.01)
+        await asyncio.sleep(0.05)
+
+        stats = scheduler.stats()
+
+        assert stats['door_relock']['fired'] == 1
+        assert stats['door_relock']['jitter_ms']['count'] == 1
+        assert 0 <= stats['door_relock']['jitter_ms']['p99'] < ACCURACY_S * 1000
+        assert stats['blinkstick_white'] == {'fired': 0, 'skipped': 0, 'errors': 0}
+
+    async def test_idle_wakeups(self, scheduler):
+        scheduler.add('door_relock', recorder())
+        scheduler.add('keys_update', recorder(), interval_s=3600)
+        await asyncio.sleep(0.2)
+
+        assert scheduler.wakeups == 0
+
+
+@pytest.mark.slow
+class TestTimerSchedulerBenchmark:
+
+    TIMERS = 200
+    SPAN_S = 2.0
+
+    async def test_dispatch_jitter(self, scheduler):
+        rng = random.Random(12)
+        for i in range(self.TIMERS):
+            scheduler.add(f"timer{i}", recorder(), delay_s=rng.uniform(0, self.SPAN_S))
+
+        await asyncio.sleep(self.SPAN_S + 0.1)
+
+        jitter_ms = sorted(stats['jitter_ms']['p50'] for stats in scheduler.stats().values())
+        p50 = jitter_ms[len(jitter_ms) // 2]
+        p99 = jitter_ms[int(len(jitter_ms) * 0.99)]
+        print(f"\n{self.TIMERS} timers over {self.SPAN_S} s: dispatch late by p50 {p50:.2f} ms, "
+              f"p99 {p99:.2f} ms, max {jitter_ms[-1]:.2f} ms ({scheduler.wakeups} wakeups)")
+
+        assert len(jitter_ms) == self.TIMERS
+        assert p99 < 50
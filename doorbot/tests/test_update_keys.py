@@ -0,0 +1,191 @@
+"""
+Tests for the update_keys timer callback and download_sounds in app.py.
+"""
+
+import asyncio
+from unittest.mock import AsyncMock, Mock, patch
+
+from doorbot import app
+from doorbot.interfaces.key_diff import KeyChanges
+from doorbot.interfaces.key_refresh import KeyRefresh
+from doorbot.interfaces.sound_store import SoundStore
+from doorbot.interfaces.custom_sound_index import sound_file_name
+
+
+def changes(added=(), removed=(), modified=(), sounds=()):
+    key_changes = KeyChanges(list(added), list(removed), list(modified))
+    key_changes.sounds.update(sounds)
+    return key_changes
+
+
+async def wait_for(condition, timeout=1.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise TimeoutError("Condition not met")
+        await asyncio.sleep(0.01)
+
+
+def mock_downloader(directory):
+    return Mock(download_all=AsyncMock(return_value={"downloaded": 0, "failed": 0, "resumed": 0}),
+                sound_path=lambda sound_hash, url: str(directory / sound_file_name("sound", sound_hash)),
+                failed_hashes=set())
+
+
+class TestUpdateKeys:
+
+    async def test_change_summary_posted(self):
+        post = AsyncMock(return_value={"ts": "1.0"})
+        key_changes = changes(added=["1", "2", "3"], removed=["4"], modified=["5", "6"], sounds=["1"])
+        with patch.object(app.user_manager, "download_keys", AsyncMock(return_value=key_changes), create=True), \
+                patch.object(app.app.client, "chat_postMessage", post), \
+                patch.object(app, "start_download_sounds") as download_sounds:
+            await app.update_keys()
+
+        assert post.call_args.kwargs["text"] == "Key list has changed (TidyAuth): +3 / −1 / ~2"
+        download_sounds.assert_called_once_with({"1"})
+
+    async def test_nothing_changed(self):
+        post = AsyncMock()
+        with patch.object(app.user_manager, "download_keys", AsyncMock(return_value=changes()), create=True), \
+                patch.object(app.app.client, "chat_postMessage", post), \
+                patch.object(app, "start_download_sounds") as download_sounds:
+            await app.update_keys()
+
+        assert not post.called
+        assert not download_sounds.called
+
+    async def test_sound_url_only_change(self):
+        post = AsyncMock()
+        with patch.object(app.user_manager, "download_keys",
+                          AsyncMock(return_value=changes(sounds=["7"])), create=True), \
+                patch.object(app.app.client, "chat_postMessage", post), \
+                patch.object(app, "start_download_sounds") as download_sounds:
+            await app.update_keys()
+
+        assert not post.called
+        download_sounds.assert_called_once_with({"7"})
+
+    async def test_sound_round_does_not_hold_up_key_refresh(self):
+        download_keys = AsyncMock(return_value=changes(sounds=["1"]))
+        lock = asyncio.Lock()
+        rounds_done = []
+
+        async def download_sounds(keys=None):
+            async with lock:
+                rounds_done.append(keys)
+
+        key_refresh = KeyRefresh(app.update_keys, min_interval_s=0)
+        with patch.object(app.user_manager, "download_keys", download_keys, create=True), \
+                patch.object(app, "download_sounds", download_sounds):
+            # A long sound round, eg. the one at startup
+            await lock.acquire()
+
+            await asyncio.wait_for(key_refresh.run(), 1)
+            # Then a denied read asks for the keys in case the card was just added
+            assert key_refresh.request() == "started"
+            await wait_for(lambda: download_keys.await_count == 2 and not key_refresh.in_flight())
+
+            # The sound rounds queued by each refresh run once the lock is free
+            lock.release()
+            await wait_for(lambda: len(rounds_done) == 2)
+
+
+class TestDownloadSounds:
+
+    async def test_evicted_sounds_skipped_and_store_collected(self, tmp_path):
+        users = {"0000000001": {"name": "A", "sound": "a" * 32, "sound_url": "http://x/a.mp3"},
+                 "0000000002": {"name": "B", "sound": "b" * 32, "sound_url": "http://x/b.mp3"}}
+        store = SoundStore(str(tmp_path / "custom_sounds"))
+        store.update_references(users)
+        store.manifest["b" * 32]["evicted"] = store.manifest["b" * 32]["last_used"] + 1
+        downloader = mock_downloader(tmp_path)
+
+        with patch.object(app, "sound_store", store), \
+                patch.object(app.user_manager, "get_users_with_custom_sounds", return_value=users, create=True), \
+                patch.object(app, "SoundDownloader", return_value=downloader) as sound_downloader:
+            await app.download_sounds()
+
+        assert list(sound_downloader.call_args.kwargs["users_with_custom_sounds"]) == ["0000000001"]
+        assert (tmp_path / "custom_sounds.manifest.json").exists()
+
+    async def test_store_kept_without_keys(self, tmp_path):
+        users = {"0000000001": {"name": "A", "sound": "a" * 32, "sound_url": "http://x/a.mp3"}}
+        store = SoundStore(str(tmp_path / "custom_sounds"))
+        store.update_references(users)
+
+        with patch.object(app, "sound_store", store), \
+                patch.object(app.user_manager, "get_users_with_custom_sounds", return_value={}, create=True), \
+                patch.object(app.user_manager, "key_count", return_value=0, create=True), \
+                patch.object(app, "SoundDownloader", return_value=mock_downloader(tmp_path)):
+            await app.download_sounds()
+
+        assert "a" * 32 in store.manifest
+
+    async def test_sounds_processed(self, tmp_path):
+        users = {"0000000001": {"name": "A", "sound": "a" * 32, "sound_url": "http://x/a.mp3"}}
+        ingest = Mock(process_all=AsyncMock())
+
+        with patch.object(app, "sound_store", SoundStore(str(tmp_path))), \
+                patch.object(app, "sound_ingest", ingest), \
+                patch.object(app.user_manager, "get_users_with_custom_sounds", return_value=users, create=True), \
+                patch.object(app, "SoundDownloader", return_value=mock_downloader(tmp_path)):
+            await app.download_sounds()
+
+        sounds = ingest.process_all.call_args.args[0]
+        assert sounds == {"a" * 32: str(tmp_path / sound_file_name("sound", "a" * 32))}
+        assert ingest.process_all.call_args.kwargs["on_processed"] == app.custom_sound_processed
+
+    async def test_rounds_do_not_overlap(self, tmp_path):
+        users = {"0000000001": {"name": "A", "sound": "a" * 32, "sound_url": "http://x/a.mp3"}}
+        running = []
+        overlapped = []
+
+        async def download_all():
+            overlapped.append(bool(running))
+            running.append(True)
+            await asyncio.sleep(0.05)
+            running.pop()
+            return {"downloaded": 0, "failed": 0, "resumed": 0}
+
+        downloader = mock_downloader(tmp_path)
+        downloader.download_all = download_all
+        with patch.object(app, "sound_store", SoundStore(str(tmp_path / "custom_sounds"))), \
+                patch.object(app, "sound_download_lock", asyncio.Lock()), \
+                patch.object(app.user_manager, "get_users_with_custom_sounds", return_value=users, create=True), \
+                patch.object(app, "SoundDownloader", return_value=downloader):
+            # Startup and the first key update
+            await asyncio.gather(app.download_sounds(), app.download_sounds({"0000000001"}))
+
+        assert overlapped == [False, False]
+
+    def test_processed_sound_used_straight_away(self):
+        with patch.object(app.user_manager, "update_sound") as update_sound, \
+                patch.object(app.sound_player, "custom_sound_downloaded") as custom_sound_downloaded:
+            app.custom_sound_processed("a" * 32, "/sounds/a.wav")
+
+        custom_sound_downloaded.assert_called_once_with("a" * 32, "/sounds/a.wav")
+        update_sound.assert_called_once_with("a" * 32, "/sounds/a.wav")
+
+    async def test_failed_sounds_retried_after_next_refresh(self, tmp_path):
+        users = {"0000000001": {"name": "A", "sound": "a" * 32, "sound_url": "http://x/a.mp3"},
+                 "0000000002": {"name": "B", "sound": "b" * 32, "sound_url": "http://x/b.mp3"}}
+        downloader = mock_downloader(tmp_path)
+        downloader.failed_hashes = {"b" * 32}
+
+        with patch.object(app, "sound_store", SoundStore(str(tmp_path / "custom_sounds"))), \
+                patch.object(app, "sound_retry_keys", set()), \
+                patch.object(app.user_manager, "get_users_with_custom_sounds", return_value=users, create=True), \
+                patch.object(app, "SoundDownloader", return_value=downloader):
+            await app.download_sounds()
+            assert app.sound_retry_keys == {"0000000002"}
+
+            # Nothing changed, but the failed sound is tried again
+            with patch.object(app.user_manager, "download_keys", AsyncMock(return_value=changes()), create=True), \
+                    patch.object(app, "start_download_sounds") as start_download_sounds:
+                await app.update_keys()
+            start_download_sounds.assert_called_once_with({"0000000002"})
+
+            downloader.failed_hashes = set()
+            await app.download_sounds({"0000000002"})
+            assert app.sound_retry_keys == set()
@@ -0,0 +1,218 @@
+"""
+Tests for UserManager's integer keyed authorisation index and key downloads.
+
+The real user_manager module is loaded (conftest mocks it for doorbot.app).
+"""
+
+import json
+import time
+
+import pytest
+
+from doorbot.interfaces import key_cache
+from doorbot.tests.conftest import import_real_interface, FakeApiClient, USERS
+
+user_manager_module = import_real_interface('user_manager')
+UserManager = user_manager_module.UserManager
+
+def users_with_sounds(count, start=1000):
+    """Keys for count users each with their own sound, and the sound data for them"""
+    keys = {}
+    sounds = {}
+    for i in range(start, start + count):
+        keys[f"{i:0>10}"] = {"door": 1, "groups": [], "name": f"User {i}", "sound": f"{i:032x}", "tidyhq": i}
+        sounds[i] = {"url": f"https://example.com/{i}.mp3"}
+    return keys, sounds
+
+
+def resolver(sound_hash):
+    return f"/sounds/gadget_whoo_{sound_hash}.mp3"
+
+
+class TestAuthorisationIndex:
+
+    def test_index_built_on_load(self, cache_path):
+        manager = UserManager(FakeApiClient(), cache_path, sound_resolver=resolver)
+
+        record = manager.lookup(123456789)
+        assert record.key == "0123456789"
+        assert record.name == "Gentleman"
+        assert record.door == 3
+        assert record.flags == 0
+        assert record.unlock_time_s == user_manager_module.DEFAULT_UNLOCK_TIME_S
+        assert record.sound_path == "/sounds/gadget_whoo_cd3d9dd904aca51abc55dbe7b7cc7b28.mp3"
+
+    def test_delayed_group(self, cache_path):
+        manager = UserManager(FakeApiClient(), cache_path)
+
+        record = manager.lookup(42)
+        assert record.flags & user_manager_module.FLAG_DELAYED
+        assert record.unlock_time_s == user_manager_module.DELAYED_UNLOCK_TIME_S
+        assert record.sound_hash is None
+        assert record.sound_path is None
+
+    def test_unknown_card(self, cache_path):
+        manager = UserManager(FakeApiClient(), cache_path)
+        assert manager.lookup(999) is None
+
+    def test_records_are_compact(self, cache_path):
+        record = UserManager(FakeApiClient(), cache_path).lookup(42)
+        assert not hasattr(record, "__dict__")
+
+    def test_no_cache_file(self, tmp_path):
+        manager = UserManager(FakeApiClient(), str(tmp_path / "missing.json"))
+        assert manager.index == {}
+        assert manager.lookup(42) is None
+
+    def test_json_api_still_works(self, cache_path):
+        manager = UserManager(FakeApiClient(), cache_path)
+        assert manager.is_key_authorised("0123456789")
+        assert not manager.is_key_authorised("123456789")
+        assert manager.get_user_details("0000000042")["name"] == "Lady"
+        assert manager.key_count() == 2
+        assert list(manager.get_users_with_custom_sounds()) == ["0123456789"]
+
+    def test_resolve_sounds_after_download(self, cache_path):
+        downloaded = {}
+        manager = UserManager(FakeApiClient(), cache_path, sound_resolver=downloaded.get)
+        assert manager.lookup(123456789).sound_path is None
+
+        downloaded["cd3d9dd904aca51abc55dbe7b7cc7b28"] = "/sounds/whoo.mp3"
+        manager.resolve_sounds()
+        assert manager.lookup(123456789).sound_path == "/sounds/whoo.mp3"
+
+    def test_update_sound(self, cache_path):
+        manager = UserManager(FakeApiClient(), cache_path, sound_resolver=lambda sound_hash: "/sounds/whoo.mp3")
+
+        manager.update_sound("cd3d9dd904aca51abc55dbe7b7cc7b28", "/sounds/whoo.wav")
+        assert manager.lookup(123456789).sound_path == "/sounds/whoo.wav"
+
+        manager.forget_sound("cd3d9dd904aca51abc55dbe7b7cc7b28")
+        assert manager.lookup(123456789).sound_path is None
+
+    async def test_index_rebuilt_when_keys_change(self, cache_path):
+        new_keys = dict(USERS)
+        new_keys["0000000007"] = {"door": 1, "groups": [], "name": "New", "tidyhq": 7}
+        del new_keys["0000000042"]
+        manager = UserManager(FakeApiClient(keys=new_keys), cache_path)
+
+        assert await manager.download_keys()
+        assert manager.lookup(7).name == "New"
+        assert manager.lookup(42) is None
+        assert manager.lookup(123456789) is not None
+
+
+class TestDownloadKeys:
+
+    async def test_sound_urls_looked_up_concurrently(self, tmp_path):
+        keys, sounds = users_with_sounds(20)
+        api_client = FakeApiClient(keys=keys, sounds=sounds, sound_delay_s=0.01)
+        manager = UserManager(api_client, str(tmp_path / "cache.json"), max_sound_fetches=5)
+
+        assert await manager.download_keys()
+
+        assert api_client.max_in_flight == 5
+        assert len(api_client.sound_requests) == 20
+        assert manager.get_user_details("0000001000")["sound_url"] == "https://example.com/1000.mp3"
+        saved = key_cache.KeyCache(str(tmp_path / "cache.json")).load()
+        assert saved["0000001019"]["sound_url"] == "https://example.com/1019.mp3"
+
+    async def test_keys_applied_before_sound_lookups(self, cache_path):
+        keys = dict(USERS)
+        keys["0000000007"] = {"door": 1, "groups": [], "name": "New", "sound": "77", "tidyhq": 7}
+        del keys["0000000042"]
+        api_client = FakeApiClient(keys=keys, sounds={7: {"url": "https://example.com/7.mp3"}})
+        manager = UserManager(api_client, cache_path)
+
+        seen = []
+        api_client.on_sound_request = lambda tidyhq_id: seen.append(
+            (manager.lookup(7) is not None, manager.lookup(42) is None))
+
+        assert await manager.download_keys()
+        assert seen == [(True, True)]
+        assert manager.get_user_details("0000000007")["sound_url"] == "https://example.com/7.mp3"
+
+    async def test_unchanged_sounds_not_looked_up(self, cache_path):
+        keys = json.loads(json.dumps(USERS))
+        for user in keys.values():
+            user.pop("sound_url", None)
+        api_client = FakeApiClient(keys=keys)
+        manager = UserManager(api_client, cache_path)
+
+        assert not await manager.download_keys()
+        assert api_client.sound_requests == []
+        assert manager.get_user_details("0123456789")["sound_url"] == "https://example.com/gadget_whoo.mp3"
+
+    async def test_missing_sound_url_looked_up_again(self, tmp_path):
+        keys, sounds = users_with_sounds(2)
+        api_client = FakeApiClient(keys=keys)
+        manager = UserManager(api_client, str(tmp_path / "cache.json"))
+
+        # Lookups fail the first time
+        assert await manager.download_keys()
+        assert "sound_url" not in manager.get_user_details("0000001000")
+
+        api_client.sounds = sounds
+        assert await manager.download_keys()
+        assert manager.get_user_details("0000001000")["sound_url"] == "https://example.com/1000.mp3"
+        assert len(api_client.sound_requests) == 4
+
+    async def test_only_changed_index_entries_updated(self, cache_path):
+        keys = json.loads(json.dumps(USERS))
+        keys["0000000042"]["door"] = 2
+        keys["0000000007"] = {"door": 1, "groups": [], "name": "New", "tidyhq": 7}
+        manager = UserManager(FakeApiClient(keys=keys), cache_path)
+        unchanged_record = manager.lookup(123456789)
+
+        changes = await manager.download_keys()
+
+        assert changes.added == ["0000000007"]
+        assert changes.modified == ["0000000042"]
+        assert changes.removed == []
+        assert manager.lookup(123456789) is unchanged_record
+        assert manager.lookup(42).door == 2
+        assert manager.lookup(7).name == "New"
+
+    async def test_changed_sounds_reported(self, cache_path):
+        keys = json.loads(json.dumps(USERS))
+        keys["0123456789"]["sound"] = "new_hash"
+        keys["0000000007"] = {"door": 1, "groups": [], "name": "New", "sound": "77", "tidyhq": 7}
+        keys["0000000008"] = {"door": 1, "groups": [], "name": "No sound url", "sound": "88", "tidyhq": 8}
+        sounds = {4321: {"url": "https://example.com/new.mp3"}, 7: {"url": "https://example.com/7.mp3"}}
+        manager = UserManager(FakeApiClient(keys=keys, sounds=sounds), cache_path)
+
+        changes = await manager.download_keys()
+
+        assert changes.summary() == "+2 / −0 / ~1"
+        # Only sounds that can be downloaded
+        assert changes.sounds == {"0123456789", "0000000007"}
+        assert set(manager.get_users_with_custom_sounds(changes.sounds)) == {"0123456789", "0000000007"}
+
+
+@pytest.mark.slow
+class TestDownloadKeysBenchmark:
+
+    USERS = 200
+    SOUND_DELAY_S = 0.005
+
+    async def test_sequential_vs_concurrent_lookups(self, tmp_path):
+        keys, sounds = users_with_sounds(self.USERS)
+
+        async def time_download(max_sound_fetches):
+            api_client = FakeApiClient(keys=keys, sounds=sounds, sound_delay_s=self.SOUND_DELAY_S)
+            manager = UserManager(api_client, str(tmp_path / f"cache{max_sound_fetches}.json"),
+                                  max_sound_fetches=max_sound_fetches)
+            applied = []
+            api_client.on_sound_request = lambda tidyhq_id: applied.append(time.perf_counter())
+            start = time.perf_counter()
+            assert await manager.download_keys()
+            return applied[0] - start, time.perf_counter() - start
+
+        sequential_applied, sequential = await time_download(1)
+        concurrent_applied, concurrent = await time_download(8)
+
+        print(f"\n{self.USERS} sound url lookups of {self.SOUND_DELAY_S * 1000:.0f} ms: "
+              f"one at a time {sequential * 1000:.0f} ms, 8 at once {concurrent * 1000:.0f} ms "
+              f"(keys applied after {concurrent_applied * 1000:.1f} ms)")
+
+        assert concurrent < sequential / 3
@@ -0,0 +1,119 @@
+"""
+Tests for the wiegand format registry, including a decode throughput comparison with the
+previous bit loop parity check.
+"""
+
+import random
+import time
+
+import pytest
+
+from doorbot.interfaces import wiegand_formats
+
+
+def legacy_decode(bits, value):
+    """The parity check and card id extraction previously in wiegand_key_reader.callback"""
+    if bits == 26 or bits == 34:
+        count_trailing = 0
+        for i in range(0, bits//2):
+            if (value >> i) & 0x01 == 0x01:
+                count_trailing += 1
+        trailing_parity_odd = (count_trailing % 2 == 1)
+
+        count_leading = 0
+        for i in range(bits//2, bits):
+            if (value >> i) & 0x01 == 0x01:
+                count_leading += 1
+        leading_parity_even = (count_leading % 2 == 0)
+
+        if trailing_parity_odd and leading_parity_even:
+            return (value >> 1) & (2**(bits-2)-1)
+    return None
+
+
+def decode(bits, value):
+    wiegand_format = wiegand_formats.lookup(bits)
+    if wiegand_format is not None and wiegand_format.parity_ok(value):
+        return wiegand_format.card_id(value)
+    return None
+
+
+class TestWiegandFormats:
+
+    @pytest.mark.parametrize("bits", [26, 34])
+    def test_matches_legacy_decoder(self, bits):
+        rng = random.Random(bits)
+        for _ in range(5000):
+            value = rng.getrandbits(bits)
+            assert decode(bits, value) == legacy_decode(bits, value)
+
+    def test_known_26_bit_frame(self):
+        assert decode(26, 0x2468AC) == 0x123456
+        assert wiegand_formats.lookup(26).encode(0x123456) == 0x2468AC
+
+    @pytest.mark.parametrize("bits", [26, 34, 35, 37])
+    def test_encode_round_trip_and_single_bit_errors(self, bits):
+        wiegand_format = wiegand_formats.lookup(bits)
+        rng = random.Random(bits)
+        for _ in range(200):
+            card_id = rng.getrandbits(wiegand_format.id_mask.bit_length())
+            frame = wiegand_format.encode(card_id)
+            assert wiegand_format.parity_ok(frame)
+            assert wiegand_format.card_id(frame) == card_id
+
+            for bit in range(bits):
+                assert not wiegand_format.parity_ok(frame ^ (1 << bit))
+
+    def test_corporate_1000_fields(self):
+        company, card_number = 0x123, 0x45678
+        card_id = (company << 20) | card_number
+        frame = wiegand_formats.lookup(35).encode(card_id)
+
+        # Company code is positions 2-13, card number 14-33
+        assert (frame >> 21) & 0xFFF == company
+        assert (frame >> 1) & 0xFFFFF == card_number
+        assert decode(35, frame) == card_id
+
+    def test_corporate_1000_overall_parity_is_odd(self):
+        frame = wiegand_formats.lookup(35).encode(0xDEADBEEF)
+        assert frame.bit_count() % 2 == 1
+
+    def test_h10304_fields(self):
+        facility, card_number = 0xABCD, 0x12345
+        card_id = (facility << 19) | card_number
+        frame = wiegand_formats.lookup(37).encode(card_id)
+
+        assert (frame >> 20) & 0xFFFF == facility
+        assert (frame >> 1) & 0x7FFFF == card_number
+        assert decode(37, frame) == card_id
+
+    def test_nfc_uid_is_raw(self):
+        assert decode(32, 0x04A1B2C3) == 0x04A1B2C3
+
+    def test_unknown_length(self):
+        assert wiegand_formats.lookup(12) is None
+
+
+@pytest.mark.slow
+class TestWiegandFormatsBenchmark:
+
+    FRAMES = 50000
+
+    @pytest.mark.parametrize("bits", [26, 34])
+    def test_decode_throughput(self, bits):
+        rng = random.Random(0)
+        wiegand_format = wiegand_formats.lookup(bits)
+        frames = [wiegand_format.encode(rng.getrandbits(bits - 2)) for _ in range(self.FRAMES)]
+
+        def rate(decoder):
+            start = time.perf_counter()
+            for frame in frames:
+                decoder(bits, frame)
+            return self.FRAMES / (time.perf_counter() - start)
+
+        legacy_rate = rate(legacy_decode)
+        new_rate = rate(decode)
+        print(f"\n{bits}-bit decode: legacy {legacy_rate:,.0f} frames/s, "
+              f"format registry {new_rate:,.0f} frames/s ({new_rate / legacy_rate:.1f}x)")
+
+        assert new_rate > legacy_rate
@@ -0,0 +1,153 @@
+"""
+Tests for the event driven key reader.
+
+The real wiegand_key_reader module is loaded (conftest mocks it for doorbot.app) and
+reads are pushed from a separate thread like the pigpio callback thread does.
+"""
+
+import asyncio
+import threading
+
+import pytest
+
+from doorbot.tests.conftest import MockPi, import_real_interface
+
+wiegand_key_reader = import_real_interface('wiegand_key_reader')
+
+# 26-bit frame for card id 0x123456 with valid parity
+VALID_26_BIT_FRAME = 0x2468AC
+
+
+def make_26_bit_frame(card_id):
+    """Build a 26-bit frame: even parity over the leading 12 bits, odd over the trailing 12"""
+    frame = card_id << 1
+    if bin(frame >> 13).count("1") % 2 == 1:
+        frame |= 1 << 25
+    if bin(frame & 0x1FFF).count("1") % 2 == 0:
+        frame |= 1
+    return frame
+
+
+def push_from_thread(bits, value):
+    """Call the decoder callback from another thread, like pigpio does"""
+    thread = threading.Thread(target=wiegand_key_reader.callback_rfid, args=(bits, value))
+    thread.start()
+    thread.join()
+
+
+class TestKeyReaderQueue:
+
+    @pytest.fixture
+    def key_reader(self):
+        return wiegand_key_reader.KeyReader(MockPi())
+
+    async def test_idle_consumer_never_wakes(self, key_reader):
+        """While no keys are presented the consumer should stay asleep"""
+        consumer = asyncio.create_task(key_reader.next_read())
+        await asyncio.sleep(0.5)
+
+        # The old polling loop would have woken 5 times in this period
+        assert key_reader.wakeups == 0
+        assert not consumer.done()
+        consumer.cancel()
+
+    async def test_key_from_other_thread_wakes_consumer(self, key_reader):
+        consumer = asyncio.create_task(key_reader.next_read())
+        await asyncio.sleep(0)
+
+        push_from_thread(26, VALID_26_BIT_FRAME)
+        event = await asyncio.wait_for(consumer, timeout=1)
+
+        assert event.is_key()
+        assert event.card_id == 0x123456
+        assert event.reader_type == "RFID"
+        assert key_reader.wakeups == 1
+
+    async def test_errors_are_queued(self, key_reader):
+        push_from_thread(26, VALID_26_BIT_FRAME ^ 1)
+        push_from_thread(12, 0xFFF)
+
+        parity_error = await asyncio.wait_for(key_reader.next_read(), timeout=1)
+        bits_error = await asyncio.wait_for(key_reader.next_read(), timeout=1)
+
+        assert not parity_error.is_key()
+        assert "Invalid Parity" in parity_error.error
+        assert "Unexpected Number Bits" in bits_error.error
+
+    async def test_reads_before_loop_are_kept_in_order(self, key_reader):
+        """Reads arriving while the app is starting up are delivered once the consumer starts"""
+        push_from_thread(26, VALID_26_BIT_FRAME)
+        push_from_thread(12, 0xFFF)
+
+        first = await asyncio.wait_for(key_reader.next_read(), timeout=1)
+        second = await asyncio.wait_for(key_reader.next_read(), timeout=1)
+
+        assert first.card_id == 0x123456
+        assert not second.is_key()
+
+
+class TestKeyReaderSuppression:
+
+    def make_reader(self, **kwargs):
+        return wiegand_key_reader.KeyReader(MockPi(), **kwargs)
+
+    def key(self, card_id, reader_type="RFID"):
+        return wiegand_key_reader.ReadEvent(reader_type, card_id=card_id)
+
+    async def test_held_card_is_merged(self):
+        reader = self.make_reader(duplicate_window_s=10)
+        for _ in range(20):
+            reader.push(self.key(1))
+
+        assert (await reader.next_read()).card_id == 1
+        assert reader.queue.empty()
+        assert reader.merged == 19
+
+    async def test_repeat_after_window_is_read(self):
+        reader = self.make_reader(duplicate_window_s=0.05)
+        reader.push(self.key(1))
+        await asyncio.sleep(0.1)
+        reader.push(self.key(1))
+
+        assert reader.merged == 0
+        assert reader.stats()["pending"] == 2
+
+    async def test_readers_and_cards_are_separate(self):
+        reader = self.make_reader(duplicate_window_s=10)
+        reader.push(self.key(1, "RFID"))
+        reader.push(self.key(1, "NFC"))
+        reader.push(self.key(2, "RFID"))
+        reader.push(self.key(1, "RFID"))
+
+        reads = [await reader.next_read() for _ in range(4)]
+        assert [(r.reader_type, r.card_id) for r in reads] == [
+            ("RFID", 1), ("NFC", 1), ("RFID", 2), ("RFID", 1)]
+        assert reader.merged == 0
+
+    async def test_errors_are_not_merged(self):
+        reader = self.make_reader(duplicate_window_s=10)
+        for _ in range(3):
+            push_from_thread(12, 0xFFF)
+        assert reader.stats()["pending"] == 3
+
+    async def test_full_queue_drops_oldest(self):
+        reader = self.make_reader(max_pending=4)
+        for card_id in range(10):
+            reader.push(self.key(card_id))
+
+        reads = [await reader.next_read() for _ in range(4)]
+        assert [r.card_id for r in reads] == [6, 7, 8, 9]
+        assert reader.dropped == 6
+
+    async def test_full_queue_drops_oldest_once_running(self):
+        reader = self.make_reader(max_pending=4)
+        consumer = asyncio.create_task(reader.next_read())
+        await asyncio.sleep(0)
+        for card_id in range(10):
+            push_from_thread(26, make_26_bit_frame(card_id))
+        first = await asyncio.wait_for(consumer, timeout=1)
+        await asyncio.sleep(0.01)
+
+        reads = [first] + [await reader.next_read() for _ in range(reader.queue.qsize())]
+        assert len(reads) + reader.dropped == 10
+        assert reads[-1].card_id == 9
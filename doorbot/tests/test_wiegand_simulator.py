@@ -0,0 +1,221 @@
+"""
+Replay simulated and recorded wiegand edge streams through wiegand.decoder and the key reader.
+
+The benchmarks (marked slow) measure decode rate, end to end grant latency through read_tags
+with the relay and slack mocked, and frames arriving back to back.
+"""
+
+import asyncio
+import statistics
+import threading
+import time
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+from doorbot import app
+from doorbot.interfaces import wiegand, wiegand_formats
+from doorbot.tests.conftest import import_real_interface
+from doorbot.tests.pigpio_simulator import (
+    SimulatedPi, TICK_WRAP, frame_edges, frames_edges, read_edge_file)
+
+wiegand_key_reader = import_real_interface('wiegand_key_reader')
+user_manager_module = import_real_interface('user_manager')
+
+RFID_GPIO_0, RFID_GPIO_1 = 5, 6
+
+H10301 = wiegand_formats.lookup(26)
+
+
+def make_decoder():
+    pi = SimulatedPi()
+    codes = []
+    decoder = wiegand.decoder(pi, RFID_GPIO_0, RFID_GPIO_1, lambda bits, value: codes.append((bits, value)))
+    return pi, decoder, codes
+
+
+class TestSimulatedDecoder:
+
+    @pytest.mark.parametrize("bits", [26, 32, 34, 35, 37])
+    def test_frame_is_decoded(self, bits):
+        pi, decoder, codes = make_decoder()
+        value = wiegand_formats.lookup(bits).encode(0x1234567 & wiegand_formats.lookup(bits).id_mask)
+
+        pi.replay(frame_edges(bits, value, RFID_GPIO_0, RFID_GPIO_1, start_tick=1000))
+
+        assert codes == [(bits, value)]
+        assert not pi.watchdogs  # Decoder cancels its watchdogs once the code is complete
+
+    def test_code_ends_on_watchdog_timeout(self):
+        pi, decoder, codes = make_decoder()
+        edges = frame_edges(26, H10301.encode(1), RFID_GPIO_0, RFID_GPIO_1, start_tick=0)
+
+        pi.replay(edges, flush=False)
+        assert codes == []
+        assert decoder.in_code
+
+        # Bit timeout is 5 ms after the last level change
+        pi.advance_to(edges[-1][2] + 4_999)
+        assert codes == []
+        pi.advance_to(edges[-1][2] + 5_000)
+        assert len(codes) == 1
+        assert decoder.code_end_tick - decoder.last_edge_tick == 5_050
+
+    def test_ticks_wrap(self):
+        pi, decoder, codes = make_decoder()
+        start = TICK_WRAP - 52_000
+        edges = [(gpio, level, tick % TICK_WRAP) for gpio, level, tick in
+                 frame_edges(26, H10301.encode(0x123456), RFID_GPIO_0, RFID_GPIO_1, start_tick=start)]
+
+        pi.replay(edges)
+
+        assert codes == [(26, H10301.encode(0x123456))]
+        assert decoder.code_end_tick < decoder.last_edge_tick  # Wrapped between them
+        assert (decoder.code_end_tick - decoder.last_edge_tick) % TICK_WRAP == 5_050
+
+    def test_back_to_back_frames(self):
+        pi, decoder, codes = make_decoder()
+        frames = [(26, H10301.encode(card_id)) for card_id in range(10)]
+
+        # Just over the 5 ms bit timeout between frames
+        pi.replay(frames_edges(frames, RFID_GPIO_0, RFID_GPIO_1, gap_us=5_200))
+
+        assert codes == frames
+
+    def test_frames_closer_than_bit_timeout_merge(self):
+        pi, decoder, codes = make_decoder()
+        frames = [(26, H10301.encode(1)), (26, H10301.encode(2))]
+
+        pi.replay(frames_edges(frames, RFID_GPIO_0, RFID_GPIO_1, gap_us=3_000))
+
+        assert len(codes) == 1
+        assert codes[0][0] == 52
+
+    def test_recorded_stream(self, tmp_path):
+        edges = frame_edges(26, H10301.encode(0x123456), RFID_GPIO_0, RFID_GPIO_1, start_tick=500)
+        recording = tmp_path / "edges.csv"
+        recording.write_text("# gpio,level,tick\n" + "\n".join(f"{g},{l},{t}" for g, l, t in edges) + "\n")
+
+        pi, decoder, codes = make_decoder()
+        pi.replay(read_edge_file(recording))
+
+        assert codes == [(26, H10301.encode(0x123456))]
+
+    async def test_key_reader_queues_replayed_keys(self):
+        pi = SimulatedPi()
+        reader = wiegand_key_reader.KeyReader(pi)
+        frames = [(26, H10301.encode(card_id)) for card_id in (11, 22)] + [(26, 0)]
+
+        pi.replay(frames_edges(frames, RFID_GPIO_0, RFID_GPIO_1))
+
+        reads = [await reader.next_read() for _ in range(3)]
+        assert [read.card_id for read in reads[:2]] == [11, 22]
+        assert "Invalid Parity" in reads[2].error
+        assert reads[0].trace.decode_s == pytest.approx(0.00505)
+
+
+def summary_ms(samples):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return f"median {statistics.median(samples) * 1000:.2f} ms, p95 {p95 * 1000:.2f} ms"
+
+
+@pytest.mark.slow
+class TestWiegandBenchmarks:
+
+    async def test_decode_rate(self):
+        """Frames per second through the decoder, key reader callback and queue"""
+        frame_count = 2000
+        pi = SimulatedPi()
+        reader = wiegand_key_reader.KeyReader(pi, duplicate_window_s=0, max_pending=frame_count)
+        frames = [(26, H10301.encode(card_id)) for card_id in range(frame_count)]
+        edges = frames_edges(frames, RFID_GPIO_0, RFID_GPIO_1)
+
+        start = time.perf_counter()
+        pi.replay(edges)
+        elapsed = time.perf_counter() - start
+
+        rate = frame_count / elapsed
+        print(f"\nDecode rate: {rate:,.0f} frames/s ({len(edges) / elapsed:,.0f} edges/s)")
+        assert reader.stats()["pending"] == frame_count
+        # A reader sends at most a few frames a second, keep a wide margin for the Pi 2
+        assert rate > 500
+
+    async def test_back_to_back_burst(self):
+        """A burst of back to back frames from the pigpio thread all reach the consumer in order"""
+        frame_count = 50
+        pi = SimulatedPi()
+        reader = wiegand_key_reader.KeyReader(pi, max_pending=frame_count)
+        frames = [(26, H10301.encode(card_id)) for card_id in range(frame_count)]
+        edges = frames_edges(frames, RFID_GPIO_0, RFID_GPIO_1, gap_us=5_200)
+
+        async def consume():
+            return [await reader.next_read() for _ in range(frame_count)]
+
+        consumer = asyncio.create_task(consume())
+        await asyncio.sleep(0)
+
+        start = time.perf_counter()
+        await asyncio.to_thread(pi.replay, edges)
+        reads = await asyncio.wait_for(consumer, timeout=5)
+        elapsed = time.perf_counter() - start
+
+        print(f"\nBack to back burst: {frame_count} frames replayed and consumed in {elapsed * 1000:.1f} ms")
+        assert [read.card_id for read in reads] == list(range(frame_count))
+        assert reader.dropped == 0
+        assert reader.merged == 0
+
+    async def test_grant_latency_through_read_tags(self):
+        """Time from the decoder completing a frame until read_tags switches the relay"""
+        grants = 200
+        pi = SimulatedPi()
+        reader = wiegand_key_reader.KeyReader(pi)
+
+        index = {}
+        for card_id in range(grants):
+            key = f"{card_id:0>10}"
+            index[card_id] = user_manager_module.AccessRecord.from_user(
+                key, {"name": f"User {card_id}", "door": 1, "groups": []})
+
+        relay_times = []
+        relay_set = threading.Event()
+
+        def set_relay(channel, state):
+            if state:
+                relay_times.append(time.perf_counter())
+                relay_set.set()
+
+        stats = app.LatencyStats()
+        with patch.object(app, "key_reader", reader), \
+                patch.object(app.user_manager, "index", index), \
+                patch.object(app.hat_gpio, "set_relay", set_relay), \
+                patch.object(app, "door_message_outbox", asyncio.Queue()), \
+                patch.object(app, "access_granted_webhook_outbox", asyncio.Queue()), \
+                patch.object(app, "latency_stats", stats), \
+                patch.object(app.app.client, "chat_postMessage", AsyncMock(return_value={"ts": "1.0"})), \
+                patch.object(app.home_assistant, "call_webhook", AsyncMock()):
+            tasks = [asyncio.create_task(app.read_tags()), asyncio.create_task(app.door_message_worker())]
+            await asyncio.sleep(0)
+
+            latencies = []
+            for card_id in range(grants):
+                edges = frame_edges(26, H10301.encode(card_id), RFID_GPIO_0, RFID_GPIO_1, start_tick=0)
+                relay_set.clear()
+
+                # Frame completes when the final watchdog fires inside replay
+                pi.replay(edges, flush=False)
+                decoded = time.perf_counter()
+                await asyncio.to_thread(pi.flush)
+                while not relay_set.is_set():
+                    await asyncio.sleep(0)
+                latencies.append(relay_times[-1] - decoded)
+
+            await asyncio.sleep(0.05)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        print(f"\nDecoder to relay: {summary_ms(latencies)}")
+        print(stats.format_summary())
+        assert len(relay_times) == grants
+        assert stats.percentiles("tag_to_relay")["p95"] < 0.1
@@ -0,0 +1,88 @@
+"""
+Stub tidyauth server for testing TidyAuthClient and UserManager against a real HTTP server.
+
+Serve StubTidyAuth.app() with the stub_server fixture from conftest.py. Keys and sounds
+can be changed between requests, and failures or delays injected.
+"""
+
+import json
+import asyncio
+import hashlib
+
+from aiohttp import web
+
+
+class StubTidyAuth:
+    def __init__(self, token="secret", keys=None, sounds=None, delay_s=0.0, etag=False, last_modified=None):
+        """
+        keys: door key json, by 10 digit key.
+        sounds: sound url by tidyhq contact id. Contacts without one get a 401 like tidyauth.
+        etag: send an ETag with the keys and answer If-None-Match with 304 if they match.
+        last_modified: Last-Modified to send with the keys, If-Modified-Since equal to it gets 304.
+        """
+        self.token = token
+        self.keys = keys if keys is not None else {}
+        self.sounds = sounds if sounds is not None else {}
+        self.delay_s = delay_s
+        self.etag = etag
+        self.last_modified = last_modified
+
+        # Statuses to respond with (in order) before answering normally
+        self.failures = []
+
+        # (path, query dict) of each request, their headers and the client connections they arrived on
+        self.requests = []
+        self.request_headers = []
+        self.connections = set()
+
+    def app(self):
+        web_app = web.Application()
+        web_app.router.add_get('/', self.handle_test_route)
+        web_app.router.add_get('/api/v1/keys/door', self.handle_keys)
+        web_app.router.add_get('/api/v1/data/sound', self.handle_sound)
+        return web_app
+
+    def count(self, path):
+        return sum(1 for request_path, _ in self.requests if request_path == path)
+
+    async def _record(self, request):
+        """Record the request, returns an error response if one should be sent instead"""
+        self.connections.add(request.transport.get_extra_info('peername'))
+        self.requests.append((request.path, dict(request.query)))
+        self.request_headers.append(dict(request.headers))
+        if self.delay_s:
+            await asyncio.sleep(self.delay_s)
+        if self.failures:
+            return web.Response(status=self.failures.pop(0))
+        if request.query.get('token') != self.token:
+            return web.Response(status=401)
+        return None
+
+    async def handle_test_route(self, request):
+        return await self._record(request) or web.Response(text="ok")
+
+    async def handle_keys(self, request):
+        error = await self._record(request)
+        if error is not None:
+            return error
+
+        body = json.dumps(self.keys)
+        headers = {}
+        if self.etag:
+            headers["ETag"] = f'"{hashlib.sha256(body.encode()).hexdigest()[:16]}"'
+            if request.headers.get("If-None-Match") == headers["ETag"]:
+                return web.Response(status=304, headers=headers)
+        if self.last_modified is not None:
+            headers["Last-Modified"] = self.last_modified
+            if request.headers.get("If-Modified-Since") == self.last_modified:
+                return web.Response(status=304, headers=headers)
+        return web.Response(text=body, content_type="application/json", headers=headers)
+
+    async def handle_sound(self, request):
+        error = await self._record(request)
+        if error is not None:
+            return error
+        tidyhq_id = request.query.get('tidyhq_id')
+        if tidyhq_id not in self.sounds:
+            return web.json_response({"error": "No sound"}, status=401)
+        return web.json_response({"url": self.sounds[tidyhq_id]})
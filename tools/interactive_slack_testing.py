@@ -56,7 +56,7 @@ class MockDoorbotHatGpio:
         return {0: False, 1: False}  # Mock switch states
 
 class MockKeyReader:
-    def __init__(self, pi):
+    def __init__(self, pi, **kwargs):
         logger.info("🏷️ Mock KeyReader initialized")
         
     def start_reading(self):
@@ -78,28 +78,47 @@ class MockBlinkstickInterface:
         self.set_colour_name("white")
 
 class MockTidyAuthClient:
-    def __init__(self, base_url, token):
+    def __init__(self, base_url, token, **kwargs):
         logger.info(f"🔐 Mock TidyAuthClient initialized (url: {base_url})")
 
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {}
+
 class MockUserManager:
-    def __init__(self, api_client, cache_path):
+    def __init__(self, api_client, cache_path, sound_resolver=None, **kwargs):
         logger.info(f"👥 Mock UserManager initialized (cache: {cache_path})")
         
     async def download_keys(self):
         logger.info("👥 Mock UserManager: Downloading keys...")
         await asyncio.sleep(1)  # Simulate API delay
         logger.info("👥 Mock UserManager: Keys downloaded successfully!")
-        return True
+        from doorbot.interfaces.key_diff import KeyChanges
+        return KeyChanges(added=["0000000001"], modified=["0000000002"])
         
+    def note_denied(self, card_id):
+        return True
+    def update_sound(self, sound_hash, path):
+        pass
+    def forget_sound(self, sound_hash):
+        pass
     def key_count(self):
         return 42
+    def stats(self):
+        return {}
+
+    def get_users_with_custom_sounds(self, keys=None):
+        return {}
 
 class MockSoundDownloader:
-    def __init__(self, users_with_custom_sounds, download_directory):
+    def __init__(self, users_with_custom_sounds, download_directory, on_download=None, **kwargs):
+        self.failed_hashes = set()
         logger.info(f"🔊 Mock SoundDownloader initialized")
         
-    def download_next_sound(self):
-        return False  # No more sounds to download
+    async def download_all(self):
+        return {"downloaded": 0, "skipped": 0, "resumed": 0, "failed": 0, "bytes_received": 0}
 
 class MockSoundPlayer:
     def __init__(self, sound_dir, custom_sound_dir):
@@ -108,23 +127,16 @@ class MockSoundPlayer:
     def play_sound(self, sound_name):
         logger.info(f"🔊 Mock SoundPlayer: Playing sound '{sound_name}'")
 
-class MockMonotonicWaiter:
-    def __init__(self, name):
-        self.name = name
-        self._duration = 0
-        logger.info(f"⏰ Mock MonotonicWaiter '{name}' initialized")
-        
-    def set_wait_time(self, duration_s):
-        self._duration = duration_s
-        logger.info(f"⏰ Mock {self.name}: Wait time set to {duration_s}s")
-        
-    async def wait(self):
-        if self._duration > 0:
-            logger.info(f"⏰ Mock {self.name}: Timer triggered ({self._duration}s)")
-            self._duration = 0
-            return True
-        await asyncio.sleep(0.1)
-        return False
+    def find_sound_by_hash(self, sound_hash):
+        return None
+
+    def custom_sound_downloaded(self, sound_hash, path):
+        pass
+    def custom_sound_removed(self, sound_hash, path):
+        pass
+
+    def stats(self):
+        return {}
 
 class MockTextToSpeech:
     def non_blocking_speak(self, text):
@@ -143,7 +155,6 @@ sys.modules['doorbot.interfaces.tidyauth_client'] = Mock(TidyAuthClient=MockTidy
 sys.modules['doorbot.interfaces.user_manager'] = Mock(UserManager=MockUserManager)
 sys.modules['doorbot.interfaces.sound_downloader'] = Mock(SoundDownloader=MockSoundDownloader)
 sys.modules['doorbot.interfaces.sound_player'] = Mock(SoundPlayer=MockSoundPlayer)
-sys.modules['doorbot.interfaces.monotonic_waiter'] = Mock(MonotonicWaiter=MockMonotonicWaiter)
 sys.modules['doorbot.interfaces.text_to_speech'] = mock_tts_module
 
 logger.info("✅ All hardware interfaces mocked successfully!")